@@ -9,12 +9,188 @@
         Development of an ASM2d-N2O model to describe nitrous oxide emissions in municipal WWTPs under dynamic conditions. 
         Chemical Engineering Journal, 335, pp.185-196.
         (https://doi.org/10.1016/j.cej.2017.10.119)
+
+        Foley, J., de Haas, D., Yuan, Z. and Lant, P., 2010. Nitrous oxide generation in full-scale
+        biological nutrient removal wastewater treatment plants. Water Research, 44(3), pp.831-844.
 """
 
 
 import math
 
+import numpy as np
+
 from .asmbase import asm_model
+from .kernel import load_kernel
+
+
+## Kinetic backends of single-state evaluations (see ASM2d_N2O.__init__)
+BACKENDS = ('python', 'numba')
+
+## Model components, in state vector order
+COMP_NAMES = ('S_O2', 'S_F', 'S_A', 'S_NH4', 'S_NH2OH', 'S_N2O', 'S_NO', 'S_NO2', 'S_NO3', 'S_PO4', 'S_I',
+              'S_ALK', 'S_N2', 'X_I', 'X_S', 'X_H', 'X_PAO', 'X_PP', 'X_PHA', 'X_AOB', 'X_NOB', 'X_TSS',
+              'X_MeOH', 'X_MeP')
+
+## Dissolved gases stripped by aeration (see ASM2d_N2O.set_stripping)
+STRIPPED_GASES = ('S_N2O', 'S_NO', 'S_N2')
+
+## Diffusivities in water at 20-25C, m2/s; by penetration theory KLa scales with their square root
+GAS_DIFFUSIVITY = {'S_O2': 2.10e-9, 'S_N2O': 1.84e-9, 'S_NO': 2.21e-9, 'S_N2': 1.88e-9}
+
+## Declarative kinetic matrix, compiled into flat functions by kernel.py. Expressions may use
+## component names, parameter names (keys of _kinetics_20C), fna_factor (mgHNO2 per mgN of
+## nitrite), the auxiliary terms and the Monod terms m0, m1, ... in the order listed here.
+
+## Auxiliary terms: (name, expression)
+_AUX_TERMS = (
+    # free nitrous acid, mgHNO2/L
+    ('S_HNO2', 'S_NO2 * fna_factor'),
+    # Haldane-type oxygen dependency of the ND pathway
+    ('fSO2', 'S_O2 / (K_O2_AOB_ND + (1.0 - 2.0 * (K_O2_AOB_ND / K_I_O2_AOB) ** 0.5) * S_O2 + S_O2 ** 2 / K_I_O2_AOB)'),
+)
+
+## Monod or inhibition terms: (term in both numerator & denominator, term only in denominator)
+_MONOD_TERMS = (
+    ('S_O2', 'K_O2_H'),                                       # m0
+    ('X_S / X_H', 'K_X_H'),                                   # m1
+    ('K_O2_H', 'S_O2'),                                       # m2
+    ('S_NO3', 'K_NO3_H'),                                     # m3
+    ('S_NO2', 'K_NO2_H'),                                     # m4
+    ('K_NO2_H', 'S_NO2 + S_NO3'),                             # m5
+    ('S_F', 'K_F'),                                           # m6
+    ('S_F', 'S_A'),                                           # m7
+    ('S_O2', 'K_O2'),                                         # m8
+    ('S_NH4', 'K_NH4'),                                       # m9
+    ('S_PO4', 'K_P'),                                         # m10
+    ('S_ALK', 'K_ALK'),                                       # m11
+    ('S_A', 'K_A'),                                           # m12
+    ('S_A', 'S_F'),                                           # m13
+    ('K_O2', 'S_O2'),                                         # m14
+    ('S_F', 'K_S3'),                                          # m15
+    ('S_NO2', 'K_NO2_Den'),                                   # m16
+    ('K_OH3', 'S_O2'),                                        # m17
+    ('S_F', 'K_S4'),                                          # m18
+    ('S_NO', 'K_NO_Den + (S_NO)**2 / K_I4NO'),                # m19
+    ('K_OH4', 'S_O2'),                                        # m20
+    ('S_F', 'K_S5'),                                          # m21
+    ('S_N2O', 'K_N2O_Den'),                                   # m22
+    ('K_OH5', 'S_O2'),                                        # m23
+    ('S_A', 'K_S3'),                                          # m24
+    ('S_A', 'K_S4'),                                          # m25
+    ('S_A', 'K_S5'),                                          # m26
+    ('K_NO2', 'S_NO2 + S_NO3'),                               # m27
+    ('S_F', 'K_fe_H'),                                        # m28
+    ('S_A', 'K_A_P'),                                         # m29
+    ('S_ALK', 'K_ALK_P'),                                     # m30
+    ('X_PP / X_PAO', 'K_PP_P'),                               # m31
+    ('S_O2', 'K_O2_P'),                                       # m32
+    ('S_PO4', 'K_P_P'),                                       # m33
+    ('X_PHA / X_PAO', 'K_PHA_P'),                             # m34
+    ('K_MAX_P - (X_PP / X_PAO)', 'K_IPP_P'),                  # m35
+    ('S_NO3', 'K_NO3_P'),                                     # m36
+    ('K_O2_P', 'S_O2'),                                       # m37
+    ('S_O2', 'K_O2_AOB1'),                                    # m38
+    ('S_NH4', 'K_NH4_AOB'),                                   # m39
+    ('S_O2', 'K_O2_AOB2'),                                    # m40
+    ('S_NH2OH', 'K_NH2OH_AOB'),                               # m41
+    ('S_PO4', 'K_P_AOB'),                                     # m42
+    ('S_ALK', 'K_ALK_AOB'),                                   # m43
+    ('S_NO', 'K_NO_AOB_HAO'),                                 # m44
+    ('S_NO', 'K_NO_AOB_NN'),                                  # m45
+    ('S_HNO2', 'K_HNO2_AOB'),                                 # m46
+    ('S_O2', 'K_O2_NOB'),                                     # m47
+    ('S_NO2', 'K_NO2_NOB'),                                   # m48
+    ('S_PO4', 'K_P_NOB'),                                     # m49
+    ('S_ALK', 'K_ALK_NOB'),                                   # m50
+    ('S_ALK', 'K_ALK_PR'),                                    # m51
+    ('S_NO3', 'K_NO3'),                                       # m52
+    ('S_NH4', '10e-12'),                                      # m53
+)
+
+## Process rate expressions, one per process (stoichiometric key prefix 1..40)
+_RATE_EXPRS = (
+    # 1 Aerobic hydrolysis
+    'K_H * m0 * m1 * X_H',
+    # 2 Anoxic hydrolysis with nitrate
+    'K_H * n_NO3_H * m2 * m3 * m1 * X_H',
+    # 3 Anoxic hydrolysis with nitrite
+    'K_H * n_NO2_H * m2 * m4 * m1 * X_H',
+    # 4 Anaerobic hydrolysis
+    'K_H * n_fe_H * m2 * m5 * m1 * X_H',
+    # 5 Aerobic growth of X_H on S_F
+    'mu_H * m6 * m7 * m8 * m9 * m10 * m11 * X_H',
+    # 6 Aerobic growth of X_H on S_A
+    'mu_H * m12 * m13 * m8 * m9 * m10 * m11 * X_H',
+    # 7 Growth of X_H on S_F, NO3 -> NO2
+    'mu_H * n_NO3_D * m6 * m7 * m14 * m52 * m9 * m10 * m11 * X_H',
+    # 8 Growth of X_H on S_F, NO2 -> NO
+    'mu_H * n_G3 * m15 * m7 * m16 * m17 * m9 * m10 * m11 * X_H',
+    # 9 Growth of X_H on S_F, NO -> N2O
+    'mu_H * n_G4 * m18 * m7 * m19 * m20 * m9 * m10 * m11 * X_H',
+    # 10 Growth of X_H on S_F, N2O -> N2
+    'mu_H * n_G5 * m21 * m7 * m22 * m23 * m9 * m10 * m11 * X_H',
+    # 11 Growth of X_H on S_A, NO3 -> NO2
+    'mu_H * n_NO3_D * m12 * m13 * m14 * m52 * m9 * m10 * m11 * X_H',
+    # 12 Growth of X_H on S_A, NO2 -> NO
+    'mu_H * n_G3 * m24 * m13 * m16 * m17 * m9 * m10 * m11 * X_H',
+    # 13 Growth of X_H on S_A, NO -> N2O
+    'mu_H * n_G4 * m25 * m13 * m19 * m20 * m9 * m10 * m11 * X_H',
+    # 14 Growth of X_H on S_A, N2O -> N2
+    'mu_H * n_G5 * m26 * m13 * m22 * m23 * m9 * m10 * m11 * X_H',
+    # 15 Fermentation
+    'q_fe * m14 * m27 * m28 * m11 * X_H',
+    # 16 Lysis of X_H
+    'b_H * X_H',
+    # 17 Storage of X_PHA
+    'q_PHA * m29 * m30 * m31 * X_PAO',
+    # 18 Aerobic storage of X_PP
+    'q_PP * m32 * m33 * m30 * m34 * m35 * X_PAO',
+    # 19 Anoxic storage of X_PP, NO3 -> NO2
+    'q_PP * n_NO3_P * m36 * m37 * m33 * m30 * m34 * m35 * X_PAO',
+    # 20 Anoxic storage of X_PP, NO2 -> NO
+    'q_PP * n_G3 * m16 * m17 * m33 * m30 * m34 * m35 * X_PAO',
+    # 21 Anoxic storage of X_PP, NO -> N2O
+    'q_PP * n_G4 * m19 * m20 * m33 * m30 * m34 * m35 * X_PAO',
+    # 22 Anoxic storage of X_PP, N2O -> N2
+    'q_PP * n_G5 * m22 * m23 * m33 * m30 * m34 * m35 * X_PAO',
+    # 23 Aerobic growth of X_PAO
+    'mu_PAO * m32 * m33 * m9 * m30 * m34 * X_PAO',
+    # 24 Anoxic growth of X_PAO, NO3 -> NO2
+    'mu_PAO * n_NO3_P * m36 * m37 * m33 * m9 * m30 * m34 * X_PAO',
+    # 25 Anoxic growth of X_PAO, NO2 -> NO
+    'mu_PAO * n_G3 * m16 * m17 * m33 * m9 * m30 * m34 * X_PAO',
+    # 26 Anoxic growth of X_PAO, NO -> N2O
+    'mu_PAO * n_G4 * m19 * m20 * m33 * m9 * m30 * m34 * X_PAO',
+    # 27 Anoxic growth of X_PAO, N2O -> N2
+    'mu_PAO * n_G5 * m22 * m23 * m33 * m9 * m30 * m34 * X_PAO',
+    # 28 Lysis of X_PAO
+    'b_PAO * m30 * X_PAO',
+    # 29 Lysis of X_PP
+    'b_PP * m30 * X_PP',
+    # 30 Lysis of X_PHA
+    'b_PHA * m30 * X_PHA',
+    # 31 AMO, NH4 -> NH2OH
+    'q_AOB_AMO * m38 * m39 * X_AOB',
+    # 32 HAO, NH2OH -> NO, growth of X_AOB
+    'mu_AOB_HAO * m40 * m41 * m53 * m42 * m43 * X_AOB',
+    # 33 HAO, NO -> NO2
+    'q_AOB_HAO * m40 * m44 * X_AOB',
+    # 34 N2O by NN pathway (NO reduction)
+    'q_AOB_N2O_NN * m41 * m45 * X_AOB',
+    # 35 N2O by ND pathway (nitrifier denitrification)
+    'q_AOB_N2O_ND * m41 * m46 * fSO2 * X_AOB',
+    # 36 Growth of X_NOB
+    'mu_NOB * m47 * m48 * m49 * m50 * X_NOB',
+    # 37 Lysis of X_AOB
+    'b_AOB * X_AOB',
+    # 38 Lysis of X_NOB
+    'b_NOB * X_NOB',
+    # 39 Precipitation
+    'k_PRE * S_PO4 * X_MeOH',
+    # 40 Redissolution
+    'k_RED * m51 * X_MeP',
+)
+
 
 class ASM2d_N2O(asm_model):
     '''
@@ -22,21 +198,27 @@ class ASM2d_N2O(asm_model):
 
     '''
 
-    def __init__(self, ww_temp=20, DO=2):
+    def __init__(self, ww_temp=20, DO=2, backend='python'):
         '''
         Initialize the ASM2d-N2O model with water temperature and dissolved oxygen.
 
         Args:
             ww_temp:   wastewater temperature, degC;
-            DO:        dissoved oxygen, mg/L
+            DO:        dissoved oxygen, mg/L;
+            backend:   'python', or 'numba' to evaluate single reactor states with
+                       numba-compiled kinetics (pure Python if numba is not installed)
 
         Return:
             None
 
         '''
+        if backend not in BACKENDS:
+            raise ValueError('backend must be one of {}'.format(BACKENDS))
+
         asm_model.__init__(self)
 
         self._set_ideal_kinetics_20C_to_defaults()
+        self._index_params()
 
         # wastewater temperature used in the model, degC
         self._temperature = ww_temp
@@ -46,16 +228,58 @@ class ASM2d_N2O(asm_model):
         # temperature gap between project condition and default value, degC
         self._delta_t = self._temperature - 20
 
+        # mixed liquor pH, fixed or given as a forcing function of time (see set_pH)
+        self._pH = 7.0
+        self._pH_forcing = None
+
+        # free nitrous acid per unit nitrite, mgHNO2/mgN, at the current temperature and pH
+        self._fna_factor = 0.0
+
+        # stripped gases as component positions, their KLa per unit oxygen KLa (0: not
+        # stripped) and their concentrations in equilibrium with the gas phase, mg/L
+        self._strip_idx = np.array([COMP_NAMES.index(gas) for gas in STRIPPED_GASES])
+        self._strip_ratio = np.zeros(len(STRIPPED_GASES))
+        self._strip_sat = np.zeros(len(STRIPPED_GASES))
+
         self.update(ww_temp, DO)
 
+        # requested kinetic backend of single-state evaluations (see get_backend)
+        self._backend = backend
+
+        # flat kinetic functions generated from the tables above (see kernel.py)
+        self._load_kernels()
+
+        # positions of the stoichiometric entries passed to the kernel, in the order of _stoichs
+        keys = [key.split('_') for key in self._stoichs]
+        self._stoich_pos = (np.array([int(proc) - 1 for proc, _ in keys]),
+                            np.array([int(comp) - 1 for _, comp in keys]))
+        # (_stoich_mat, its entries at _stoich_pos) for the compiled net_rates
+        self._stoich_flat = (None, None)
+
         # ASM2d-N2O model components
         self._comps = [0.0] * 24
 
-        # intermediate results of Monod or Inhibition Terms
-        self._monods = [1.0] * 52
-
         # intermediate results of rate expressions
-        self._rate_res = [0.0] * 40
+        self._rate_res = np.zeros(40)
+
+        # intermediate hydraulic term of rhs_into
+        self._hyd_res = np.zeros(24)
+
+        # state handed to the kernels by rhs_into, and its stripping rates; indexing the
+        # memoryview gives the Python floats the scalar rate code evaluates fastest
+        self._comps_arr = np.zeros(24)
+        self._comps_view = memoryview(self._comps_arr)
+        self._strip_res = np.zeros((2, len(STRIPPED_GASES)))
+
+        # whether _dCdt sums the process rates with the dense stoichiometric
+        # matrix (True) or with the unrolled _rateN_* methods (False)
+        self._use_stoich_mat = True
+
+        # static 24x24 sparsity pattern of the Jacobian of _dCdt
+        self._jac_sparsity = self._build_jac_sparsity()
+
+        # derivatives of the stoichiometric matrix with respect to the parameters (see param_vjp)
+        self._dstoich_cache = (None, None, None)
 
         return None
     
@@ -182,452 +406,591 @@ class ASM2d_N2O(asm_model):
         self._kinetics_20C['k_RED'] = 0.6
         self._kinetics_20C['K_ALK_PR'] = 0.5
 
+        ## Arrhenius temperature coefficients, k_T = k_20C * theta ** (T - 20)
+        ## from the 20 and 10 degC values of ASM2d (Henze et al., 2000); all other constants have theta == 1
+        self._arrhenius_theta['K_H'] = 1.041
+        self._arrhenius_theta['mu_H'] = 1.072
+        self._arrhenius_theta['q_fe'] = 1.072
+        self._arrhenius_theta['b_H'] = 1.072
+        self._arrhenius_theta['mu_H_Den'] = 1.072
+
+        self._arrhenius_theta['q_PHA'] = 1.041
+        self._arrhenius_theta['q_PP'] = 1.041
+        self._arrhenius_theta['mu_PAO'] = 1.041
+        self._arrhenius_theta['b_PAO'] = 1.072
+        self._arrhenius_theta['b_PP'] = 1.072
+        self._arrhenius_theta['b_PHA'] = 1.072
+
+        self._arrhenius_theta['mu_AOB_HAO'] = 1.111
+        self._arrhenius_theta['q_AOB_AMO'] = 1.111
+        self._arrhenius_theta['q_AOB_HAO'] = 1.111
+        self._arrhenius_theta['q_AOB_N2O_NN'] = 1.111
+        self._arrhenius_theta['q_AOB_N2O_ND'] = 1.111
+        self._arrhenius_theta['mu_NOB'] = 1.111
+        self._arrhenius_theta['b_AOB'] = 1.116
+        self._arrhenius_theta['b_NOB'] = 1.116
+
         return None
     
-    def _set_params(self):
+    def _set_stoichs(self):
         '''
-        Set the kinetic parameters/constants at project temperature.
-        TODO: update the parameters based on the temperature by Arrhenius equation.
+        Set the stoichiometrics for the model.
 
         '''
+        ## a new dict is built on every call, so update() can memoize it
+        self._stoichs = self._stoich_values(self._params)
 
-        ## Conversion factors
-        self._params['i_NSF'] = self._kinetics_20C['i_NSF']
-        self._params['i_PSF'] = self._kinetics_20C['i_PSF']
-        self._params['i_NSI'] = self._kinetics_20C['i_NSI']
-        self._params['i_PSI'] = self._kinetics_20C['i_PSI']
-        self._params['i_NXI'] = self._kinetics_20C['i_NXI']
-        self._params['i_PXI'] = self._kinetics_20C['i_PXI']
-        self._params['i_TSSXI'] = self._kinetics_20C['i_TSSXI']
-        self._params['i_NXS'] = self._kinetics_20C['i_NXS']
-        self._params['i_PXS'] = self._kinetics_20C['i_PXS']
-        self._params['i_TSSXS'] = self._kinetics_20C['i_TSSXS']
-        self._params['i_NBM'] = self._kinetics_20C['i_NBM']
-        self._params['i_PBM'] = self._kinetics_20C['i_PBM']
-        self._params['i_TSSBM'] = self._kinetics_20C['i_TSSBM']
-
-        ## Stoichiometric coefficients
-        self._params['Y_H'] = self._kinetics_20C['Y_H']
-        self._params['Y_PHA'] = self._kinetics_20C['Y_PHA']
-        self._params['Y_PAO'] = self._kinetics_20C['Y_PAO']
-        self._params['Y_PO4'] = self._kinetics_20C['Y_PO4']
-        self._params['Y_AOB'] = self._kinetics_20C['Y_AOB']
-        self._params['Y_NOB'] = self._kinetics_20C['Y_NOB']
-        self._params['f_SI'] = self._kinetics_20C['f_SI']
-        self._params['f_XI'] = self._kinetics_20C['f_XI']
-        self._params['n_G'] = self._kinetics_20C['n_G']
+        ## Dense stoichiometric matrix, _stoich_mat[x - 1, y - 1] == _stoichs['x_y']
+        self._stoich_mat = np.zeros((40, 24))
+        for key, val in self._stoichs.items():
+            proc, comp = key.split('_')
+            self._stoich_mat[int(proc) - 1, int(comp) - 1] = val
 
-        ## Kinetic parameters
-        self._params['K_H'] = self._kinetics_20C['K_H']
-        self._params['K_O2_H'] = self._kinetics_20C['K_O2_H']
-        self._params['K_X_H'] = self._kinetics_20C['K_X_H']
-        self._params['n_NO3_H'] = self._kinetics_20C['n_NO3_H']
-        self._params['n_NO2_H'] = self._kinetics_20C['n_NO2_H']
-        self._params['K_NO3_H'] = self._kinetics_20C['K_NO3_H']
-        self._params['K_NO2_H'] = self._kinetics_20C['K_NO2_H']
-        self._params['n_fe_H'] = self._kinetics_20C['n_fe_H']
-
-        self._params['mu_H'] = self._kinetics_20C['mu_H']
-        self._params['K_O2'] = self._kinetics_20C['K_O2']
-        self._params['K_F'] = self._kinetics_20C['K_F']
-        self._params['K_NH4'] = self._kinetics_20C['K_NH4']
-        self._params['K_P'] = self._kinetics_20C['K_P']
-        self._params['K_ALK'] = self._kinetics_20C['K_ALK']
-        self._params['K_A'] = self._kinetics_20C['K_A']
-        self._params['K_NO3'] = self._kinetics_20C['K_NO3']
-        self._params['K_NO2'] = self._kinetics_20C['K_NO2']
-        self._params['n_NO3_D'] = self._kinetics_20C['n_NO3_D']
-        self._params['q_fe'] = self._kinetics_20C['q_fe']
-        self._params['K_fe_H'] = self._kinetics_20C['K_fe_H']
-        self._params['b_H'] = self._kinetics_20C['b_H']
-        self._params['mu_H_Den'] = self._kinetics_20C['mu_H_Den']
-        self._params['n_G3'] = self._kinetics_20C['n_G3']
-        self._params['n_G4'] = self._kinetics_20C['n_G4']
-        self._params['n_G5'] = self._kinetics_20C['n_G5']
-        self._params['K_S3'] = self._kinetics_20C['K_S3']
-        self._params['K_S4'] = self._kinetics_20C['K_S4']
-        self._params['K_S5'] = self._kinetics_20C['K_S5']
-        self._params['K_NO2_Den'] = self._kinetics_20C['K_NO2_Den']
-        self._params['K_OH4'] = self._kinetics_20C['K_OH4']
-        self._params['K_N2O_Den'] = self._kinetics_20C['K_N2O_Den']
-        self._params['K_OH3'] = self._kinetics_20C['K_OH3']
-        self._params['K_NO_Den'] = self._kinetics_20C['K_NO_Den']
-        self._params['K_OH5'] = self._kinetics_20C['K_OH5']
-        self._params['K_I3NO'] = self._kinetics_20C['K_I3NO']
-        self._params['K_I4NO'] = self._kinetics_20C['K_I4NO']
-        self._params['K_I5NO'] = self._kinetics_20C['K_I5NO']
-
-        self._params['q_PHA'] = self._kinetics_20C['q_PHA']
-        self._params['K_A_P'] = self._kinetics_20C['K_A_P']
-        self._params['K_ALK_P'] = self._kinetics_20C['K_ALK_P']
-        self._params['q_PP'] = self._kinetics_20C['q_PP']
-        self._params['K_O2_P'] = self._kinetics_20C['K_O2_P']
-        self._params['K_P_P'] = self._kinetics_20C['K_P_P']
-        self._params['K_PHA_P'] = self._kinetics_20C['K_PHA_P']
-        self._params['K_MAX_P'] = self._kinetics_20C['K_MAX_P']
-        self._params['K_PP_P'] = self._kinetics_20C['K_PP_P']
-        self._params['K_IPP_P'] = self._kinetics_20C['K_IPP_P']
-        self._params['K_PO4_P'] = self._kinetics_20C['K_PO4_P']
-        self._params['n_NO3_P'] = self._kinetics_20C['n_NO3_P']
-        self._params['n_NO2_P'] = self._kinetics_20C['n_NO2_P']
-        self._params['K_NO3_P'] = self._kinetics_20C['K_NO3_P']
-        self._params['K_NO2_P'] = self._kinetics_20C['K_NO2_P']
-        self._params['mu_PAO'] = self._kinetics_20C['mu_PAO']
-        self._params['b_PAO'] = self._kinetics_20C['b_PAO']
-        self._params['b_PP'] = self._kinetics_20C['b_PP']
-        self._params['b_PHA'] = self._kinetics_20C['b_PHA']
-
-        self._params['mu_AOB_HAO'] = self._kinetics_20C['mu_AOB_HAO']
-        self._params['q_AOB_AMO'] = self._kinetics_20C['q_AOB_AMO']
-        self._params['K_O2_AOB1'] = self._kinetics_20C['K_O2_AOB1']
-        self._params['K_NH4_AOB'] = self._kinetics_20C['K_NH4_AOB']
-        self._params['K_O2_AOB2'] = self._kinetics_20C['K_O2_AOB2']
-        self._params['K_NH2OH_AOB'] = self._kinetics_20C['K_NH2OH_AOB']
-        self._params['q_AOB_HAO'] = self._kinetics_20C['q_AOB_HAO']
-        self._params['K_NO_AOB_HAO'] = self._kinetics_20C['K_NO_AOB_HAO']
-        self._params['q_AOB_N2O_NN'] = self._kinetics_20C['q_AOB_N2O_NN']
-        self._params['K_NO_AOB_NN'] = self._kinetics_20C['K_NO_AOB_NN']
-        self._params['K_O2_AOB_ND'] = self._kinetics_20C['K_O2_AOB_ND']
-        self._params['K_I_O2_AOB'] = self._kinetics_20C['K_I_O2_AOB']
-        self._params['K_HNO2_AOB'] = self._kinetics_20C['K_HNO2_AOB']
-        self._params['q_AOB_N2O_ND'] = self._kinetics_20C['q_AOB_N2O_ND']
-        self._params['K_ALK_AOB'] = self._kinetics_20C['K_ALK_AOB']
-        self._params['K_P_AOB'] = self._kinetics_20C['K_P_AOB']
-        self._params['mu_NOB'] = self._kinetics_20C['mu_NOB']
-        self._params['K_O2_NOB'] = self._kinetics_20C['K_O2_NOB']
-        self._params['K_ALK_NOB'] = self._kinetics_20C['K_ALK_NOB']
-        self._params['K_NO2_NOB'] = self._kinetics_20C['K_NO2_NOB']
-        self._params['K_P_NOB'] = self._kinetics_20C['K_P_NOB']
-        self._params['b_AOB'] = self._kinetics_20C['b_AOB']
-        self._params['b_NOB'] = self._kinetics_20C['b_NOB']
-
-        self._params['k_PRE'] = self._kinetics_20C['k_PRE']
-        self._params['k_RED'] = self._kinetics_20C['k_RED']
-        self._params['K_ALK_PR'] = self._kinetics_20C['K_ALK_PR']
-        
         return None
 
-    def _set_stoichs(self):
+    def _stoich_values(self, params):
         '''
-        Set the stoichiometrics for the model.
+        Stoichiometric coefficients for the given kinetic parameters.
+
+        Args:
+            params (mapping): Kinetic parameters by name; values may be floats or
+                equally shaped NumPy arrays (one entry per parameter sample).
 
+        Return:
+            stoichs (dict): Stoichiometric coefficients by key 'x_y'.
         '''
 
         ## Stoichiometric coefficients
         ## definition can be found in the Stoichiometric matrix of ASM2d-N2O model documentation (https://doi.org/10.1016/j.cej.2017.10.119)
-        ## _stoichs['x_y'] ==> x is process index, and y is component index
+        ## stoichs['x_y'] ==> x is process index, and y is component index
+        stoichs = {}
+
+        stoichs['1_2'] = 1.0 - params['f_SI']
+        stoichs['1_4'] = params['i_NXS'] - (1.0 - params['f_SI']) * params['i_NSF']
+        stoichs['1_10'] = params['i_PXS'] - (1.0 - params['f_SI']) * params['i_PSF']
+        stoichs['1_11'] = params['f_SI']
+        stoichs['1_15'] = -1.0
+        stoichs['1_12'] = (1 / 14) * stoichs['1_4'] + (-1.5 / 31) * stoichs['1_10']
+        stoichs['1_22'] = params['i_TSSXS'] * stoichs['1_15']
+
+        stoichs['2_2'] = 1.0 - params['f_SI']
+        stoichs['2_4'] = params['i_NXS'] - (1.0 - params['f_SI']) * params['i_NSF']
+        stoichs['2_10'] = params['i_PXS'] - (1.0 - params['f_SI']) * params['i_PSF']
+        stoichs['2_11'] = params['f_SI']
+        stoichs['2_15'] = -1.0
+        stoichs['2_12'] = (1 / 14) * stoichs['2_4'] + (-1.5 / 31) * stoichs['2_10']
+        stoichs['2_22'] = params['i_TSSXS'] * stoichs['2_15']
+
+        stoichs['3_2'] = 1.0 - params['f_SI']
+        stoichs['3_4'] = params['i_NXS'] - (1.0 - params['f_SI']) * params['i_NSF']
+        stoichs['3_10'] = params['i_PXS'] - (1.0 - params['f_SI']) * params['i_PSF']
+        stoichs['3_11'] = params['f_SI']
+        stoichs['3_15'] = -1.0
+        stoichs['3_12'] = (1 / 14) * stoichs['3_4'] + (-1.5 / 31) * stoichs['3_10']
+        stoichs['3_22'] = params['i_TSSXS'] * stoichs['3_15']
+
+        stoichs['4_2'] = 1.0 - params['f_SI']
+        stoichs['4_4'] = params['i_NXS'] - (1.0 - params['f_SI']) * params['i_NSF']
+        stoichs['4_10'] = params['i_PXS'] - (1.0 - params['f_SI']) * params['i_PSF']
+        stoichs['4_11'] = params['f_SI']
+        stoichs['4_15'] = -1.0
+        stoichs['4_12'] = (1 / 14) * stoichs['4_4'] + (-1.5 / 31) * stoichs['4_10']
+        stoichs['4_22'] = params['i_TSSXS'] * stoichs['4_15']
+
+        stoichs['5_1'] = 1.0 - (1.0 / params['Y_H'])
+        stoichs['5_2'] = -1.0 / params['Y_H']
+        stoichs['5_4'] = params['i_NSF'] / params['Y_H'] - params['i_NBM']
+        stoichs['5_10'] = params['i_PSF'] / params['Y_H'] - params['i_PBM']
+        stoichs['5_16'] = 1.0
+        stoichs['5_12'] = (1 / 14) * stoichs['5_4'] + (-1.5 / 31) * stoichs['5_10']
+        stoichs['5_22'] = params['i_TSSBM'] * stoichs['5_16']
+
+        stoichs['6_1'] = 1.0 - (1.0 / params['Y_H'])
+        stoichs['6_3'] = -1.0 / params['Y_H']
+        stoichs['6_4'] = 0.0 - params['i_NBM']
+        stoichs['6_10'] = 0.0 - params['i_PBM']
+        stoichs['6_16'] = 1.0
+        stoichs['6_12'] = (-1 / 64) * stoichs['6_3'] + (1 / 14) * stoichs['6_4'] + (-1.5 / 31) * stoichs['6_10']
+        stoichs['6_22'] = params['i_TSSBM'] * stoichs['6_16']
+
+        stoichs['7_2'] = -1.0 / (params['Y_H'] * params['n_G'])
+        stoichs['7_4'] = params['i_NSF'] / params['Y_H'] - params['i_NBM']
+        stoichs['7_8'] = (1.0 - params['Y_H'] * params['n_G']) / ((8 / 7) * params['Y_H'] * params['n_G'])
+        stoichs['7_9'] = 0.0 - (1.0 - params['Y_H'] * params['n_G']) / ((8 / 7) * params['Y_H'] * params['n_G'])
+        stoichs['7_10'] = params['i_PSF'] / params['Y_H'] - params['i_PBM']
+        stoichs['7_16'] = 1.0
+        stoichs['7_12'] = (1 / 14) * stoichs['7_4'] + (-1 / 14) * stoichs['7_8'] + (-1 / 14) * stoichs['7_9'] + (-1.5 / 31) * stoichs['7_10']
+        stoichs['7_22'] = params['i_TSSBM'] * stoichs['7_16']
+
+        stoichs['8_2'] = -1.0 / (params['Y_H'] * params['n_G'])
+        stoichs['8_4'] = params['i_NSF'] / params['Y_H'] - params['i_NBM']
+        stoichs['8_7'] = (1.0 - params['Y_H'] * params['n_G']) / ((4 / 7) * params['Y_H'] * params['n_G'])
+        stoichs['8_8'] = 0.0 - (1.0 - params['Y_H'] * params['n_G']) / ((4 / 7) * params['Y_H'] * params['n_G'])
+        stoichs['8_10'] = params['i_PSF'] / params['Y_H'] - params['i_PBM']
+        stoichs['8_16'] = 1.0
+        stoichs['8_12'] = (1 / 14) * stoichs['8_4'] + (-1 / 14) * stoichs['8_8'] + (-1.5 / 31) * stoichs['8_10']
+        stoichs['8_22'] = params['i_TSSBM'] * stoichs['8_16']
+
+        stoichs['9_2'] = -1.0 / (params['Y_H'] * params['n_G'])
+        stoichs['9_4'] = params['i_NSF'] / params['Y_H'] - params['i_NBM']
+        stoichs['9_6'] = (1.0 - params['Y_H'] * params['n_G']) / ((4 / 7) * params['Y_H'] * params['n_G'])
+        stoichs['9_7'] = 0.0 - (1.0 - params['Y_H'] * params['n_G']) / ((4 / 7) * params['Y_H'] * params['n_G'])
+        stoichs['9_10'] = params['i_PSF'] / params['Y_H'] - params['i_PBM']
+        stoichs['9_16'] = 1.0
+        stoichs['9_12'] = (1 / 14) * stoichs['9_4']+ (-1.5 / 31) * stoichs['9_10']
+        stoichs['9_22'] = params['i_TSSBM'] * stoichs['9_16']
+
+        stoichs['10_2'] = -1.0 / (params['Y_H'] * params['n_G'])
+        stoichs['10_4'] = params['i_NSF'] / params['Y_H'] - params['i_NBM']
+        stoichs['10_6'] = 0.0 - (1.0 - params['Y_H'] * params['n_G']) / ((4 / 7) * params['Y_H'] * params['n_G'])
+        stoichs['10_10'] = params['i_PSF'] / params['Y_H'] - params['i_PBM']
+        stoichs['10_13'] = (1.0 - params['Y_H'] * params['n_G']) / ((4 / 7) * params['Y_H'] * params['n_G'])
+        stoichs['10_16'] = 1.0
+        stoichs['10_12'] = (1 / 14) * stoichs['10_4'] + (-1.5 / 31) * stoichs['10_10']
+        stoichs['10_22'] = params['i_TSSBM'] * stoichs['10_16']
+
+        stoichs['11_3'] = -1.0 / (params['Y_H'] * params['n_G'])
+        stoichs['11_4'] = 0.0 - params['i_NBM']
+        stoichs['11_8'] = (1.0 - params['Y_H'] * params['n_G']) / ((8 / 7) * params['Y_H'] * params['n_G'])
+        stoichs['11_9'] = 0.0 - (1.0 - params['Y_H'] * params['n_G']) / ((8 / 7) * params['Y_H'] * params['n_G'])
+        stoichs['11_10'] = 0.0 - params['i_PBM']
+        stoichs['11_16'] = 1.0
+        stoichs['11_12'] = (-1 / 64) * stoichs['11_3'] + (1 / 14) * stoichs['11_4'] + (-1 / 14) * stoichs['11_8'] + (-1 / 14) * stoichs['11_9'] + (-1.5 / 31) * stoichs['11_10']
+        stoichs['11_22'] = params['i_TSSBM'] * stoichs['11_16']
+
+        stoichs['12_3'] = -1.0 / (params['Y_H'] * params['n_G'])
+        stoichs['12_4'] = 0.0 - params['i_NBM']
+        stoichs['12_7'] = (1.0 - params['Y_H'] * params['n_G']) / ((4 / 7) * params['Y_H'] * params['n_G'])
+        stoichs['12_8'] = 0.0 - (1.0 - params['Y_H'] * params['n_G']) / ((4 / 7) * params['Y_H'] * params['n_G'])
+        stoichs['12_10'] = 0.0 - params['i_PBM']
+        stoichs['12_16'] = 1.0
+        stoichs['12_12'] = (-1 / 64) * stoichs['12_3'] + (1 / 14) * stoichs['12_4'] + (-1 / 14) * stoichs['12_8'] + (-1.5 / 31) * stoichs['12_10']
+        stoichs['12_22'] = params['i_TSSBM'] * stoichs['12_16']
+
+        stoichs['13_3'] = -1.0 / (params['Y_H'] * params['n_G'])
+        stoichs['13_4'] = 0.0 - params['i_NBM']
+        stoichs['13_6'] = (1.0 - params['Y_H'] * params['n_G']) / ((4 / 7) * params['Y_H'] * params['n_G'])
+        stoichs['13_7'] = 0.0 - (1.0 - params['Y_H'] * params['n_G']) / ((4 / 7) * params['Y_H'] * params['n_G'])
+        stoichs['13_10'] = 0.0 - params['i_PBM']
+        stoichs['13_16'] = 1.0
+        stoichs['13_12'] = (-1 / 64) * stoichs['13_3'] + (1 / 14) * stoichs['13_4'] + (-1.5 / 31) * stoichs['13_10']
+        stoichs['13_22'] = params['i_TSSBM'] * stoichs['13_16']
+
+        stoichs['14_3'] = -1.0 / (params['Y_H'] * params['n_G'])
+        stoichs['14_4'] = 0.0 - params['i_NBM']
+        stoichs['14_6'] = 0.0 - (1.0 - params['Y_H'] * params['n_G']) / ((4 / 7) * params['Y_H'] * params['n_G'])
+        stoichs['14_10'] = 0.0 - params['i_PBM']
+        stoichs['14_13'] = (1.0 - params['Y_H'] * params['n_G']) / ((4 / 7) * params['Y_H'] * params['n_G'])
+        stoichs['14_16'] = 1.0
+        stoichs['14_12'] = (-1 / 64) * stoichs['14_3'] + (1 / 14) * stoichs['14_4'] + (-1.5 / 31) * stoichs['14_10']
+        stoichs['14_22'] = params['i_TSSBM'] * stoichs['14_16']
+
+        stoichs['15_2'] = -1.0
+        stoichs['15_3'] = 1.0
+        stoichs['15_4'] = params['i_NSF']
+        stoichs['15_10'] = params['i_PSF']
+        stoichs['15_12'] = (-1 / 64) * stoichs['15_3'] + (1 / 14) * stoichs['15_4'] + (-1.5 / 31) * stoichs['15_10']
+
+        stoichs['16_4'] = params['i_NBM'] - params['i_NXI'] * params['f_XI'] - (1.0 - params['f_XI']) * params['i_NXS']
+        stoichs['16_10'] = params['i_PBM'] - params['i_PXI'] * params['f_XI'] - (1.0 - params['f_XI']) * params['i_PXS']
+        stoichs['16_14'] = params['f_XI']
+        stoichs['16_15'] = 1.0 - params['f_XI']
+        stoichs['16_16'] = -1.0
+        stoichs['16_12'] = (1 / 14) * stoichs['16_4'] + (-1.5 / 31) * stoichs['16_10']
+        stoichs['16_22'] = params['i_TSSXI'] * stoichs['16_14'] + params['i_TSSXS'] * stoichs['16_15'] + params['i_TSSBM'] * stoichs['16_16']
+
+        stoichs['17_3'] = -1.0
+        stoichs['17_10'] = params['Y_PO4']
+        stoichs['17_18'] = 0.0 - params['Y_PO4']
+        stoichs['17_19'] = 1.0
+        stoichs['17_12'] = (-1 / 64) * stoichs['17_3'] + (-1.5 / 31) * stoichs['17_10'] + (-1 / 31) * stoichs['17_18']
+        stoichs['17_22'] = 3.23 * stoichs['17_18'] + 0.6 * stoichs['17_19']
+
+        stoichs['18_1'] = 0.0 - params['Y_PHA']
+        stoichs['18_10'] = -1.0
+        stoichs['18_18'] = 1.0
+        stoichs['18_19'] = 0.0 - params['Y_PHA']
+        stoichs['18_12'] = (-1.5 / 31) * stoichs['18_10'] + (-1 / 31) * stoichs['18_18']
+        stoichs['18_22'] = 3.23 * stoichs['18_18'] + 0.6 * stoichs['18_19']
+
+        stoichs['19_8'] = params['Y_PHA'] / (8 / 7)
+        stoichs['19_9'] = 0.0 - params['Y_PHA'] / (8 / 7)
+        stoichs['19_10'] = -1.0
+        stoichs['19_18'] = 1.0
+        stoichs['19_19'] = 0.0 - params['Y_PHA']
+        stoichs['19_12'] = (-1 / 14) * stoichs['19_8'] + (-1 / 14) * stoichs['19_9'] + (-1.5 / 31) * stoichs['19_10'] + (-1 / 31) * stoichs['19_18']
+        stoichs['19_22'] = 3.23 * stoichs['19_18'] + 0.6 * stoichs['19_19']
+
+        stoichs['20_7'] = params['Y_PHA'] / (4 / 7)
+        stoichs['20_8'] = 0.0 - params['Y_PHA'] / (4 / 7)
+        stoichs['20_10'] = -1.0
+        stoichs['20_18'] = 1.0
+        stoichs['20_19'] = 0.0 - params['Y_PHA']
+        stoichs['20_12'] = (-1 / 14) * stoichs['20_8'] + (-1.5 / 31) * stoichs['20_10'] + (-1 / 31) * stoichs['20_18']
+        stoichs['20_22'] = 3.23 * stoichs['20_18'] + 0.6 * stoichs['20_19']
+
+        stoichs['21_6'] = params['Y_PHA'] / (4 / 7)
+        stoichs['21_7'] = 0.0 - params['Y_PHA'] / (4 / 7)
+        stoichs['21_10'] = -1.0
+        stoichs['21_18'] = 1.0
+        stoichs['21_19'] = 0.0 - params['Y_PHA']
+        stoichs['21_12'] = (-1.5 / 31) * stoichs['21_10'] + (-1 / 31) * stoichs['21_18']
+        stoichs['21_22'] = 3.23 * stoichs['21_18'] + 0.6 * stoichs['21_19']
+
+        stoichs['22_6'] = 0.0 - params['Y_PHA'] / (4 / 7)
+        stoichs['22_10'] = -1.0
+        stoichs['22_13'] = params['Y_PHA'] / (4 / 7)
+        stoichs['22_18'] = 1.0
+        stoichs['22_19'] = 0.0 - params['Y_PHA']
+        stoichs['22_12'] = (-1.5 / 31) * stoichs['22_10'] + (-1 / 31) * stoichs['22_18']
+        stoichs['22_22'] = 3.23 * stoichs['22_18'] + 0.6 * stoichs['22_19']
+
+        stoichs['23_1'] = 1.0 - 1.0 / params['Y_PAO']
+        stoichs['23_4'] = 0.0 - params['i_NBM']
+        stoichs['23_10'] = 0.0 - params['i_PBM']
+        stoichs['23_17'] = 1.0
+        stoichs['23_19'] = -1.0 / params['Y_PAO']
+        stoichs['23_12'] = (1 / 14) * stoichs['23_4'] + (-1.5 / 31) * stoichs['23_10']
+        stoichs['23_22'] = params['i_TSSBM'] * stoichs['23_17'] + 0.6 * stoichs['23_19']
+
+        stoichs['24_4'] = 0.0 - params['i_NBM']
+        stoichs['24_8'] = (1.0 - params['Y_PAO'] * params['n_G']) / ((8 / 7) * params['Y_PAO'] * params['n_G'])
+        stoichs['24_9'] = 0.0 - (1.0 - params['Y_PAO'] * params['n_G']) / ((8 / 7) * params['Y_PAO'] * params['n_G'])
+        stoichs['24_10'] = 0.0 - params['i_PBM']
+        stoichs['24_17'] = 1.0
+        stoichs['24_19'] = -1.0 / params['Y_PAO']
+        stoichs['24_12'] = (1 / 14) * stoichs['24_4'] + (-1 / 14) * stoichs['24_8'] + (-1 / 14) * stoichs['24_9'] + (-1.5 / 31) * stoichs['24_10']
+        stoichs['24_22'] = params['i_TSSBM'] * stoichs['24_17'] + 0.6 * stoichs['24_19']
+
+        stoichs['25_4'] = 0.0 - params['i_NBM']
+        stoichs['25_7'] = (1.0 - params['Y_PAO'] * params['n_G']) / ((4 / 7) * params['Y_PAO'] * params['n_G'])
+        stoichs['25_8'] = 0.0 - (1.0 - params['Y_PAO'] * params['n_G']) / ((4 / 7) * params['Y_PAO'] * params['n_G'])
+        stoichs['25_10'] = 0.0 - params['i_PBM']
+        stoichs['25_17'] = 1.0
+        stoichs['25_19'] = -1.0 / params['Y_PAO']
+        stoichs['25_12'] = (1 / 14) * stoichs['25_4'] + (-1 / 14) * stoichs['25_8'] + (-1.5 / 31) * stoichs['25_10']
+        stoichs['25_22'] = params['i_TSSBM'] * stoichs['25_17'] + 0.6 * stoichs['25_19']
+
+        stoichs['26_4'] = 0.0 - params['i_NBM']
+        stoichs['26_6'] = (1.0 - params['Y_PAO'] * params['n_G']) / ((4 / 7) * params['Y_PAO'] * params['n_G'])
+        stoichs['26_7'] = 0.0 - (1.0 - params['Y_PAO'] * params['n_G']) / ((4 / 7) * params['Y_PAO'] * params['n_G'])
+        stoichs['26_10'] = 0.0 - params['i_PBM']
+        stoichs['26_17'] = 1.0
+        stoichs['26_19'] = -1.0 / params['Y_PAO']
+        stoichs['26_12'] = (1 / 14) * stoichs['26_4'] + (-1.5 / 31) * stoichs['26_10']
+        stoichs['26_22'] = params['i_TSSBM'] * stoichs['26_17'] + 0.6 * stoichs['26_19']
+
+        stoichs['27_4'] = 0.0 - params['i_NBM']
+        stoichs['27_6'] = 0.0 - (1.0 - params['Y_PAO'] * params['n_G']) / ((4 / 7) * params['Y_PAO'] * params['n_G'])
+        stoichs['27_10'] = 0.0 - params['i_PBM']
+        stoichs['27_13'] = (1.0 - params['Y_PAO'] * params['n_G']) / ((4 / 7) * params['Y_PAO'] * params['n_G'])
+        stoichs['27_17'] = 1.0
+        stoichs['27_19'] = -1.0 / params['Y_PAO']
+        stoichs['27_12'] = (1 / 14) * stoichs['27_4'] + (-1.5 / 31) * stoichs['27_10']
+        stoichs['27_22'] = params['i_TSSBM'] * stoichs['27_17'] + 0.6 * stoichs['27_19']
+
+        stoichs['28_4'] = params['i_NBM'] - params['i_NXI'] * params['f_XI'] - (1.0 - params['f_XI']) * params['i_NXS']
+        stoichs['28_10'] = params['i_PBM'] - params['i_PXI'] * params['f_XI'] - (1.0 - params['f_XI']) * params['i_PXS']
+        stoichs['28_14'] = params['f_XI']
+        stoichs['28_15'] = 1.0 - params['f_XI']
+        stoichs['28_17'] = -1.0
+        stoichs['28_12'] = (1 / 14) * stoichs['28_4'] + (-1.5 / 31) * stoichs['28_10']
+        stoichs['28_22'] = params['i_TSSXI'] * stoichs['28_14'] + params['i_TSSXS'] * stoichs['28_15'] + params['i_TSSBM'] * stoichs['28_17']
+
+        stoichs['29_10'] = 1.0
+        stoichs['29_18'] = -1.0
+        stoichs['29_12'] = (-1.5 / 31) * stoichs['29_10'] + (-1 / 31) * stoichs['29_18']
+        stoichs['29_22'] = 3.23 * stoichs['29_18']
+
+        stoichs['30_3'] = 1.0
+        stoichs['30_19'] = -1.0
+        stoichs['30_12'] = (-1 / 64) * stoichs['30_3']
+        stoichs['30_22'] = 0.6 * stoichs['30_19']
+
+        stoichs['31_1'] = -8 / 7
+        stoichs['31_4'] = -1.0
+        stoichs['31_5'] = 1.0
+        stoichs['31_12'] = (1 / 14) * stoichs['31_4']
+
+        stoichs['32_1'] = 0.0 - ((12 / 7) - params['Y_AOB']) / params['Y_AOB']
+        stoichs['32_4'] = 0.0 - params['i_NBM']
+        stoichs['32_5'] = -1.0 / params['Y_AOB']
+        stoichs['32_7'] = 1.0 / params['Y_AOB']
+        stoichs['32_10'] = 0.0 - params['i_PBM']
+        stoichs['32_20'] = 1.0
+        stoichs['32_12'] = (1 / 14) * stoichs['32_4'] + (-1.5 / 31) * stoichs['32_10']
+        stoichs['32_22'] = params['i_TSSBM'] * stoichs['32_20']
+
+        stoichs['33_1'] = -4 / 7
+        stoichs['33_7'] = -1.0
+        stoichs['33_8'] = 1.0
+        stoichs['33_12'] = (-1 / 14) * stoichs['33_8']
+
+        stoichs['34_5'] = -1.0
+        stoichs['34_6'] = 4.0
+        stoichs['34_7'] = -4.0
+        stoichs['34_8'] = 1.0
+        stoichs['34_12'] = (-1 / 14) * stoichs['34_8']
+
+        stoichs['35_5'] = -1.0
+        stoichs['35_6'] = 2.0
+        stoichs['35_8'] = -1.0
+        stoichs['35_12'] = (-1 / 14) * stoichs['35_8']
+
+        stoichs['36_1'] = 0.0 - ((8 / 7) - params['Y_NOB']) / params['Y_NOB']
+        stoichs['36_4'] = 0.0 - params['i_NBM']
+        stoichs['36_8'] = -1.0 / params['Y_NOB']
+        stoichs['36_9'] = 1.0 / params['Y_NOB']
+        stoichs['36_10'] = 0.0 - params['i_PBM']
+        stoichs['36_21'] = 1.0
+        stoichs['36_12'] = (1 / 14) * stoichs['36_4'] + (-1 / 14) * stoichs['36_8'] + (-1 / 14) * stoichs['36_9'] + (-1.5 / 31) * stoichs['36_10']
+        stoichs['36_22'] = params['i_TSSBM'] * stoichs['36_21']
+
+        stoichs['37_4'] = params['i_NBM'] - params['i_NXI'] * params['f_XI'] - (1.0 - params['f_XI']) * params['i_NXS']
+        stoichs['37_10'] = params['i_PBM'] - params['i_PXI'] * params['f_XI'] - (1.0 - params['f_XI']) * params['i_PXS']
+        stoichs['37_14'] = params['f_XI']
+        stoichs['37_15'] = 1.0 - params['f_XI']
+        stoichs['37_20'] = -1.0
+        stoichs['37_12'] = (1 / 14) * stoichs['37_4'] + (-1.5 / 31) * stoichs['37_10']
+        stoichs['37_22'] = params['i_TSSXI'] * stoichs['37_14'] + params['i_TSSXS'] * stoichs['37_15'] + params['i_TSSBM'] * stoichs['37_20']
         
-        self._stoichs['1_2'] = 1.0 - self._params['f_SI']
-        self._stoichs['1_4'] = self._params['i_NXS'] - (1.0 - self._params['f_SI']) * self._params['i_NSF']
-        self._stoichs['1_10'] = self._params['i_PXS'] - (1.0 - self._params['f_SI']) * self._params['i_PSF']
-        self._stoichs['1_11'] = self._params['f_SI']
-        self._stoichs['1_15'] = -1.0
-        self._stoichs['1_12'] = (1 / 14) * self._stoichs['1_4'] + (-1.5 / 31) * self._stoichs['1_10']
-        self._stoichs['1_22'] = self._params['i_TSSXS'] * self._stoichs['1_15']
-
-        self._stoichs['2_2'] = 1.0 - self._params['f_SI']
-        self._stoichs['2_4'] = self._params['i_NXS'] - (1.0 - self._params['f_SI']) * self._params['i_NSF']
-        self._stoichs['2_10'] = self._params['i_PXS'] - (1.0 - self._params['f_SI']) * self._params['i_PSF']
-        self._stoichs['2_11'] = self._params['f_SI']
-        self._stoichs['2_15'] = -1.0
-        self._stoichs['2_12'] = (1 / 14) * self._stoichs['2_4'] + (-1.5 / 31) * self._stoichs['2_10']
-        self._stoichs['2_22'] = self._params['i_TSSXS'] * self._stoichs['2_15']
-
-        self._stoichs['3_2'] = 1.0 - self._params['f_SI']
-        self._stoichs['3_4'] = self._params['i_NXS'] - (1.0 - self._params['f_SI']) * self._params['i_NSF']
-        self._stoichs['3_10'] = self._params['i_PXS'] - (1.0 - self._params['f_SI']) * self._params['i_PSF']
-        self._stoichs['3_11'] = self._params['f_SI']
-        self._stoichs['3_15'] = -1.0
-        self._stoichs['3_12'] = (1 / 14) * self._stoichs['3_4'] + (-1.5 / 31) * self._stoichs['3_10']
-        self._stoichs['3_22'] = self._params['i_TSSXS'] * self._stoichs['3_15']
-
-        self._stoichs['4_2'] = 1.0 - self._params['f_SI']
-        self._stoichs['4_4'] = self._params['i_NXS'] - (1.0 - self._params['f_SI']) * self._params['i_NSF']
-        self._stoichs['4_10'] = self._params['i_PXS'] - (1.0 - self._params['f_SI']) * self._params['i_PSF']
-        self._stoichs['4_11'] = self._params['f_SI']
-        self._stoichs['4_15'] = -1.0
-        self._stoichs['4_12'] = (1 / 14) * self._stoichs['4_4'] + (-1.5 / 31) * self._stoichs['4_10']
-        self._stoichs['4_22'] = self._params['i_TSSXS'] * self._stoichs['4_15']
-
-        self._stoichs['5_1'] = 1.0 - (1.0 / self._params['Y_H'])
-        self._stoichs['5_2'] = -1.0 / self._params['Y_H']
-        self._stoichs['5_4'] = self._params['i_NSF'] / self._params['Y_H'] - self._params['i_NBM']
-        self._stoichs['5_10'] = self._params['i_PSF'] / self._params['Y_H'] - self._params['i_PBM']
-        self._stoichs['5_16'] = 1.0
-        self._stoichs['5_12'] = (1 / 14) * self._stoichs['5_4'] + (-1.5 / 31) * self._stoichs['5_10']
-        self._stoichs['5_22'] = self._params['i_TSSBM'] * self._stoichs['5_16']
-
-        self._stoichs['6_1'] = 1.0 - (1.0 / self._params['Y_H'])
-        self._stoichs['6_3'] = -1.0 / self._params['Y_H']
-        self._stoichs['6_4'] = 0.0 - self._params['i_NBM']
-        self._stoichs['6_10'] = 0.0 - self._params['i_PBM']
-        self._stoichs['6_16'] = 1.0
-        self._stoichs['6_12'] = (-1 / 64) * self._stoichs['6_3'] + (1 / 14) * self._stoichs['6_4'] + (-1.5 / 31) * self._stoichs['6_10']
-        self._stoichs['6_22'] = self._params['i_TSSBM'] * self._stoichs['6_16']
-
-        self._stoichs['7_2'] = -1.0 / (self._params['Y_H'] * self._params['n_G'])
-        self._stoichs['7_4'] = self._params['i_NSF'] / self._params['Y_H'] - self._params['i_NBM']
-        self._stoichs['7_8'] = (1.0 - self._params['Y_H'] * self._params['n_G']) / ((8 / 7) * self._params['Y_H'] * self._params['n_G'])
-        self._stoichs['7_9'] = 0.0 - (1.0 - self._params['Y_H'] * self._params['n_G']) / ((8 / 7) * self._params['Y_H'] * self._params['n_G'])
-        self._stoichs['7_10'] = self._params['i_PSF'] / self._params['Y_H'] - self._params['i_PBM']
-        self._stoichs['7_16'] = 1.0
-        self._stoichs['7_12'] = (1 / 14) * self._stoichs['7_4'] + (-1 / 14) * self._stoichs['7_8'] + (-1 / 14) * self._stoichs['7_9'] + (-1.5 / 31) * self._stoichs['7_10']
-        self._stoichs['7_22'] = self._params['i_TSSBM'] * self._stoichs['7_16']
-
-        self._stoichs['8_2'] = -1.0 / (self._params['Y_H'] * self._params['n_G'])
-        self._stoichs['8_4'] = self._params['i_NSF'] / self._params['Y_H'] - self._params['i_NBM']
-        self._stoichs['8_7'] = (1.0 - self._params['Y_H'] * self._params['n_G']) / ((4 / 7) * self._params['Y_H'] * self._params['n_G'])
-        self._stoichs['8_8'] = 0.0 - (1.0 - self._params['Y_H'] * self._params['n_G']) / ((4 / 7) * self._params['Y_H'] * self._params['n_G'])
-        self._stoichs['8_10'] = self._params['i_PSF'] / self._params['Y_H'] - self._params['i_PBM']
-        self._stoichs['8_16'] = 1.0
-        self._stoichs['8_12'] = (1 / 14) * self._stoichs['8_4'] + (-1 / 14) * self._stoichs['8_8'] + (-1.5 / 31) * self._stoichs['8_10']
-        self._stoichs['8_22'] = self._params['i_TSSBM'] * self._stoichs['8_16']
-
-        self._stoichs['9_2'] = -1.0 / (self._params['Y_H'] * self._params['n_G'])
-        self._stoichs['9_4'] = self._params['i_NSF'] / self._params['Y_H'] - self._params['i_NBM']
-        self._stoichs['9_6'] = (1.0 - self._params['Y_H'] * self._params['n_G']) / ((4 / 7) * self._params['Y_H'] * self._params['n_G'])
-        self._stoichs['9_7'] = 0.0 - (1.0 - self._params['Y_H'] * self._params['n_G']) / ((4 / 7) * self._params['Y_H'] * self._params['n_G'])
-        self._stoichs['9_10'] = self._params['i_PSF'] / self._params['Y_H'] - self._params['i_PBM']
-        self._stoichs['9_16'] = 1.0
-        self._stoichs['9_12'] = (1 / 14) * self._stoichs['9_4']+ (-1.5 / 31) * self._stoichs['9_10']
-        self._stoichs['9_22'] = self._params['i_TSSBM'] * self._stoichs['9_16']
-
-        self._stoichs['10_2'] = -1.0 / (self._params['Y_H'] * self._params['n_G'])
-        self._stoichs['10_4'] = self._params['i_NSF'] / self._params['Y_H'] - self._params['i_NBM']
-        self._stoichs['10_6'] = 0.0 - (1.0 - self._params['Y_H'] * self._params['n_G']) / ((4 / 7) * self._params['Y_H'] * self._params['n_G'])
-        self._stoichs['10_10'] = self._params['i_PSF'] / self._params['Y_H'] - self._params['i_PBM']
-        self._stoichs['10_13'] = (1.0 - self._params['Y_H'] * self._params['n_G']) / ((4 / 7) * self._params['Y_H'] * self._params['n_G'])
-        self._stoichs['10_16'] = 1.0
-        self._stoichs['10_12'] = (1 / 14) * self._stoichs['10_4'] + (-1.5 / 31) * self._stoichs['10_10']
-        self._stoichs['10_22'] = self._params['i_TSSBM'] * self._stoichs['10_16']
-
-        self._stoichs['11_3'] = -1.0 / (self._params['Y_H'] * self._params['n_G'])
-        self._stoichs['11_4'] = 0.0 - self._params['i_NBM']
-        self._stoichs['11_8'] = (1.0 - self._params['Y_H'] * self._params['n_G']) / ((8 / 7) * self._params['Y_H'] * self._params['n_G'])
-        self._stoichs['11_9'] = 0.0 - (1.0 - self._params['Y_H'] * self._params['n_G']) / ((8 / 7) * self._params['Y_H'] * self._params['n_G'])
-        self._stoichs['11_10'] = 0.0 - self._params['i_PBM']
-        self._stoichs['11_16'] = 1.0
-        self._stoichs['11_12'] = (-1 / 64) * self._stoichs['11_3'] + (1 / 14) * self._stoichs['11_4'] + (-1 / 14) * self._stoichs['11_8'] + (-1 / 14) * self._stoichs['11_9'] + (-1.5 / 31) * self._stoichs['11_10']
-        self._stoichs['11_22'] = self._params['i_TSSBM'] * self._stoichs['11_16']
-
-        self._stoichs['12_3'] = -1.0 / (self._params['Y_H'] * self._params['n_G'])
-        self._stoichs['12_4'] = 0.0 - self._params['i_NBM']
-        self._stoichs['12_7'] = (1.0 - self._params['Y_H'] * self._params['n_G']) / ((4 / 7) * self._params['Y_H'] * self._params['n_G'])
-        self._stoichs['12_8'] = 0.0 - (1.0 - self._params['Y_H'] * self._params['n_G']) / ((4 / 7) * self._params['Y_H'] * self._params['n_G'])
-        self._stoichs['12_10'] = 0.0 - self._params['i_PBM']
-        self._stoichs['12_16'] = 1.0
-        self._stoichs['12_12'] = (-1 / 64) * self._stoichs['12_3'] + (1 / 14) * self._stoichs['12_4'] + (-1 / 14) * self._stoichs['12_8'] + (-1.5 / 31) * self._stoichs['12_10']
-        self._stoichs['12_22'] = self._params['i_TSSBM'] * self._stoichs['12_16']
-
-        self._stoichs['13_3'] = -1.0 / (self._params['Y_H'] * self._params['n_G'])
-        self._stoichs['13_4'] = 0.0 - self._params['i_NBM']
-        self._stoichs['13_6'] = (1.0 - self._params['Y_H'] * self._params['n_G']) / ((4 / 7) * self._params['Y_H'] * self._params['n_G'])
-        self._stoichs['13_7'] = 0.0 - (1.0 - self._params['Y_H'] * self._params['n_G']) / ((4 / 7) * self._params['Y_H'] * self._params['n_G'])
-        self._stoichs['13_10'] = 0.0 - self._params['i_PBM']
-        self._stoichs['13_16'] = 1.0
-        self._stoichs['13_12'] = (-1 / 64) * self._stoichs['13_3'] + (1 / 14) * self._stoichs['13_4'] + (-1.5 / 31) * self._stoichs['13_10']
-        self._stoichs['13_22'] = self._params['i_TSSBM'] * self._stoichs['13_16']
-
-        self._stoichs['14_3'] = -1.0 / (self._params['Y_H'] * self._params['n_G'])
-        self._stoichs['14_4'] = 0.0 - self._params['i_NBM']
-        self._stoichs['14_6'] = 0.0 - (1.0 - self._params['Y_H'] * self._params['n_G']) / ((4 / 7) * self._params['Y_H'] * self._params['n_G'])
-        self._stoichs['14_10'] = 0.0 - self._params['i_PBM']
-        self._stoichs['14_13'] = (1.0 - self._params['Y_H'] * self._params['n_G']) / ((4 / 7) * self._params['Y_H'] * self._params['n_G'])
-        self._stoichs['14_16'] = 1.0
-        self._stoichs['14_12'] = (-1 / 64) * self._stoichs['14_3'] + (1 / 14) * self._stoichs['14_4'] + (-1.5 / 31) * self._stoichs['14_10']
-        self._stoichs['14_22'] = self._params['i_TSSBM'] * self._stoichs['14_16']
-
-        self._stoichs['15_2'] = -1.0
-        self._stoichs['15_3'] = 1.0
-        self._stoichs['15_4'] = self._params['i_NSF']
-        self._stoichs['15_10'] = self._params['i_PSF']
-        self._stoichs['15_12'] = (-1 / 64) * self._stoichs['15_3'] + (1 / 14) * self._stoichs['15_4'] + (-1.5 / 31) * self._stoichs['15_10']
-
-        self._stoichs['16_4'] = self._params['i_NBM'] - self._params['i_NXI'] * self._params['f_XI'] - (1.0 - self._params['f_XI']) * self._params['i_NXS']
-        self._stoichs['16_10'] = self._params['i_PBM'] - self._params['i_PXI'] * self._params['f_XI'] - (1.0 - self._params['f_XI']) * self._params['i_PXS']
-        self._stoichs['16_14'] = self._params['f_XI']
-        self._stoichs['16_15'] = 1.0 - self._params['f_XI']
-        self._stoichs['16_16'] = -1.0
-        self._stoichs['16_12'] = (1 / 14) * self._stoichs['16_4'] + (-1.5 / 31) * self._stoichs['16_10']
-        self._stoichs['16_22'] = self._params['i_TSSXI'] * self._stoichs['16_14'] + self._params['i_TSSXS'] * self._stoichs['16_15'] + self._params['i_TSSBM'] * self._stoichs['16_16']
-
-        self._stoichs['17_3'] = -1.0
-        self._stoichs['17_10'] = self._params['Y_PO4']
-        self._stoichs['17_18'] = 0.0 - self._params['Y_PO4']
-        self._stoichs['17_19'] = 1.0
-        self._stoichs['17_12'] = (-1 / 64) * self._stoichs['17_3'] + (-1.5 / 31) * self._stoichs['17_10'] + (-1 / 31) * self._stoichs['17_18']
-        self._stoichs['17_22'] = 3.23 * self._stoichs['17_18'] + 0.6 * self._stoichs['17_19']
-
-        self._stoichs['18_1'] = 0.0 - self._params['Y_PHA']
-        self._stoichs['18_10'] = -1.0
-        self._stoichs['18_18'] = 1.0
-        self._stoichs['18_19'] = 0.0 - self._params['Y_PHA']
-        self._stoichs['18_12'] = (-1.5 / 31) * self._stoichs['18_10'] + (-1 / 31) * self._stoichs['18_18']
-        self._stoichs['18_22'] = 3.23 * self._stoichs['18_18'] + 0.6 * self._stoichs['18_19']
-
-        self._stoichs['19_8'] = self._params['Y_PHA'] / (8 / 7)
-        self._stoichs['19_9'] = 0.0 - self._params['Y_PHA'] / (8 / 7)
-        self._stoichs['19_10'] = -1.0
-        self._stoichs['19_18'] = 1.0
-        self._stoichs['19_19'] = 0.0 - self._params['Y_PHA']
-        self._stoichs['19_12'] = (-1 / 14) * self._stoichs['19_8'] + (-1 / 14) * self._stoichs['19_9'] + (-1.5 / 31) * self._stoichs['19_10'] + (-1 / 31) * self._stoichs['19_18']
-        self._stoichs['19_22'] = 3.23 * self._stoichs['19_18'] + 0.6 * self._stoichs['19_19']
-
-        self._stoichs['20_7'] = self._params['Y_PHA'] / (4 / 7)
-        self._stoichs['20_8'] = 0.0 - self._params['Y_PHA'] / (4 / 7)
-        self._stoichs['20_10'] = -1.0
-        self._stoichs['20_18'] = 1.0
-        self._stoichs['20_19'] = 0.0 - self._params['Y_PHA']
-        self._stoichs['20_12'] = (-1 / 14) * self._stoichs['20_8'] + (-1.5 / 31) * self._stoichs['20_10'] + (-1 / 31) * self._stoichs['20_18']
-        self._stoichs['20_22'] = 3.23 * self._stoichs['20_18'] + 0.6 * self._stoichs['20_19']
-
-        self._stoichs['21_6'] = self._params['Y_PHA'] / (4 / 7)
-        self._stoichs['21_7'] = 0.0 - self._params['Y_PHA'] / (4 / 7)
-        self._stoichs['21_10'] = -1.0
-        self._stoichs['21_18'] = 1.0
-        self._stoichs['21_19'] = 0.0 - self._params['Y_PHA']
-        self._stoichs['21_12'] = (-1.5 / 31) * self._stoichs['21_10'] + (-1 / 31) * self._stoichs['21_18']
-        self._stoichs['21_22'] = 3.23 * self._stoichs['21_18'] + 0.6 * self._stoichs['21_19']
-
-        self._stoichs['22_6'] = 0.0 - self._params['Y_PHA'] / (4 / 7)
-        self._stoichs['22_10'] = -1.0
-        self._stoichs['22_13'] = self._params['Y_PHA'] / (4 / 7)
-        self._stoichs['22_18'] = 1.0
-        self._stoichs['22_19'] = 0.0 - self._params['Y_PHA']
-        self._stoichs['22_12'] = (-1.5 / 31) * self._stoichs['22_10'] + (-1 / 31) * self._stoichs['22_18']
-        self._stoichs['22_22'] = 3.23 * self._stoichs['22_18'] + 0.6 * self._stoichs['22_19']
-
-        self._stoichs['23_1'] = 1.0 - 1.0 / self._params['Y_PAO']
-        self._stoichs['23_4'] = 0.0 - self._params['i_NBM']
-        self._stoichs['23_10'] = 0.0 - self._params['i_PBM']
-        self._stoichs['23_17'] = 1.0
-        self._stoichs['23_19'] = -1.0 / self._params['Y_PAO']
-        self._stoichs['23_12'] = (1 / 14) * self._stoichs['23_4'] + (-1.5 / 31) * self._stoichs['23_10']
-        self._stoichs['23_22'] = self._params['i_TSSBM'] * self._stoichs['23_17'] + 0.6 * self._stoichs['23_19']
-
-        self._stoichs['24_4'] = 0.0 - self._params['i_NBM']
-        self._stoichs['24_8'] = (1.0 - self._params['Y_PAO'] * self._params['n_G']) / ((8 / 7) * self._params['Y_PAO'] * self._params['n_G'])
-        self._stoichs['24_9'] = 0.0 - (1.0 - self._params['Y_PAO'] * self._params['n_G']) / ((8 / 7) * self._params['Y_PAO'] * self._params['n_G'])
-        self._stoichs['24_10'] = 0.0 - self._params['i_PBM']
-        self._stoichs['24_17'] = 1.0
-        self._stoichs['24_19'] = -1.0 / self._params['Y_PAO']
-        self._stoichs['24_12'] = (1 / 14) * self._stoichs['24_4'] + (-1 / 14) * self._stoichs['24_8'] + (-1 / 14) * self._stoichs['24_9'] + (-1.5 / 31) * self._stoichs['24_10']
-        self._stoichs['24_22'] = self._params['i_TSSBM'] * self._stoichs['24_17'] + 0.6 * self._stoichs['24_19']
-
-        self._stoichs['25_4'] = 0.0 - self._params['i_NBM']
-        self._stoichs['25_7'] = (1.0 - self._params['Y_PAO'] * self._params['n_G']) / ((4 / 7) * self._params['Y_PAO'] * self._params['n_G'])
-        self._stoichs['25_8'] = 0.0 - (1.0 - self._params['Y_PAO'] * self._params['n_G']) / ((4 / 7) * self._params['Y_PAO'] * self._params['n_G'])
-        self._stoichs['25_10'] = 0.0 - self._params['i_PBM']
-        self._stoichs['25_17'] = 1.0
-        self._stoichs['25_19'] = -1.0 / self._params['Y_PAO']
-        self._stoichs['25_12'] = (1 / 14) * self._stoichs['25_4'] + (-1 / 14) * self._stoichs['25_8'] + (-1.5 / 31) * self._stoichs['25_10']
-        self._stoichs['25_22'] = self._params['i_TSSBM'] * self._stoichs['25_17'] + 0.6 * self._stoichs['25_19']
-
-        self._stoichs['26_4'] = 0.0 - self._params['i_NBM']
-        self._stoichs['26_6'] = (1.0 - self._params['Y_PAO'] * self._params['n_G']) / ((4 / 7) * self._params['Y_PAO'] * self._params['n_G'])
-        self._stoichs['26_7'] = 0.0 - (1.0 - self._params['Y_PAO'] * self._params['n_G']) / ((4 / 7) * self._params['Y_PAO'] * self._params['n_G'])
-        self._stoichs['26_10'] = 0.0 - self._params['i_PBM']
-        self._stoichs['26_17'] = 1.0
-        self._stoichs['26_19'] = -1.0 / self._params['Y_PAO']
-        self._stoichs['26_12'] = (1 / 14) * self._stoichs['26_4'] + (-1.5 / 31) * self._stoichs['26_10']
-        self._stoichs['26_22'] = self._params['i_TSSBM'] * self._stoichs['26_17'] + 0.6 * self._stoichs['26_19']
-
-        self._stoichs['27_4'] = 0.0 - self._params['i_NBM']
-        self._stoichs['27_6'] = 0.0 - (1.0 - self._params['Y_PAO'] * self._params['n_G']) / ((4 / 7) * self._params['Y_PAO'] * self._params['n_G'])
-        self._stoichs['27_10'] = 0.0 - self._params['i_PBM']
-        self._stoichs['27_13'] = (1.0 - self._params['Y_PAO'] * self._params['n_G']) / ((4 / 7) * self._params['Y_PAO'] * self._params['n_G'])
-        self._stoichs['27_17'] = 1.0
-        self._stoichs['27_19'] = -1.0 / self._params['Y_PAO']
-        self._stoichs['27_12'] = (1 / 14) * self._stoichs['27_4'] + (-1.5 / 31) * self._stoichs['27_10']
-        self._stoichs['27_22'] = self._params['i_TSSBM'] * self._stoichs['27_17'] + 0.6 * self._stoichs['27_19']
-
-        self._stoichs['28_4'] = self._params['i_NBM'] - self._params['i_NXI'] * self._params['f_XI'] - (1.0 - self._params['f_XI']) * self._params['i_NXS']
-        self._stoichs['28_10'] = self._params['i_PBM'] - self._params['i_PXI'] * self._params['f_XI'] - (1.0 - self._params['f_XI']) * self._params['i_PXS']
-        self._stoichs['28_14'] = self._params['f_XI']
-        self._stoichs['28_15'] = 1.0 - self._params['f_XI']
-        self._stoichs['28_17'] = -1.0
-        self._stoichs['28_12'] = (1 / 14) * self._stoichs['28_4'] + (-1.5 / 31) * self._stoichs['28_10']
-        self._stoichs['28_22'] = self._params['i_TSSXI'] * self._stoichs['28_14'] + self._params['i_TSSXS'] * self._stoichs['28_15'] + self._params['i_TSSBM'] * self._stoichs['28_17']
-
-        self._stoichs['29_10'] = 1.0
-        self._stoichs['29_18'] = -1.0
-        self._stoichs['29_12'] = (-1.5 / 31) * self._stoichs['29_10'] + (-1 / 31) * self._stoichs['29_18']
-        self._stoichs['29_22'] = 3.23 * self._stoichs['29_18']
-
-        self._stoichs['30_3'] = 1.0
-        self._stoichs['30_19'] = -1.0
-        self._stoichs['30_12'] = (-1 / 64) * self._stoichs['30_3']
-        self._stoichs['30_22'] = 0.6 * self._stoichs['30_19']
-
-        self._stoichs['31_1'] = -8 / 7
-        self._stoichs['31_4'] = -1.0
-        self._stoichs['31_5'] = 1.0
-        self._stoichs['31_12'] = (1 / 14) * self._stoichs['31_4']
-
-        self._stoichs['32_1'] = 0.0 - ((12 / 7) - self._params['Y_AOB']) / self._params['Y_AOB']
-        self._stoichs['32_4'] = 0.0 - self._params['i_NBM']
-        self._stoichs['32_5'] = -1.0 / self._params['Y_AOB']
-        self._stoichs['32_7'] = 1.0 / self._params['Y_AOB']
-        self._stoichs['32_10'] = 0.0 - self._params['i_PBM']
-        self._stoichs['32_20'] = 1.0
-        self._stoichs['32_12'] = (1 / 14) * self._stoichs['32_4'] + (-1.5 / 31) * self._stoichs['32_10']
-        self._stoichs['32_22'] = self._params['i_TSSBM'] * self._stoichs['32_20']
-
-        self._stoichs['33_1'] = -4 / 7
-        self._stoichs['33_7'] = -1.0
-        self._stoichs['33_8'] = 1.0
-        self._stoichs['33_12'] = (-1 / 14) * self._stoichs['33_8']
-
-        self._stoichs['34_5'] = -1.0
-        self._stoichs['34_6'] = 4.0
-        self._stoichs['34_7'] = -4.0
-        self._stoichs['34_8'] = 1.0
-        self._stoichs['34_12'] = (-1 / 14) * self._stoichs['34_8']
-
-        self._stoichs['35_5'] = -1.0
-        self._stoichs['35_6'] = 2.0
-        self._stoichs['35_8'] = -1.0
-        self._stoichs['35_12'] = (-1 / 14) * self._stoichs['35_8']
-
-        self._stoichs['36_1'] = 0.0 - ((8 / 7) - self._params['Y_NOB']) / self._params['Y_NOB']
-        self._stoichs['36_4'] = 0.0 - self._params['i_NBM']
-        self._stoichs['36_8'] = -1.0 / self._params['Y_NOB']
-        self._stoichs['36_9'] = 1.0 / self._params['Y_NOB']
-        self._stoichs['36_10'] = 0.0 - self._params['i_PBM']
-        self._stoichs['36_21'] = 1.0
-        self._stoichs['36_12'] = (1 / 14) * self._stoichs['36_4'] + (-1 / 14) * self._stoichs['36_8'] + (-1 / 14) * self._stoichs['36_9'] + (-1.5 / 31) * self._stoichs['36_10']
-        self._stoichs['36_22'] = self._params['i_TSSBM'] * self._stoichs['36_21']
-
-        self._stoichs['37_4'] = self._params['i_NBM'] - self._params['i_NXI'] * self._params['f_XI'] - (1.0 - self._params['f_XI']) * self._params['i_NXS']
-        self._stoichs['37_10'] = self._params['i_PBM'] - self._params['i_PXI'] * self._params['f_XI'] - (1.0 - self._params['f_XI']) * self._params['i_PXS']
-        self._stoichs['37_14'] = self._params['f_XI']
-        self._stoichs['37_15'] = 1.0 - self._params['f_XI']
-        self._stoichs['37_20'] = -1.0
-        self._stoichs['37_12'] = (1 / 14) * self._stoichs['37_4'] + (-1.5 / 31) * self._stoichs['37_10']
-        self._stoichs['37_22'] = self._params['i_TSSXI'] * self._stoichs['37_14'] + self._params['i_TSSXS'] * self._stoichs['37_15'] + self._params['i_TSSBM'] * self._stoichs['37_20']
-        
-        self._stoichs['38_4'] = self._params['i_NBM'] - self._params['i_NXI'] * self._params['f_XI'] - (1.0 - self._params['f_XI']) * self._params['i_NXS']
-        self._stoichs['38_10'] = self._params['i_PBM'] - self._params['i_PXI'] * self._params['f_XI'] - (1.0 - self._params['f_XI']) * self._params['i_PXS']
-        self._stoichs['38_14'] = self._params['f_XI']
-        self._stoichs['38_15'] = 1.0 - self._params['f_XI']
-        self._stoichs['38_21'] = -1.0
-        self._stoichs['38_12'] = (1 / 14) * self._stoichs['38_4'] + (-1.5 / 31) * self._stoichs['38_10']
-        self._stoichs['38_22'] = self._params['i_TSSXI'] * self._stoichs['38_14'] + self._params['i_TSSXS'] * self._stoichs['38_15'] + self._params['i_TSSBM'] * self._stoichs['38_21']
-
-        self._stoichs['39_10'] = -1.0
-        self._stoichs['39_23'] = -3.45
-        self._stoichs['39_24'] = 4.87
-        self._stoichs['39_12'] = (-1.5 / 31) * self._stoichs['39_10']
-        self._stoichs['39_22'] = 1.0 * self._stoichs['39_23'] + 1.0 * self._stoichs['39_24']
-
-        self._stoichs['40_10'] = 1.0
-        self._stoichs['40_23'] = 3.45
-        self._stoichs['40_24'] = -4.87
-        self._stoichs['40_12'] = (-1.5 / 31) * self._stoichs['40_10']
-        self._stoichs['40_22'] = 1.0 * self._stoichs['40_23'] + 1.0 * self._stoichs['40_24']
+        stoichs['38_4'] = params['i_NBM'] - params['i_NXI'] * params['f_XI'] - (1.0 - params['f_XI']) * params['i_NXS']
+        stoichs['38_10'] = params['i_PBM'] - params['i_PXI'] * params['f_XI'] - (1.0 - params['f_XI']) * params['i_PXS']
+        stoichs['38_14'] = params['f_XI']
+        stoichs['38_15'] = 1.0 - params['f_XI']
+        stoichs['38_21'] = -1.0
+        stoichs['38_12'] = (1 / 14) * stoichs['38_4'] + (-1.5 / 31) * stoichs['38_10']
+        stoichs['38_22'] = params['i_TSSXI'] * stoichs['38_14'] + params['i_TSSXS'] * stoichs['38_15'] + params['i_TSSBM'] * stoichs['38_21']
+
+        stoichs['39_10'] = -1.0
+        stoichs['39_23'] = -3.45
+        stoichs['39_24'] = 4.87
+        stoichs['39_12'] = (-1.5 / 31) * stoichs['39_10']
+        stoichs['39_22'] = 1.0 * stoichs['39_23'] + 1.0 * stoichs['39_24']
+
+        stoichs['40_10'] = 1.0
+        stoichs['40_23'] = 3.45
+        stoichs['40_24'] = -4.87
+        stoichs['40_12'] = (-1.5 / 31) * stoichs['40_10']
+        stoichs['40_22'] = 1.0 * stoichs['40_23'] + 1.0 * stoichs['40_24']
+
+        return stoichs
+    
+    def __getstate__(self):
+        # the generated kernels are rebuilt (from the disk cache) when unpickled
+        state = self.__dict__.copy()
+        del state['_kernel']
+        del state['_fast_kernel']
+        # memoryviews cannot be pickled; the view is taken again on the copied buffer
+        del state['_comps_view']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._comps_view = memoryview(self._comps_arr)
+        self._load_kernels()
+
+    def _load_kernels(self):
+        '''
+        Load the generated kinetic functions of the model tables.
+
+        _kernel holds the plain Python functions, which the batched methods
+        apply to NumPy columns of many states. _fast_kernel evaluates one
+        state at a time: the numba-compiled functions with the 'numba'
+        backend (machine code cached next to the kernel source, so later
+        processes skip compilation), otherwise _kernel itself.
+
+        '''
+        args = (COMP_NAMES, self._param_names, _AUX_TERMS, _MONOD_TERMS, _RATE_EXPRS, list(self._stoichs))
+        self._kernel = load_kernel(*args)
+        self._fast_kernel = load_kernel(*args, use_numba=True) if self._backend == 'numba' else self._kernel
 
         return None
-    
+
+    def get_backend(self):
+        '''
+        Return the kinetic backend in use, 'numba' or 'python'.
+
+        '''
+        return 'numba' if self._fast_kernel.compiled else 'python'
+
+    def _stoich_entries(self):
+        '''
+        Return the stoichiometric entries of _stoich_mat in the order of _stoichs, as an array.
+
+        '''
+        # _stoich_mat is replaced, never modified in place, when the stoichiometry changes
+        if self._stoich_flat[0] is not self._stoich_mat:
+            self._stoich_flat = (self._stoich_mat, self._stoich_mat[self._stoich_pos])
+
+        return self._stoich_flat[1]
+
+    def update(self, ww_temp, DO):
+        '''
+        Update the model with new water temperature and dissolved O2.
+
+        Args:
+            ww_temp:    wastewater temperature, degC;
+            DO:         dissolved oxygen, mg/L
+
+        Return:
+            None
+
+        '''
+        asm_model.update(self, ww_temp, DO)
+        self._set_fna_factor()
+
+        return None
+
+    def set_stripping(self, enable=True, ratios=None, sat_comps=None):
+        '''
+        Strip N2O, NO and N2 wherever oxygen is transferred.
+
+        Each gas leaves at ratio * KLa * (C - C_sat), with KLa that of oxygen
+        (the model KLa here, 0 when the bulk DO is 0; the tank or phase KLa in
+        flowsheets and SBR cycles). Stripping is off until this is called.
+
+        Args:
+            enable:     whether the gases are stripped;
+            ratios:     dict of gas (STRIPPED_GASES) to its KLa per unit oxygen KLa; gases left out
+                        get sqrt(D_gas / D_O2) from GAS_DIFFUSIVITY;
+            sat_comps:  dict of gas to its concentration in equilibrium with the gas phase, mg/L
+                        (default 0: N2O and NO in air are negligible, and S_N2 only counts the N2
+                        produced by denitrification)
+
+        Return:
+            None
+
+        '''
+        ratios = {} if ratios is None else ratios
+        sat_comps = {} if sat_comps is None else sat_comps
+        for gas in list(ratios) + list(sat_comps):
+            if gas not in STRIPPED_GASES:
+                raise ValueError('{} is not one of the stripped gases {}'.format(gas, STRIPPED_GASES))
+
+        strip_ratio = np.zeros(len(STRIPPED_GASES))
+        if enable:
+            for i, gas in enumerate(STRIPPED_GASES):
+                strip_ratio[i] = ratios.get(gas, math.sqrt(GAS_DIFFUSIVITY[gas] / GAS_DIFFUSIVITY['S_O2']))
+        strip_sat = np.array([sat_comps.get(gas, 0.0) for gas in STRIPPED_GASES], dtype=float)
+        if np.any(strip_ratio < 0) or np.any(strip_sat < 0):
+            raise ValueError('KLa ratios and saturation concentrations must not be negative')
+
+        self._strip_ratio = strip_ratio
+        self._strip_sat = strip_sat
+
+        return None
+
+    def stripping_rates(self, comps, KLa=None):
+        '''
+        Transfer rates of the stripped gases to the gas phase, in the order of STRIPPED_GASES.
+
+        Args:
+            comps:  concentrations, mg/L, shape (..., 24);
+            KLa:    oxygen KLa, 1/d, broadcastable against the leading shape of comps
+                    (default: the model KLa, 0 when the bulk DO is 0)
+
+        Return:
+            numpy.ndarray of shape (..., 3), mg/L/d
+
+        '''
+        if KLa is None:
+            KLa = self._aeration_KLa()
+        comps = np.asarray(comps)
+
+        return (np.asarray(KLa)[..., None] * self._strip_ratio) * (comps[..., self._strip_idx] - self._strip_sat)
+
+    def _aeration_KLa(self, t=None):
+        '''
+        Oxygen KLa of the single reactor at the current DO, or at the DO forcing of time t
+        without applying it, 1/d (0 when not aerated).
+
+        '''
+        DO = self._bulk_DO
+        if t is not None and self._DO_forcing is not None:
+            DO = float(self._DO_forcing(t))
+
+        return 0.0 if DO == 0 else self._KLa
+
+    def set_pH(self, pH):
+        '''
+        Set the mixed liquor pH used for the free nitrous acid (HNO2) equilibrium.
+
+        Args:
+            pH:     a fixed value, a callable of time (days), or a (times, values)
+                    pair that is interpolated linearly
+
+        Return:
+            None
+
+        '''
+        if callable(pH) or not np.isscalar(pH):
+            self._pH_forcing = self._as_forcing(pH)
+        else:
+            self._pH_forcing = None
+            self._pH = float(pH)
+            self._set_fna_factor()
+
+        return None
+
+    def get_pH(self):
+        '''
+        Return the current mixed liquor pH.
+
+        '''
+        return self._pH
+
+    def _set_temperature(self, ww_temp):
+        '''
+        Move the kinetic parameters and the HNO2 equilibrium to a new temperature.
+
+        '''
+        if ww_temp != self._temperature:
+            asm_model._set_temperature(self, ww_temp)
+            self._set_fna_factor()
+
+        return None
+
+    def _apply_forcing(self, t):
+        '''
+        Evaluate the temperature, DO and pH forcing functions at time t (days).
+
+        '''
+        asm_model._apply_forcing(self, t)
+
+        if self._pH_forcing is not None:
+            pH = float(self._pH_forcing(t))
+            if pH != self._pH:
+                self._pH = pH
+                self._set_fna_factor()
+
+        return None
+
+    def _set_fna_factor(self):
+        '''
+        Cache the HNO2 equilibrium factor for the current temperature and pH.
+
+        '''
+        self._fna_factor = self._fna_equilibrium(self._temperature, self._pH)
+
+        return None
+
+    @staticmethod
+    def _fna_equilibrium(temp, pH):
+        '''
+        Free nitrous acid per unit nitrite nitrogen, mgHNO2/mgN.
+
+        Args:
+            temp (float): Temperature (degC).
+            pH (float or numpy.ndarray): pH value(s).
+
+        Return:
+            float or numpy.ndarray
+        '''
+        Ka = math.exp(-2300 / (273.15 + temp))
+
+        return (47 / 14) / (Ka * 10.0**pH + 1)
+
     def _reaction_rate(self, comps):
         '''
         Calculate the reaction rate for each biological process.
@@ -636,122 +999,101 @@ class ASM2d_N2O(asm_model):
             comps (list): A list of current model components (concentrations).
 
         Return:
-            self._rate_res (list): A list of reaction rates for each biological process.
-        '''
-
-        ## Use some Monod terms for simplification
-        self._monods[0] = self._monod(comps[0], self._params['K_O2_H'])
-        self._monods[1] = self._monod((comps[14] / comps[15]), self._params['K_X_H'])
-        self._monods[2] = self._monod(self._params['K_O2_H'], comps[0])
-        self._monods[3] = self._monod(comps[8], self._params['K_NO3_H'])
-        self._monods[4] = self._monod(comps[7], self._params['K_NO2_H'])
-        self._monods[5] = self._monod(self._params['K_NO2_H'], (comps[7] + comps[8]))
-        self._monods[6] = self._monod(comps[1], self._params['K_F'])
-        self._monods[7] = self._monod(comps[1], comps[2])
-        self._monods[8] = self._monod(comps[0], self._params['K_O2'])
-        self._monods[9] = self._monod(comps[3], self._params['K_NH4'])
-        self._monods[10] = self._monod(comps[9], self._params['K_P'])
-        self._monods[11] = self._monod(comps[11], self._params['K_ALK'])
-        self._monods[12] = self._monod(comps[2], self._params['K_A'])
-        self._monods[13] = self._monod(comps[2], comps[1])
-        self._monods[14] = self._monod(self._params['K_O2'], comps[0])
-        self._monods[15] = self._monod(comps[1], self._params['K_S3'])
-        self._monods[16] = self._monod(comps[7], self._params['K_NO2_Den'])
-        self._monods[17] = self._monod(self._params['K_OH3'], comps[0])
-        self._monods[18] = self._monod(comps[1], self._params['K_S4'])
-        self._monods[19] = self._monod(comps[6], (self._params['K_NO_Den'] + (comps[6])**2 / self._params['K_I4NO']))
-        self._monods[20] = self._monod(self._params['K_OH4'], comps[0])
-        self._monods[21] = self._monod(comps[1], self._params['K_S5'])
-        self._monods[22] = self._monod(comps[5], self._params['K_N2O_Den'])
-        self._monods[23] = self._monod(self._params['K_OH5'], comps[0])
-        self._monods[24] = self._monod(comps[2], self._params['K_S3'])
-        self._monods[25] = self._monod(comps[2], self._params['K_S4'])
-        self._monods[26] = self._monod(comps[2], self._params['K_S5'])
-        self._monods[27] = self._monod(self._params['K_NO2'], (comps[7] + comps[8]))
-        self._monods[28] = self._monod(comps[1], self._params['K_fe_H'])
-        self._monods[29] = self._monod(comps[2], self._params['K_A_P'])
-        self._monods[30] = self._monod(comps[11], self._params['K_ALK_P'])
-        self._monods[31] = self._monod((comps[17] / comps[16]), self._params['K_PP_P'])
-        self._monods[32] = self._monod(comps[0], self._params['K_O2_P'])
-        self._monods[33] = self._monod(comps[9], self._params['K_P_P'])
-        self._monods[34] = self._monod((comps[18] / comps[16]), self._params['K_PHA_P'])
-        self._monods[35] = self._monod((self._params['K_MAX_P'] - (comps[17] / comps[16])), self._params['K_IPP_P'])
-        self._monods[36] = self._monod(comps[8], self._params['K_NO3_P'])
-        self._monods[37] = self._monod(self._params['K_O2_P'], comps[0])
-        self._monods[38] = self._monod(comps[0], self._params['K_O2_AOB1'])
-        self._monods[39] = self._monod(comps[3], self._params['K_NH4_AOB'])
-        self._monods[40] = self._monod(comps[0], self._params['K_O2_AOB2'])
-        self._monods[41] = self._monod(comps[4], self._params['K_NH2OH_AOB'])
-        self._monods[42] = self._monod(comps[9], self._params['K_P_AOB'])
-        self._monods[43] = self._monod(comps[11], self._params['K_ALK_AOB'])
-        self._monods[44] = self._monod(comps[6], self._params['K_NO_AOB_HAO'])
-        self._monods[45] = self._monod(comps[6], self._params['K_NO_AOB_NN'])
-        
-        # Calculate concentrations of HNO2
-        temp = 20
-        pH = 7
-        Ka = math.exp(-2300 / (273.15 + temp))
-        S_HNO2 = (comps[7] / (Ka * 10**pH + 1)) * (47 / 14)
-        self._monods[46] = self._monod(S_HNO2, self._params['K_HNO2_AOB'])
-
-        self._monods[47] = self._monod(comps[0], self._params['K_O2_NOB'])
-        self._monods[48] = self._monod(comps[7], self._params['K_NO2_NOB'])
-        self._monods[49] = self._monod(comps[9], self._params['K_P_NOB'])
-        self._monods[50] = self._monod(comps[11], self._params['K_ALK_NOB'])
-        self._monods[51] = self._monod(comps[11], self._params['K_ALK_PR'])
-
-        # Omitted monod terms earlier
-        self._monods[52] = self._monod(comps[8], self._params['K_NO3'])
-        self._monods[53] = self._monod(comps[3], 10e-12)
-
-        ## Calculate reaction rates
-        self._rate_res[0] = self._params['K_H'] * self._monods[0] * self._monods[1] * comps[15]
-        self._rate_res[1] = self._params['K_H'] * self._params['n_NO3_H'] * self._monods[2] * self._monods[3] * self._monods[1] * comps[15]
-        self._rate_res[2] = self._params['K_H'] * self._params['n_NO2_H'] * self._monods[2] * self._monods[4] * self._monods[1] * comps[15]
-        self._rate_res[3] = self._params['K_H'] * self._params['n_fe_H'] * self._monods[2] * self._monods[5] * self._monods[1] * comps[15]
-        self._rate_res[4] = self._params['mu_H'] * self._monods[6] * self._monods[7] * self._monods[8] * self._monods[9] * self._monods[10] * self._monods[11] * comps[15]
-        self._rate_res[5] = self._params['mu_H'] * self._monods[12] * self._monods[13] * self._monods[8] * self._monods[9] * self._monods[10] * self._monods[11] * comps[15]
-        self._rate_res[6] = self._params['mu_H'] * self._params['n_NO3_D'] * self._monods[6] * self._monods[7] * self._monods[14] * self._monods[52] * self._monods[9] * self._monods[10] * self._monods[11] * comps[15]
-        self._rate_res[7] = self._params['mu_H'] * self._params['n_G3'] * self._monods[15] * self._monods[7] * self._monods[16] * self._monods[17] * self._monods[9] * self._monods[10] * self._monods[11] * comps[15]
-        self._rate_res[8] = self._params['mu_H'] * self._params['n_G4'] * self._monods[18] * self._monods[7] * self._monods[19] * self._monods[20] * self._monods[9] * self._monods[10] * self._monods[11] * comps[15]
-        self._rate_res[9] = self._params['mu_H'] * self._params['n_G5'] * self._monods[21] * self._monods[7] * self._monods[22] * self._monods[23] * self._monods[9] * self._monods[10] * self._monods[11] * comps[15]
-        self._rate_res[10] = self._params['mu_H'] * self._params['n_NO3_D'] * self._monods[12] * self._monods[13] * self._monods[14] * self._monods[52] * self._monods[9] * self._monods[10] * self._monods[11] * comps[15]
-        self._rate_res[11] = self._params['mu_H'] * self._params['n_G3'] * self._monods[24] * self._monods[13] * self._monods[16] * self._monods[17] * self._monods[9] * self._monods[10] * self._monods[11] * comps[15]
-        self._rate_res[12] = self._params['mu_H'] * self._params['n_G4'] * self._monods[25] * self._monods[13] * self._monods[19] * self._monods[20] * self._monods[9] * self._monods[10] * self._monods[11] * comps[15]
-        self._rate_res[13] = self._params['mu_H'] * self._params['n_G5'] * self._monods[26] * self._monods[13] * self._monods[22] * self._monods[23] * self._monods[9] * self._monods[10] * self._monods[11] * comps[15]
-        self._rate_res[14] = self._params['q_fe'] * self._monods[14] * self._monods[27] * self._monod[28] * self._monods[11] * comps[15]
-        self._rate_res[15] = self._params['b_H'] * comps[15]
-        self._rate_res[16] = self._params['q_PHA'] * self._monods[29] * self._monods[30] * self._monods[31] * comps[16]
-        self._rate_res[17] = self._params['q_PP'] * self._monods[32] * self._monods[33] * self._monods[30] * self._monods[34] * self._monods[35] * comps[16]
-        self._rate_res[18] = self._params['q_PP'] * self._params['n_NO3_P'] * self._monods[36] * self._monods[37] * self._monods[33] * self._monods[30] * self._monods[34] * self._monods[35] * comps[16]
-        self._rate_res[19] = self._params['q_PP'] * self._params['n_G3'] * self._monods[16] * self._monods[17] * self._monods[33] * self._monods[30] * self._monods[34] * self._monods[35] * comps[16]
-        self._rate_res[20] = self._params['q_PP'] * self._params['n_G4'] * self._monods[19] * self._monods[20] * self._monods[33] * self._monods[30] * self._monods[34] * self._monods[35] * comps[16]
-        self._rate_res[21] = self._params['q_PP'] * self._params['n_G5'] * self._monods[22] * self._monods[23] * self._monods[33] * self._monods[30] * self._monods[34] * self._monods[35] * comps[16]
-        self._rate_res[22] = self._params['mu_PAO'] * self._monods[32] * self._monods[33] * self._monods[9] * self._monods[30] * self._monods[34] * comps[16]
-        self._rate_res[23] = self._params['mu_PAO'] * self._params['n_NO3_P'] * self._monods[36] * self._monods[37] * self._monods[33] * self._monods[9] * self._monods[30] * self._monods[34] * comps[16]
-        self._rate_res[24] = self._params['mu_PAO'] * self._params['n_G3'] * self._monods[16] * self._monods[17] * self._monods[33] * self._monods[9] * self._monods[30] * self._monods[34] * comps[16]
-        self._rate_res[25] = self._params['mu_PAO'] * self._params['n_G4'] * self._monods[19] * self._monods[20] * self._monods[33] * self._monods[9] * self._monods[30] * self._monods[34] * comps[16]
-        self._rate_res[26] = self._params['mu_PAO'] * self._params['n_G5'] * self._monods[22] * self._monods[23] * self._monods[33] * self._monods[9] * self._monods[30] * self._monods[34] * comps[16]
-        self._rate_res[27] = self._params['b_PAO'] * self._monods[30] * comps[16]
-        self._rate_res[28] = self._params['b_PP'] * self._monods[30] * comps[17]
-        self._rate_res[29] = self._params['b_PHA'] * self._monods[30] * comps[18]
-        self._rate_res[30] = self._params['q_AOB_AMO'] * self._monods[38] * self._monods[39] * comps[19]
-        self._rate_res[31] = self._params['mu_AOB_HAO'] * self._monods[40] * self._monods[41] * self._monods[53] * self._monods[42] * self._monods[43] * comps[19]
-        self._rate_res[32] = self._params['q_AOB_HAO'] * self._monods[40] * self._monods[44] * comps[19]
-        self._rate_res[33] = self._params['q_AOB_N2O_NN'] * self._monods[41] * self._monods[45] * comps[19]
-
-        # Calculate concentrations of HNO2
-        fSO2 = comps[0] / (self._params['K_O2_AOB_ND'] + (1.0 - 2.0 * (self._params['K_O2_AOB_ND'] / self._params['K_I_O2_AOB']) ** (1 / 2)) * comps[0] + ((comps[0] ** 2) / self._params['K_I_O2_AOB']))
-        self._rate_res[34] = self._params['q_AOB_N2O_ND'] * self._monods[41] * self._monods[46] * fSO2 * comps[19]
-
-        self._rate_res[35] = self._params['mu_NOB'] * self._monods[47] * self._monods[48] * self._monods[49] * self._monods[50] * comps[20]
-        self._rate_res[36] = self._params['b_AOB'] * comps[19]
-        self._rate_res[37] = self._params['b_NOB'] * comps[20]
-        self._rate_res[38] = self._params['k_PRE'] * comps[9] * comps[22]
-        self._rate_res[39] = self._params['k_RED'] * self._monods[51] * comps[23]
+            self._rate_res (numpy.ndarray): Reaction rates for each biological process.
+        '''
+        if self._fast_kernel.compiled:
+            self._fast_kernel.rates(np.asarray(comps, dtype=float), self._param_vals, self._fna_factor,
+                                    self._rate_res)
+        else:
+            self._kernel.rates(comps, self._param_list, self._fna_factor, self._rate_res)
 
         return self._rate_res
-    
+
+    def batch_reaction_rate(self, comps, pH=None, params=None, stoich_mat=None):
+        '''
+        Calculate the process and net component rates for many reactor states at once.
+
+        The generated rate function is applied to component rows of length N,
+        so all Monod/inhibition terms and rate expressions are evaluated as
+        NumPy operations over the N states.
+
+        Args:
+            comps (array_like): Model components (concentrations), shape (N, 24) or (24,).
+            pH (float or array_like): Optional pH, one value or one per state (N,);
+                defaults to the current model pH.
+            params (numpy.ndarray): Optional kinetic parameters of each state, shape (N, n_params)
+                (see batch_params); defaults to the current model parameters.
+            stoich_mat (numpy.ndarray): Optional stoichiometric matrix of each state, shape
+                (N, 40, 24) (see batch_stoich_mat); defaults to the current _stoich_mat.
+
+        Return:
+            proc_rates (numpy.ndarray): Process rates, shape (N, 40).
+            net_rates (numpy.ndarray): Net component rates, shape (N, 24).
+        '''
+        comps = np.asarray(comps)
+        dtype = np.result_type(comps.dtype, float) if params is None else np.result_type(comps.dtype, params, float)
+        comps = np.atleast_2d(comps.astype(dtype, copy=False))
+        proc_rates = np.empty((comps.shape[0], 40), dtype=dtype)
+
+        if pH is None:
+            fna_factor = self._fna_factor
+        else:
+            fna_factor = self._fna_equilibrium(self._temperature, np.asarray(pH, dtype=float))
+
+        # parameter-major, so entry i is the (N,) column of parameter i
+        param_cols = self._param_list if params is None else list(np.asarray(params).T)
+
+        # component-major views so comps_T[i] is the (N,) column of component i
+        self._kernel.rates(comps.T, param_cols, fna_factor, proc_rates.T)
+
+        if stoich_mat is None:
+            return proc_rates, proc_rates @ self._stoich_mat
+
+        return proc_rates, np.matmul(proc_rates[:, None, :], stoich_mat)[:, 0, :]
+
+    def batch_params(self, kinetics_20C):
+        '''
+        Kinetic parameters at the project temperature for a batch of parameter sets.
+
+        Args:
+            kinetics_20C (dict): 20C values of some kinetic constants, name to an (N,) array
+                (complex values are kept, for complex-step derivatives); the other constants
+                keep their current 20C values.
+
+        Return:
+            params (numpy.ndarray): Parameters in the order of _param_index, shape (N, n_params).
+        '''
+        n = len(next(iter(kinetics_20C.values())))
+        dtype = np.result_type(float, *kinetics_20C.values())
+        params = np.tile(self._kinetics_20C_vals.astype(dtype), (n, 1))
+        for name, vals in kinetics_20C.items():
+            if name not in self._param_index:
+                raise ValueError('unknown kinetic constant: {}'.format(name))
+            params[:, self._param_index[name]] = vals
+
+        return params * np.exp(self._log_theta * self._delta_t)
+
+    def batch_stoich_mat(self, params):
+        '''
+        Stoichiometric matrices for a batch of parameter sets.
+
+        Args:
+            params (numpy.ndarray): Kinetic parameters, shape (N, n_params) (see batch_params);
+                real or complex.
+
+        Return:
+            stoich_mat (numpy.ndarray): Shape (N, 40, 24), stoich_mat[n] like _stoich_mat.
+        '''
+        params = np.asarray(params)
+        stoichs = self._stoich_values(dict(zip(self._param_names, params.T)))
+
+        stoich_mat = np.zeros((params.shape[0], 40, 24), dtype=np.result_type(params, float))
+        for key, val in stoichs.items():
+            proc, comp = key.split('_')
+            stoich_mat[:, int(proc) - 1, int(comp) - 1] = val
+
+        return stoich_mat
+
     ## Overall process rates for each component
 
     def _rate0_S_O2(self):
@@ -1222,20 +1564,36 @@ class ASM2d_N2O(asm_model):
         Overall mass balance:
         dComp/dt == InfFlow / Actvol * (in_comps - mo_comps) + GrowthRate
                  == (in_comps - mo_comps) / HRT + GrowthRate
+
+        Temperature and DO forcing functions (see set_forcing) are evaluated
+        at t first; with fix_DO, a forced DO replaces the DO in mo_comps.
+        in_comps may also be a callable of time (e.g. influent.influent_reader)
+        giving the influent concentrations at t.
                  
         Args:
             t (float): Time (days).
             mo_comps (list): Mass of each component (mg/L).
             vol (float): Reactor volume (m3).
             flow (float): Influent flow rate (m3/d).
-            in_comps (list): Influent component concentrations (mg/L).
+            in_comps (list or callable): Influent component concentrations (mg/L),
+                or a callable of time returning them.
             fix_DO (bool): Whether to fix the DO concentration.
             DO_sat_T (float): Saturation DO at the chosen temperature (mg/L).
 
         Returns:
-            dCdt (list): List of dC/dt for each component (mg/L/d).
+            dCdt (numpy.ndarray or list): dC/dt for each component (mg/L/d);
+                an array when the stoichiometric matrix is used, otherwise a list.
 
         '''
+        if callable(in_comps):
+            in_comps = in_comps(t)
+
+        if self._use_stoich_mat:
+            return self.rhs_into(np.empty(24), t, np.asarray(mo_comps, dtype=float), vol, flow,
+                                 np.asarray(in_comps, dtype=float), fix_DO, DO_sat_T)
+
+        # Time-varying temperature and DO, if any
+        mo_comps = self._forced_comps(t, mo_comps, fix_DO)
 
         # Load all normalized reaction rates
         self._reaction_rate(mo_comps)
@@ -1318,6 +1676,278 @@ class ASM2d_N2O(asm_model):
         
         result.append((in_comps[23] - mo_comps[23]) / _HRT
                         + self._rate23_X_MeP())
+
+        if self._strip_ratio.any():
+            for i, rate in zip(self._strip_idx, self.stripping_rates(mo_comps)):
+                result[i] -= rate
         
         return result
-            
\ No newline at end of file
+            
+
+    def rhs_into(self, out, t, y, vol, flow, in_comps, fix_DO, DO_sat_T):
+        '''
+        Write dC/dt of _dCdt into a caller-supplied array.
+
+        No arrays are allocated on this path: the kernel input, the process
+        rates, the hydraulic and stripping terms and the result all go to
+        preallocated buffers, so a driver can reuse one output array for a
+        whole run. With the 'python' backend the state is copied into a
+        buffer that the kernel reads through a memoryview, which yields the
+        Python floats the scalar rate code evaluates much faster than NumPy
+        scalars; with the 'numba' backend the compiled kernel takes the
+        arrays directly and also forms the net rates.
+
+        Args:
+            out (numpy.ndarray): Output, float array of shape (24,).
+            t (float): Time (days).
+            y (numpy.ndarray): Concentration of each component (mg/L), shape (24,).
+            vol (float): Reactor volume (m3).
+            flow (float): Influent flow rate (m3/d).
+            in_comps (numpy.ndarray or callable): Influent component concentrations (mg/L),
+                shape (24,), or a callable of time returning them.
+            fix_DO (bool): Whether to fix the DO concentration.
+            DO_sat_T (float): Saturation DO at the chosen temperature (mg/L).
+
+        Returns:
+            out (numpy.ndarray): dC/dt for each component (mg/L/d).
+
+        '''
+        self._apply_forcing(t)
+
+        if callable(in_comps):
+            in_comps = in_comps(t)
+
+        comps = self._comps_arr
+        np.copyto(comps, y)
+        if fix_DO and self._DO_forcing is not None:
+            comps[0] = self._bulk_DO
+        if self._fast_kernel.compiled:
+            # the compiled kernel takes float64 arrays and also forms rates @ stoich_mat
+            self._fast_kernel.net_rates(comps, self._param_vals, self._stoich_entries(), self._fna_factor,
+                                        self._rate_res, out)
+        else:
+            self._kernel.rates(self._comps_view, self._param_list, self._fna_factor, self._rate_res)
+            np.matmul(self._rate_res, self._stoich_mat, out=out)
+
+        # (in_comps - y) / HRT + rates @ stoich_mat
+        np.subtract(in_comps, y, out=self._hyd_res)
+        np.divide(self._hyd_res, vol / flow, out=self._hyd_res)
+        np.add(self._hyd_res, out, out=out)
+
+        if fix_DO or self._bulk_DO == 0:
+            out[0] = 0.0
+        else:
+            out[0] += self._KLa * (DO_sat_T - comps[0])
+
+        if self._strip_ratio.any():
+            # out[_strip_idx] -= stripping_rates(y), through the two rows of _strip_res
+            strip, res = self._strip_res
+            comps.take(self._strip_idx, out=strip, mode='clip')
+            np.subtract(strip, self._strip_sat, out=strip)
+            np.multiply(strip, self._strip_ratio, out=strip)
+            np.multiply(strip, self._aeration_KLa(), out=strip)
+            out.take(self._strip_idx, out=res, mode='clip')
+            np.subtract(res, strip, out=res)
+            out.put(self._strip_idx, res)
+
+        return out
+
+    def jacobian(self, t, comps, vol, flow, in_comps, fix_DO, DO_sat_T, out=None):
+        '''
+        Jacobian of _dCdt with respect to the model components.
+
+        The kinetic part is evaluated by complex-step differentiation of the
+        rate expressions, one perturbed state per component in a single
+        batched call. This gives derivatives exact to round-off, unlike
+        finite differences.
+
+        Args:
+            t (float): Time (days).
+            comps (list): Concentration of each component (mg/L).
+            vol (float): Reactor volume (m3).
+            flow (float): Influent flow rate (m3/d).
+            in_comps (list): Influent component concentrations (mg/L).
+            fix_DO (bool): Whether to fix the DO concentration.
+            DO_sat_T (float): Saturation DO at the chosen temperature (mg/L).
+            out (numpy.ndarray): Optional (24, 24) array to write the result into.
+
+        Returns:
+            jac (numpy.ndarray): jac[i, j] == d(dC_i/dt) / dC_j, shape (24, 24).
+
+        '''
+        comps = self._forced_comps(t, comps, fix_DO)
+
+        h = 1e-30
+        states = np.tile(np.asarray(comps, dtype=complex), (24, 1))
+        states[np.arange(24), np.arange(24)] += 1j * h
+        _, net_rates = self.batch_reaction_rate(states)
+
+        # row j of net_rates holds the response to perturbing component j
+        jac = np.divide(net_rates.imag.T, h, out=out)
+        jac[np.arange(24), np.arange(24)] -= flow / vol
+
+        if fix_DO or self._bulk_DO == 0:
+            jac[0, :] = 0.0
+        else:
+            jac[0, 0] -= self._KLa
+        jac[self._strip_idx, self._strip_idx] -= self._aeration_KLa() * self._strip_ratio
+
+        # a forced, fixed DO does not depend on the DO state
+        if fix_DO and self._DO_forcing is not None:
+            jac[:, 0] = 0.0
+
+        return jac
+
+    def vjp(self, t, comps, lam, vol, flow, fix_DO):
+        '''
+        Product of a vector with the Jacobian of _dCdt, lam^T J.
+
+        The kinetic part is the gradient of the weighted process rates
+        (_stoich_mat lam) . r from the reverse-mode kernel function, so it
+        costs a few rate evaluations and no Jacobian is formed.
+
+        Args:
+            t (float): Time (days).
+            comps (list): Concentration of each component (mg/L).
+            lam (array_like): Vector multiplying dC/dt, shape (24,).
+            vol (float): Reactor volume (m3).
+            flow (float): Influent flow rate (m3/d).
+            fix_DO (bool): Whether to fix the DO concentration.
+
+        Returns:
+            res (numpy.ndarray): res[j] == sum_i lam[i] * d(dC_i/dt) / dC_j, shape (24,).
+
+        '''
+        comps = self._forced_comps(t, comps, fix_DO)
+
+        held = fix_DO or self._bulk_DO == 0
+        lam = np.array(lam, dtype=float)
+        if held:
+            lam[0] = 0.0
+
+        res = np.empty(24)
+        comps = np.asarray(comps, dtype=float)
+        weights = self._stoich_mat @ lam
+        if self._fast_kernel.compiled:
+            self._fast_kernel.rates_vjp(comps, self._param_vals, self._fna_factor, weights, res,
+                                        np.empty(len(self._param_names)))
+        else:
+            self._kernel.rates_vjp(comps.tolist(), self._param_list, self._fna_factor, weights.tolist(), res,
+                                   np.empty(len(self._param_names)))
+        res -= lam * (flow / vol)
+        if not held:
+            res[0] -= self._KLa * lam[0]
+        res[self._strip_idx] -= self._aeration_KLa() * self._strip_ratio * lam[self._strip_idx]
+
+        # a forced, fixed DO does not depend on the DO state
+        if fix_DO and self._DO_forcing is not None:
+            res[0] = 0.0
+
+        return res
+
+    def param_vjp(self, t, comps, lam, fix_DO):
+        '''
+        Product of a vector with the Jacobian of _dCdt with respect to the 20C kinetic constants.
+
+        lam^T df/dp is the gradient of the weighted process rates
+        (_stoich_mat lam) . r from the reverse-mode kernel function, plus the
+        process rates times the derivatives of the stoichiometric matrix,
+        which are kept until the constants or the temperature change. The
+        cost does not depend on the number of constants. Several states at
+        the same forcing conditions can be passed at once.
+
+        Args:
+            t (float): Time (days).
+            comps (array_like): Concentration of each component (mg/L), shape (24,) or (N, 24).
+            lam (array_like): Vectors multiplying dC/dt, of the same shape as comps.
+            fix_DO (bool): Whether to fix the DO concentration.
+
+        Returns:
+            grad (numpy.ndarray): lam^T d(dC/dt) / d(constant), in the order of _param_index,
+                shape (n_params,) or (N, n_params).
+
+        '''
+        comps = np.asarray(self._forced_comps(t, comps, fix_DO), dtype=float)
+        states = np.atleast_2d(comps)
+        lam = np.array(np.atleast_2d(lam), dtype=float)
+        # the DO row of dC/dt does not depend on the kinetics when DO is held
+        if fix_DO or self._bulk_DO == 0:
+            lam[:, 0] = 0.0
+
+        key = self._param_vals.tobytes()
+        if self._dstoich_cache[0] != key:
+            h = 1e-30
+            n_params = len(self._param_names)
+            params = np.tile(self._param_vals.astype(complex), (n_params, 1))
+            params[np.arange(n_params), np.arange(n_params)] += 1j * h
+            dstoich = self.batch_stoich_mat(params).imag / h
+            rows = np.flatnonzero(np.any(dstoich, axis=(1, 2)))
+            self._dstoich_cache = (key, rows, dstoich[rows])
+        _, rows, dstoich = self._dstoich_cache
+
+        # parameter-major, so row i holds the gradients for parameter i
+        grad = np.empty((len(self._param_names), states.shape[0]))
+        self._kernel.rates_vjp(states.T, self._param_list, self._fna_factor, self._stoich_mat @ lam.T,
+                               np.empty(states.T.shape), grad)
+        grad = grad.T
+        proc_rates, _ = self.batch_reaction_rate(states)
+        grad[:, rows] += np.einsum('nk,jkc,nc->nj', proc_rates, dstoich, lam)
+
+        # parameters at the project temperature per unit 20C constant
+        grad *= np.exp(self._log_theta * self._delta_t)
+
+        return grad if comps.ndim == 2 else grad[0]
+
+    def _forced_comps(self, t, comps, fix_DO):
+        '''
+        Apply the forcing functions at time t.
+
+        Args:
+            t (float): Time (days).
+            comps (list): Concentration of each component (mg/L).
+            fix_DO (bool): Whether the DO concentration is fixed.
+
+        Return:
+            comps, or a copy of it with the forced DO when fix_DO is set.
+        '''
+        self._apply_forcing(t)
+
+        if fix_DO and self._DO_forcing is not None:
+            comps = np.array(comps, dtype=np.result_type(comps, float))
+            comps[..., 0] = self._bulk_DO
+
+        return comps
+
+    def get_jac_sparsity(self):
+        '''
+        Return a copy of the static 24x24 sparsity pattern (bool) of the Jacobian.
+
+        '''
+        return self._jac_sparsity.copy()
+
+    def _build_jac_sparsity(self):
+        '''
+        Build the Jacobian sparsity pattern from the stoichiometric matrix.
+
+        Component i depends on component j if some process with a stoichiometric
+        entry for i has a rate that depends on j. The rate dependencies are
+        found once by complex-step perturbation at a generic positive state.
+
+        Return:
+            mask (numpy.ndarray): Bool array of shape (24, 24).
+        '''
+        stoich_mask = np.zeros((40, 24), dtype=bool)
+        for key in self._stoichs:
+            proc, comp = key.split('_')
+            stoich_mask[int(proc) - 1, int(comp) - 1] = True
+
+        states = np.tile(np.linspace(1.0, 2.0, 24, dtype=complex), (24, 1))
+        states[np.arange(24), np.arange(24)] += 1j * 1e-30
+        proc_rates, _ = self.batch_reaction_rate(states)
+        # rate_deps[k, j]: process k depends on component j
+        rate_deps = proc_rates.imag.T != 0.0
+
+        mask = (stoich_mask.T.astype(int) @ rate_deps.astype(int)) > 0
+        mask[np.arange(24), np.arange(24)] = True
+
+        return mask
@@ -0,0 +1,300 @@
+"""
+    Adjoint gradients of calibration objectives for the ASM2d-N2O reactor model.
+
+    -   squared_error: weighted squared error of simulated components (e.g. S_N2O and S_NH4)
+        against measurements at given times, optionally with the N2O off-gas emission rate of
+        the stripping model (ASM2d_N2O.set_stripping).
+    -   adjoint_gradient(): value of an objective over a single-CSTR simulation and its gradient
+        with respect to every 20C kinetic constant, from one forward pass storing checkpoints and
+        one backward pass of the adjoint equations, segment by segment.
+
+    Reference:
+        Massara, T.M., Solís, B., Guisasola, A., Katsou, E. and Baeza, J.A., 2018.
+        Development of an ASM2d-N2O model to describe nitrous oxide emissions in municipal WWTPs under dynamic conditions.
+        Chemical Engineering Journal, 335, pp.185-196.
+        (https://doi.org/10.1016/j.cej.2017.10.119)
+
+        Cao, Y., Li, S., Petzold, L. and Serban, R., 2003. Adjoint sensitivity analysis for
+        differential-algebraic equations: the adjoint DAE system and its numerical solution.
+        SIAM Journal on Scientific Computing, 24(3), pp.1076-1089.
+"""
+
+
+import numpy as np
+from scipy.integrate import solve_ivp
+
+from .ASM2d_N2O import COMP_NAMES, STRIPPED_GASES
+from .simulation import simulate, RTOL, ATOL
+
+
+# default number of forward segments whose initial states are stored
+CHECKPOINTS = 10
+
+# 2-point Gauss-Legendre rule on [-1, 1], for the gradient quadrature
+_GAUSS_NODES = np.array([-1.0, 1.0]) / np.sqrt(3.0)
+_GAUSS_WEIGHTS = np.array([1.0, 1.0])
+
+_N2O = COMP_NAMES.index('S_N2O')
+
+
+class squared_error(object):
+    '''
+    Weighted squared error of simulated components against measurements.
+
+    The off-gas N2O emission rate is simulated as KLa * ratio * (C_N2O - C_sat) * V,
+    with the stripping settings and aeration of the model at the measurement
+    times when the objective is built.
+
+    '''
+
+    def __init__(self, t, data, weights=None, off_gas=None, off_gas_weight=1.0, model=None, vol=None):
+        '''
+        Args:
+            t:              measurement times, days, increasing;
+            data:           dict of component name to its measured values at t, mg/L (nan where missing);
+            weights:        dict of component name to the weight of its squared errors (default 1);
+            off_gas:        measured N2O-N emission rate to the gas phase at t, g/d (nan where missing),
+                            or None;
+            off_gas_weight: weight of the squared errors of the off-gas emission rate;
+            model:          the ASM2d_N2O instance of the stripping settings (needed with off_gas);
+            vol:            reactor volume, m3 (needed with off_gas)
+
+        Return:
+            None
+
+        '''
+        self.t = np.asarray(t, dtype=float)
+        if self.t.ndim != 1 or np.any(np.diff(self.t) <= 0):
+            raise ValueError('measurement times must be a strictly increasing 1-D sequence')
+
+        self._obs = np.full((len(self.t), 24), np.nan)
+        self._weights = np.zeros(24)
+        for name, vals in data.items():
+            if name not in COMP_NAMES:
+                raise ValueError('unknown component: {}'.format(name))
+            i = COMP_NAMES.index(name)
+            self._obs[:, i] = vals
+            self._weights[i] = 1.0 if weights is None else weights.get(name, 1.0)
+
+        # measured entries; the others do not contribute
+        self._mask = ~np.isnan(self._obs)
+
+        # off-gas rate == factor * (C_N2O - C_sat) at each measurement time
+        self._off_gas = np.full(len(self.t), np.nan)
+        self._off_gas_factor = np.zeros(len(self.t))
+        self._off_gas_sat = 0.0
+        self._off_gas_weight = float(off_gas_weight)
+        if off_gas is not None:
+            if model is None or vol is None:
+                raise ValueError('off-gas measurements need the model and the reactor volume')
+            g = STRIPPED_GASES.index('S_N2O')
+            if model._strip_ratio[g] == 0:
+                raise ValueError('off-gas measurements need N2O stripping (ASM2d_N2O.set_stripping)')
+            self._off_gas[:] = off_gas
+            for k, t_k in enumerate(self.t.tolist()):
+                # aeration follows the DO forcing, read without applying it to the model
+                self._off_gas_factor[k] = model._aeration_KLa(t_k) * model._strip_ratio[g] * vol
+            self._off_gas_sat = float(model._strip_sat[g])
+        self._off_gas_mask = ~np.isnan(self._off_gas)
+
+        return None
+
+
+    def off_gas_rate(self, comps):
+        '''
+        Simulated N2O-N emission rate to the gas phase at the measurement times, g/d.
+
+        '''
+        return self._off_gas_factor * (comps[:, _N2O] - self._off_gas_sat)
+
+
+    def value(self, comps):
+        '''
+        Objective value of the simulated components at the measurement times, shape (len(t), 24).
+
+        '''
+        res = np.where(self._mask, comps - self._obs, 0.0)
+        res_gas = np.where(self._off_gas_mask, self.off_gas_rate(comps) - self._off_gas, 0.0)
+
+        return float(np.sum(self._weights * res ** 2) + self._off_gas_weight * np.sum(res_gas ** 2))
+
+
+    def state_grad(self, k, comps):
+        '''
+        Gradient of the objective with respect to the components at measurement time k.
+
+        '''
+        res = np.where(self._mask[k], comps - self._obs[k], 0.0)
+        grad = 2.0 * self._weights * res
+        if self._off_gas_mask[k]:
+            res_gas = self._off_gas_factor[k] * (comps[_N2O] - self._off_gas_sat) - self._off_gas[k]
+            grad[_N2O] += 2.0 * self._off_gas_weight * res_gas * self._off_gas_factor[k]
+
+        return grad
+
+
+class adjoint_result(object):
+    '''
+    Objective value and gradient from an adjoint run.
+
+    '''
+
+    def __init__(self, value, grad, init_grad, comps, nfev, nfev_adjoint, success, message):
+        '''
+        Args:
+            value:          objective value;
+            grad:           dict of 20C kinetic constant name to the derivative of the objective;
+            init_grad:      derivatives of the objective with respect to the initial components, (24,);
+            comps:          simulated components at the measurement times, mg/L, shape (len(t), 24);
+            nfev:           number of dC/dt evaluations of the forward and recomputed passes;
+            nfev_adjoint:   number of adjoint right-hand side evaluations;
+            success:        whether all passes reached the end of their horizon;
+            message:        status message
+
+        Return:
+            None
+
+        '''
+        self.value = value
+        self.grad = grad
+        self.init_grad = init_grad
+        self.comps = comps
+        self.nfev = nfev
+        self.nfev_adjoint = nfev_adjoint
+        self.success = success
+        self.message = message
+
+        return None
+
+
+def adjoint_gradient(model, objective, init_comps, in_comps, vol, flow, fix_DO=False, DO_sat_T=9.0,
+                     t_start=0.0, checkpoints=CHECKPOINTS, method='BDF', rtol=RTOL, atol=ATOL):
+    '''
+    Objective of a single-CSTR simulation and its gradient with respect to all 20C kinetic constants.
+
+    For an objective G = sum_k g_k(C(t_k)), the adjoint l(t) = dG/dC(t)
+    obeys dl/dt = -J^T l backward in time, jumping by dg_k/dC at each
+    measurement time, and dG/dp = integral of l^T df/dp dt. The forward
+    pass only keeps the states at checkpoints + 1 evenly spaced times;
+    each segment is then simulated again with dense output and the
+    adjoint is integrated back across it, so memory is bounded by one
+    segment. l^T J and l^T df/dp come from the reverse-mode kernel
+    function (ASM2d_N2O.vjp and param_vjp) at the cost of a few rate
+    evaluations whatever the number of constants, and the gradient is
+    accumulated by Gauss-Legendre quadrature over the adjoint steps
+    (outside the error control, as quadratures are in CVODES). The work
+    is two forward simulations and one backward integration of a linear
+    system of the same size.
+
+    Args:
+        model:          an ASM2d_N2O instance;
+        objective:      a squared_error, or any object with increasing measurement times t,
+                        value(comps) and state_grad(k, comps);
+        init_comps:     initial component concentrations, mg/L (24 values);
+        in_comps:       influent component concentrations, mg/L (24 values), or a callable of time;
+        vol:            reactor volume, m3;
+        flow:           influent flow rate, m3/d;
+        fix_DO:         whether to fix the DO concentration;
+        DO_sat_T:       saturation DO at the chosen temperature, mg/L;
+        t_start:        start of the simulation, days; it ends at the last measurement time;
+        checkpoints:    number of forward segments;
+        method:         stiff solver passed to scipy solve_ivp ('BDF', 'Radau' or 'LSODA');
+        rtol:           relative tolerance;
+        atol:           absolute tolerance, mg/L
+
+    Return:
+        adjoint_result
+
+    '''
+    t_obs = np.asarray(objective.t, dtype=float)
+    if t_obs[0] < t_start:
+        raise ValueError('measurement times must not precede t_start')
+    t_end = t_obs[-1]
+    if checkpoints < 1:
+        raise ValueError('checkpoints must be at least 1')
+
+    n_params = len(model._param_names)
+    bounds = np.linspace(t_start, t_end, checkpoints + 1)
+
+    ## Forward pass: components at the measurement times and states at the checkpoints
+    fwd = simulate(model, init_comps, in_comps, t_end, vol, flow, fix_DO, DO_sat_T,
+                   t_eval=np.union1d(t_obs, bounds), t_start=t_start, method=method, rtol=rtol, atol=atol)
+    if not fwd.success:
+        return adjoint_result(np.nan, None, None, None, fwd.nfev, 0, False, fwd.message)
+    comps_obs = fwd.comps[np.searchsorted(fwd.t, t_obs)]
+    starts = fwd.comps[np.searchsorted(fwd.t, bounds[:-1])]
+    nfev = fwd.nfev
+    nfev_adjoint = 0
+
+    ## Backward pass, segment by segment
+    inf = in_comps if callable(in_comps) else np.array(in_comps, dtype=float)
+    jac_buf = np.empty((24, 24))
+    # forward interpolant of the current segment
+    seg_state = {'sol': None}
+
+    def _adj_rhs(t, lam):
+        return -model.vjp(t, seg_state['sol'](t), lam, vol, flow, fix_DO)
+
+    def _adj_jac(t, lam):
+        return -model.jacobian(t, seg_state['sol'](t), vol, flow, inf, fix_DO, DO_sat_T, out=jac_buf).T
+
+    # without forcing functions, the quadrature nodes share one batched call
+    forced = (model._temp_forcing is not None or model._DO_forcing is not None
+              or model._pH_forcing is not None)
+
+    def _quadrature(t_q, w_q, lam_sol):
+        y_q = seg_state['sol'](t_q).T
+        lam_q = lam_sol(t_q).T * w_q[:, None]
+        if forced:
+            return sum(model.param_vjp(t, y, lam, fix_DO) for t, y, lam in zip(t_q, y_q, lam_q))
+        return model.param_vjp(t_q[0], y_q, lam_q, fix_DO).sum(axis=0)
+
+    lam = np.zeros(24)
+    grad = np.zeros(n_params)
+    step = None
+    k = len(t_obs) - 1
+    for s in range(checkpoints - 1, -1, -1):
+        a, b = bounds[s], bounds[s + 1]
+        seg = simulate(model, starts[s], in_comps, b, vol, flow, fix_DO, DO_sat_T, t_eval=[b], t_start=a,
+                       dense_output=True, method=method, rtol=rtol, atol=atol)
+        nfev += seg.nfev
+        if not seg.success:
+            return adjoint_result(np.nan, None, None, comps_obs, nfev, nfev_adjoint, False, seg.message)
+        seg_state['sol'] = seg.sol
+
+        # sub-intervals between the measurement times of the segment, backward
+        t_hi = b
+        while True:
+            while k >= 0 and t_obs[k] >= t_hi:
+                lam += objective.state_grad(k, comps_obs[k])
+                k -= 1
+            t_lo = max(t_obs[k], a) if k >= 0 else a
+            if t_lo >= t_hi:
+                break
+            # the previous step size saves ramping up again after each jump
+            res = solve_ivp(_adj_rhs, (t_hi, t_lo), lam, method=method, jac=_adj_jac, rtol=rtol, atol=atol,
+                            dense_output=True, first_step=None if step is None else min(step, t_hi - t_lo))
+            nfev_adjoint += res.nfev
+            if not res.success:
+                return adjoint_result(np.nan, None, None, comps_obs, nfev, nfev_adjoint, False, res.message)
+
+            # gradient quadrature, at the Gauss-Legendre nodes of each solver step
+            lo, hi = res.t[1:], res.t[:-1]
+            t_q = ((hi + lo) / 2 + np.outer(_GAUSS_NODES, (hi - lo) / 2)).ravel()
+            w_q = np.outer(_GAUSS_WEIGHTS, (hi - lo) / 2).ravel()
+            grad += _quadrature(t_q, w_q, res.sol)
+
+            lam = res.y[:, -1]
+            step = abs(res.t[-1] - res.t[-2])
+            t_hi = t_lo
+            if t_lo == a:
+                break
+
+    # measurements at t_start only depend on the initial components
+    while k >= 0:
+        lam += objective.state_grad(k, comps_obs[k])
+        k -= 1
+    grad = dict(zip(model._param_names, grad.tolist()))
+
+    return adjoint_result(objective.value(comps_obs), grad, lam, comps_obs, nfev, nfev_adjoint, True,
+                          'The adjoint pass successfully reached the start of the integration interval.')
@@ -12,6 +12,72 @@
 """
 
 
+from collections.abc import MutableMapping
+
+import numpy as np
+
+
+# maximum number of (temperature, DO) conditions memoized by asm_model.update()
+_UPDATE_CACHE_SIZE = 256
+
+
+class param_view(MutableMapping):
+    '''
+    Dict-style view on a fixed-order parameter array.
+
+    Keys are parameter names; values are read from and written to the
+    underlying float64 array (and its list mirror) by integer position.
+
+    '''
+
+    def __init__(self, index, vals, vals_list):
+        '''
+        Args:
+            index:      dict of parameter name to integer position;
+            vals:       float64 array of parameter values;
+            vals_list:  list mirror of vals used by scalar kinetic code
+
+        Return:
+            None
+
+        '''
+        self._index = index
+        self._vals = vals
+        self._vals_list = vals_list
+
+        return None
+
+
+    def __getitem__(self, name):
+        return self._vals_list[self._index[name]]
+
+
+    def __setitem__(self, name, val):
+        pos = self._index[name]
+        self._vals[pos] = val
+        self._vals_list[pos] = float(val)
+
+
+    def __delitem__(self, name):
+        raise TypeError('model parameters cannot be deleted')
+
+
+    def __iter__(self):
+        return iter(self._index)
+
+
+    def __len__(self):
+        return len(self._index)
+
+
+    def copy(self):
+        '''
+        Return a plain dict copy of the parameters.
+
+        '''
+        return dict(self.items())
+
+
 class asm_model(object):
 
 
@@ -36,11 +102,41 @@ class asm_model(object):
         # default kinetic constants AT 20 degree Celcius under ideal conditions
         self._kinetics_20C = {}
 
-        # kinetic parameters AT PROJECT TEMPERATURE
+        # Arrhenius temperature coefficients (theta) of the kinetic constants,
+        # k_T = k_20C * theta ** (T - 20); constants not listed have theta == 1
+        self._arrhenius_theta = {}
+
+        # kinetic parameters AT PROJECT TEMPERATURE, a dict-style view on
+        # _param_vals once _index_params() has been called
         self._params = {}
 
-        # stoichiometrics
+        # fixed-order parameter names and their positions in _param_vals
+        self._param_names = []
+        self._param_index = {}
+
+        # kinetic parameters AT PROJECT TEMPERATURE as a contiguous array,
+        # and a list mirror of it for scalar (non-vectorized) kinetic code
+        self._param_vals = np.zeros(0)
+        self._param_list = []
+
+        # kinetic constants at 20C and ln(theta), in the order of _param_index
+        self._kinetics_20C_vals = np.zeros(0)
+        self._log_theta = np.zeros(0)
+
+        # positions of the temperature-dependent parameters (theta != 1)
+        self._temp_idx = np.zeros(0, dtype=int)
+
+        # forcing functions of time (days) for temperature and DO, or None
+        self._temp_forcing = None
+        self._DO_forcing = None
+
+        # stoichiometrics, as a dict and as a dense (process x component) matrix
         self._stoichs = {}
+        self._stoich_mat = np.zeros((0, 0))
+
+        # parameters and stoichiometrics already computed by update(),
+        # keyed by (temperature, DO)
+        self._update_cache = {}
 
         # ASM model components
         self._comps = []
@@ -72,16 +168,60 @@ class asm_model(object):
         '''
         if new_val > 0 and name in self._kinetics_20C.keys():
             self._kinetics_20C[name] = new_val
+            if name in self._param_index:
+                self._kinetics_20C_vals[self._param_index[name]] = new_val
+            self._update_cache.clear()
         else:
             print('ERROR IN ALTERING 20C KINETICS. NO PARAMETER WAS CHANGED')
 
         return None
 
 
+    def get_kinetics_20C(self):
+        '''
+        Return a copy of the kinetic constants at 20C.
+
+        '''
+        return dict(self._kinetics_20C)
+
+
+    def reset_kinetics_20C(self, kinetics):
+        '''
+        Restore kinetic constants at 20C from a snapshot of get_kinetics_20C().
+
+        Unlike alter_kinetic_20C(), zero values (e.g. the default f_SI) are
+        accepted, so any snapshot can be restored. Call update() afterwards
+        to recompute the parameters.
+
+        Args:
+            kinetics:   dict of name to 20C value, for all or some of the constants
+
+        Return:
+            None
+
+        '''
+        for name, val in kinetics.items():
+            if name not in self._kinetics_20C:
+                raise ValueError('unknown kinetic constant: {}'.format(name))
+            if val < 0:
+                raise ValueError('kinetic constant {} must not be negative, got {}'.format(name, val))
+
+        for name, val in kinetics.items():
+            self._kinetics_20C[name] = val
+            if name in self._param_index:
+                self._kinetics_20C_vals[self._param_index[name]] = val
+        self._update_cache.clear()
+
+        return None
+
+
     def update(self, ww_temp, DO):
         ''' 
         Update the ASM model with new water temperature and dissolved O2. 
 
+        Parameters and stoichiometrics are memoized by (ww_temp, DO), so
+        recurring conditions are restored without recomputing anything.
+
         Args:
             ww_temp:    wastewater temperature, degC;
             DO:         dissolved oxygen, mg/L
@@ -93,8 +233,22 @@ class asm_model(object):
         self._temperature = ww_temp
         self._bulk_DO = DO
         self._delta_t = self._temperature - 20.0
-        self._set_params()
-        self._set_stoichs()
+
+        key = (ww_temp, DO)
+        cached = self._update_cache.get(key)
+        if cached is None:
+            self._set_params()
+            self._set_stoichs()
+            if len(self._update_cache) >= _UPDATE_CACHE_SIZE:
+                self._update_cache.clear()
+            # _set_stoichs builds new containers on every call, so they can be shared
+            self._update_cache[key] = (self._param_vals.copy(), self._stoichs, self._stoich_mat)
+        else:
+            param_vals, self._stoichs, self._stoich_mat = cached
+            # the parameter array is updated in place, _params is a view on it
+            self._param_vals[:] = param_vals
+            self._param_list[:] = param_vals.tolist()
+
         return None
 
 
@@ -117,6 +271,29 @@ class asm_model(object):
         return None
 
 
+    def set_forcing(self, ww_temp=None, DO=None):
+        '''
+        Set time-varying wastewater temperature and/or DO used inside _dCdt.
+
+        Each forcing is either None (no forcing), a callable of time (days),
+        or a (times, values) pair that is interpolated linearly. Temperature
+        changes only recompute the temperature-dependent parameters; the
+        stoichiometrics do not depend on temperature and are left as is.
+
+        Args:
+            ww_temp:    wastewater temperature forcing, degC;
+            DO:         dissolved oxygen forcing, mg/L (0 switches aeration off)
+
+        Return:
+            None
+
+        '''
+        self._temp_forcing = self._as_forcing(ww_temp)
+        self._DO_forcing = self._as_forcing(DO)
+
+        return None
+
+
     def get_params(self):
         '''
         Return the values of the kinetic parameter dictionary.
@@ -157,12 +334,93 @@ class asm_model(object):
         pass
 
 
+    def _index_params(self):
+        '''
+        Fix the parameter order to that of _kinetics_20C and allocate the
+        parameter array. Call once after the 20C defaults are set.
+
+        '''
+        self._param_names = list(self._kinetics_20C.keys())
+        self._param_index = {name: i for i, name in enumerate(self._param_names)}
+        self._kinetics_20C_vals = np.array([self._kinetics_20C[name] for name in self._param_names], dtype=np.float64)
+        self._log_theta = np.log([self._arrhenius_theta.get(name, 1.0) for name in self._param_names])
+        self._param_vals = self._kinetics_20C_vals.copy()
+        self._param_list = self._param_vals.tolist()
+        self._params = param_view(self._param_index, self._param_vals, self._param_list)
+        self._temp_idx = np.flatnonzero(self._log_theta)
+        self._update_cache.clear()
+
+        return None
+
+
     def _set_params(self):
         '''
         Set the kinetic parameters/constants to the project temperature & DO.
 
+        Applies the Arrhenius correction k_T = k_20C * theta ** (T - 20) to
+        the whole parameter array with a single vectorized exp.
+
         '''
-        pass
+        np.multiply(self._kinetics_20C_vals, np.exp(self._log_theta * self._delta_t), out=self._param_vals)
+        self._param_list[:] = self._param_vals.tolist()
+
+        return None
+
+
+    def _set_temperature(self, ww_temp):
+        '''
+        Move the kinetic parameters to a new temperature, in place.
+
+        Only the temperature-dependent entries are recomputed, and nothing
+        is done if the temperature has not changed.
+
+        Args:
+            ww_temp:    wastewater temperature, degC
+
+        Return:
+            None
+
+        '''
+        if ww_temp == self._temperature:
+            return None
+
+        self._temperature = ww_temp
+        self._delta_t = ww_temp - 20.0
+
+        idx = self._temp_idx
+        vals = self._kinetics_20C_vals[idx] * np.exp(self._log_theta[idx] * self._delta_t)
+        self._param_vals[idx] = vals
+        for i, val in zip(idx.tolist(), vals.tolist()):
+            self._param_list[i] = val
+
+        return None
+
+
+    def _apply_forcing(self, t):
+        '''
+        Evaluate the temperature and DO forcing functions at time t (days).
+
+        '''
+        if self._temp_forcing is not None:
+            self._set_temperature(float(self._temp_forcing(t)))
+        if self._DO_forcing is not None:
+            self._bulk_DO = float(self._DO_forcing(t))
+
+        return None
+
+
+    @staticmethod
+    def _as_forcing(spec):
+        '''
+        Return spec as a callable of time: None, a callable, or a (times, values) pair.
+
+        '''
+        if spec is None or callable(spec):
+            return spec
+
+        times, vals = (np.asarray(x, dtype=float) for x in spec)
+
+        return lambda t: np.interp(t, times, vals)
 
 
     def _set_stoichs(self):
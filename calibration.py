@@ -0,0 +1,345 @@
+"""
+    Calibration of ASM2d-N2O kinetic constants against plant data.
+
+    -   calibrate(): fit a subset of the 20C kinetic constants to measured series (e.g. effluent
+        S_NH4 and S_N2O, and the off-gas N2O emission rate once N2O is stripped) by weighted
+        least squares over a single-CSTR simulation, with several bounded quasi-Newton starts
+        run in parallel worker processes. Objective gradients come from
+        adjoint.adjoint_gradient(); forward runs are memoized by the hash of the parameter
+        vector, and the steady-state initialization of each run is warm-started from the
+        nearest parameter vector already solved.
+
+    Reference:
+        Massara, T.M., Solís, B., Guisasola, A., Katsou, E. and Baeza, J.A., 2018.
+        Development of an ASM2d-N2O model to describe nitrous oxide emissions in municipal WWTPs under dynamic conditions.
+        Chemical Engineering Journal, 335, pp.185-196.
+        (https://doi.org/10.1016/j.cej.2017.10.119)
+"""
+
+
+import hashlib
+import multiprocessing
+import os
+import pickle
+
+import numpy as np
+from scipy.linalg import lu_factor, lu_solve
+from scipy.optimize import minimize
+from scipy.stats import qmc
+
+from .adjoint import adjoint_gradient, CHECKPOINTS
+from .simulation import simulate, RTOL, ATOL
+from .steady import steady_state
+
+
+# state of the current worker process, set by _init_worker
+_worker = {}
+
+
+class start_result(object):
+    '''
+    Outcome of one optimizer start.
+
+    '''
+
+    def __init__(self, index, x0, x, value, n_eval, n_cached, success, message):
+        '''
+        Args:
+            index:      position of the start;
+            x0:         dict of the starting 20C values;
+            x:          dict of the fitted 20C values;
+            value:      objective value at x;
+            n_eval:     number of objective evaluations requested by the optimizer;
+            n_cached:   number of those answered from the memo or the cache directory;
+            success:    whether the optimizer converged;
+            message:    optimizer message, or the error of a failed start
+
+        Return:
+            None
+
+        '''
+        self.index = index
+        self.x0 = x0
+        self.x = x
+        self.value = value
+        self.n_eval = n_eval
+        self.n_cached = n_cached
+        self.success = success
+        self.message = message
+
+        return None
+
+
+class calib_result(object):
+    '''
+    Result of a multi-start calibration.
+
+    '''
+
+    def __init__(self, names, best, value, starts):
+        '''
+        Args:
+            names:      calibrated kinetic constants;
+            best:       dict of the 20C values of the best start;
+            value:      objective value of the best start;
+            starts:     list of start_result, in start order
+
+        Return:
+            None
+
+        '''
+        self.names = names
+        self.best = best
+        self.value = value
+        self.starts = starts
+
+        return None
+
+
+def _init_worker(model, case):
+    '''
+    Keep the model and the calibration case in this worker process.
+
+    '''
+    # memo: parameter hash to (value, gradient); solved: (log parameters, steady state) pairs
+    _worker.update(model=model, case=case, base=dict(model._kinetics_20C), memo={}, solved=[])
+
+    return None
+
+
+def _steady_init(model, case, u):
+    '''
+    Steady state of the current parameters, warm-started from the nearest solved parameter vector,
+    or from a short transient run of init_comps.
+
+    '''
+    solved = _worker['solved']
+    guess = case['init_comps']
+    if solved:
+        dist = [np.sum((u - u_i) ** 2) for u_i, _ in solved]
+        guess = solved[int(np.argmin(dist))][1]
+
+    args = (case['ss_in_comps'], case['vol'], case['flow'], case['fix_DO'], case['DO_sat_T'])
+    res = steady_state(model, guess, *args)
+    if not res.converged:
+        # relax the cold guess over one hydraulic residence time and solve again
+        hrt = case['vol'] / case['flow']
+        run = simulate(model, case['init_comps'], case['ss_in_comps'], hrt, case['vol'], case['flow'],
+                       case['fix_DO'], case['DO_sat_T'], t_eval=[hrt])
+        if run.success:
+            res = steady_state(model, run.comps[-1], *args)
+    if res.converged:
+        solved.append((u.copy(), res.comps.copy()))
+
+    return res
+
+
+def _evaluate(u):
+    '''
+    Objective value and gradient with respect to the log 20C values u of the case constants.
+
+    '''
+    model, case = _worker['model'], _worker['case']
+    names = case['names']
+
+    key = hashlib.sha256(case['key'].encode() + np.ascontiguousarray(u, dtype=float).tobytes()).hexdigest()
+    if key in _worker['memo']:
+        _worker['hits'] += 1
+        return _worker['memo'][key]
+    path = None if case['cache_dir'] is None else os.path.join(case['cache_dir'], key[:32] + '.npy')
+    if path is not None and os.path.exists(path):
+        out = np.load(path)
+        _worker['hits'] += 1
+        _worker['memo'][key] = (float(out[0]), out[1:])
+        return _worker['memo'][key]
+
+    vals = np.exp(u)
+    for name, val in zip(names, vals.tolist()):
+        model.alter_kinetic_20C(name, val)
+    model.update(case['ww_temp'], case['DO'])
+
+    init_comps = case['init_comps']
+    if case['steady_init']:
+        ss = _steady_init(model, case, u)
+        if not ss.converged:
+            return np.inf, np.zeros(len(names))
+        init_comps = ss.comps
+
+    res = adjoint_gradient(model, case['objective'], init_comps, case['in_comps'], case['vol'], case['flow'],
+                           case['fix_DO'], case['DO_sat_T'], case['t_start'], case['checkpoints'],
+                           case['method'], case['rtol'], case['atol'])
+    if not res.success:
+        return np.inf, np.zeros(len(names))
+
+    grad = np.array([res.grad[name] for name in names])
+    if case['steady_init']:
+        # the initial state moves with the constants: dC0/dp = -J^-1 df/dp at the steady state
+        jac = model.jacobian(0.0, init_comps, case['vol'], case['flow'], case['ss_in_comps'],
+                             case['fix_DO'], case['DO_sat_T'])
+        if case['fix_DO'] or model._bulk_DO == 0:
+            jac[0, 0] = -1.0
+        mu = lu_solve(lu_factor(jac), res.init_grad, trans=1)
+        idx = [model._param_index[name] for name in names]
+        grad -= model.param_vjp(0.0, init_comps, mu, case['fix_DO'])[idx]
+
+    # d/d(log p) == p * d/dp
+    out = (res.value, grad * vals)
+    _worker['memo'][key] = out
+    if path is not None:
+        # write-then-rename, so a concurrent or interrupted run never reads a partial file
+        np.save(path + '.tmp.npy', np.concatenate([[out[0]], out[1]]))
+        os.replace(path + '.tmp.npy', path)
+
+    return out
+
+
+def _run_start(task):
+    '''
+    Run one optimizer start in the current worker.
+
+    '''
+    index, u0 = task
+    model, case = _worker['model'], _worker['case']
+    names = case['names']
+    _worker['hits'] = 0
+    n_eval = [0]
+
+    def _fun(u):
+        n_eval[0] += 1
+        return _evaluate(u)
+
+    x0 = dict(zip(names, np.exp(u0).tolist()))
+    try:
+        res = minimize(_fun, u0, jac=True, method='L-BFGS-B', bounds=case['log_bounds'],
+                       options={'maxiter': case['max_iter']})
+        # an infinite value is a failed simulation, not a converged start
+        return start_result(index, x0, dict(zip(names, np.exp(res.x).tolist())), float(res.fun),
+                            n_eval[0], _worker['hits'], bool(res.success and np.isfinite(res.fun)),
+                            str(res.message))
+    except Exception as exc:
+        return start_result(index, x0, None, np.inf, n_eval[0], _worker['hits'], False,
+                            '{}: {}'.format(type(exc).__name__, exc))
+    finally:
+        # back to the baseline constants for the next start of this worker
+        for name in names:
+            model.alter_kinetic_20C(name, _worker['base'][name])
+        model.update(case['ww_temp'], case['DO'])
+
+
+def calibrate(model, names, objective, in_comps, vol, flow, init_comps, steady_init=True, ss_in_comps=None,
+              bounds=None, rel_range=0.5, starts=4, seed=0, processes=None, mp_context=None, max_iter=50,
+              cache_dir=None, fix_DO=False, DO_sat_T=9.0, t_start=0.0, checkpoints=CHECKPOINTS,
+              method='BDF', rtol=RTOL, atol=ATOL):
+    '''
+    Fit 20C kinetic constants to measured series with parallel multi-start L-BFGS-B.
+
+    The constants are optimized in log space within their bounds. Start 0
+    is the current model value; the others are Latin hypercube points of
+    the log bounds. Each start runs in a worker process that builds its
+    state once and memoizes the objective and gradient of every parameter
+    vector it evaluates by a hash of the vector and of the case, so the
+    optimizer's repeated evaluations (and, with cache_dir, evaluations of
+    other workers and earlier runs) cost nothing. With steady_init the
+    simulation starts from the steady state of the trial constants, solved
+    from the steady state of the nearest parameter vector the worker has
+    already solved, and its dependence on the constants enters the
+    gradient through the implicit function theorem.
+
+    Args:
+        model:          an ASM2d_N2O instance (its temperature, DO, pH, KLa and other
+                        constants are kept);
+        names:          20C kinetic constants to fit;
+        objective:      an adjoint.squared_error of the measured series, or any picklable object
+                        with measurement times t, value(comps) and state_grad(k, comps);
+        in_comps:       influent component concentrations, mg/L (24 values), or a picklable
+                        callable of time (e.g. influent.influent_reader);
+        vol:            reactor volume, m3;
+        flow:           influent flow rate, m3/d;
+        init_comps:     initial components, mg/L (24 values), or the first steady-state guess;
+        steady_init:    whether to start each simulation from the steady state of the trial constants;
+        ss_in_comps:    influent of the steady state, mg/L (default: in_comps at t_start);
+        bounds:         dict of name to (low, high) 20C values, overriding rel_range;
+        rel_range:      default bounds, value * (1 - rel_range) to value * (1 + rel_range);
+        starts:         number of optimizer starts;
+        seed:           seed of the start points;
+        processes:      number of worker processes (default: all cores, at most starts); 1 runs
+                        in this process;
+        mp_context:     multiprocessing start method or None for the default;
+        max_iter:       maximum number of L-BFGS-B iterations per start;
+        cache_dir:      directory shared by the workers to cache evaluations across starts and
+                        runs, or None;
+        fix_DO:         whether to fix the DO concentration;
+        DO_sat_T:       saturation DO at the chosen temperature, mg/L;
+        t_start:        start of the simulation, days; it ends at the last measurement time;
+        checkpoints:    number of forward segments of the adjoint runs;
+        method:         stiff solver passed to scipy solve_ivp;
+        rtol:           relative tolerance;
+        atol:           absolute tolerance, mg/L
+
+    Return:
+        calib_result
+
+    '''
+    names = list(names)
+    k20 = model._kinetics_20C
+    bounds = dict(bounds or {})
+    for name in names:
+        if name not in k20:
+            raise ValueError('unknown kinetic constant: {}'.format(name))
+        bounds.setdefault(name, (k20[name] * (1.0 - rel_range), k20[name] * (1.0 + rel_range)))
+        if not 0 < bounds[name][0] <= bounds[name][1]:
+            raise ValueError('bounds of {} must be positive and increasing'.format(name))
+    log_bounds = np.log([bounds[name] for name in names])
+
+    if ss_in_comps is None:
+        ss_in_comps = in_comps(t_start) if callable(in_comps) else in_comps
+
+    case = {'names': names, 'objective': objective, 'in_comps': in_comps, 'vol': vol, 'flow': flow,
+            'init_comps': np.array(init_comps, dtype=float), 'steady_init': steady_init,
+            'ss_in_comps': np.array(ss_in_comps, dtype=float), 'fix_DO': fix_DO, 'DO_sat_T': DO_sat_T,
+            't_start': t_start, 'checkpoints': checkpoints, 'method': method, 'rtol': rtol, 'atol': atol,
+            'ww_temp': model._temperature, 'DO': model._bulk_DO, 'log_bounds': [tuple(b) for b in log_bounds],
+            'max_iter': max_iter, 'cache_dir': cache_dir}
+
+    # the cache key covers everything that changes an evaluation, except the parameter vector
+    key = hashlib.sha256()
+    key.update(model._kinetics_20C_vals.tobytes())
+    key.update(model._log_theta.tobytes())
+    key.update(model._strip_ratio.tobytes() + model._strip_sat.tobytes())
+    key.update(repr((model._temperature, model._bulk_DO, model._pH, model._KLa)).encode())
+    try:
+        key.update(pickle.dumps({k: v for k, v in case.items() if k not in ('log_bounds', 'max_iter', 'cache_dir')}))
+    except (pickle.PicklingError, AttributeError, TypeError):
+        # e.g. a lambda influent, which also needs processes == 1: memoize within this run only
+        key.update(os.urandom(16))
+    case['key'] = key.hexdigest()
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+
+    ## Start points: the current values, then a Latin hypercube of the log bounds
+    u0 = np.log(np.clip([k20[name] for name in names], *np.exp(log_bounds.T)))
+    tasks = [(0, u0)]
+    if starts > 1:
+        unit = qmc.LatinHypercube(d=len(names), seed=seed).random(starts - 1)
+        lo, hi = log_bounds[:, 0], log_bounds[:, 1]
+        tasks += [(i + 1, lo + u * (hi - lo)) for i, u in enumerate(unit)]
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = max(1, min(processes, len(tasks)))
+
+    if processes == 1:
+        _init_worker(model, case)
+        try:
+            results = [_run_start(task) for task in tasks]
+        finally:
+            # do not keep the caller's model, the memo and the solved states alive after the run
+            _worker.clear()
+    else:
+        ctx = multiprocessing.get_context(mp_context)
+        with ctx.Pool(processes, initializer=_init_worker, initargs=(model, case)) as pool:
+            results = sorted(pool.imap_unordered(_run_start, tasks), key=lambda res: res.index)
+
+    best = min(results, key=lambda res: res.value)
+
+    return calib_result(names, best.x, best.value, results)
@@ -0,0 +1,529 @@
+"""
+    Multi-reactor flowsheets for the ASM2d-N2O model.
+
+    -   tanks_in_series: completely mixed tanks in series with step feed and recycles (internal
+        nitrate recycle, return sludge), integrated as one stacked state of shape (n_tanks x 24),
+        optionally followed by the layers of a secondary settler, and optionally integrating the
+        cumulative off-gas emissions of all tanks with the state.
+    -   takacs_settler: non-reactive layered 1-D secondary settler with the double-exponential
+        settling velocity of Takacs et al., whose gravity fluxes are evaluated for all layers
+        (and a batch of states) at once.
+
+    Reference:
+        Massara, T.M., Solís, B., Guisasola, A., Katsou, E. and Baeza, J.A., 2018.
+        Development of an ASM2d-N2O model to describe nitrous oxide emissions in municipal WWTPs under dynamic conditions.
+        Chemical Engineering Journal, 335, pp.185-196.
+        (https://doi.org/10.1016/j.cej.2017.10.119)
+
+        Takács, I., Patry, G.G. and Nolasco, D., 1991. A dynamic model of the clarification-thickening
+        process. Water Research, 25(10), pp.1263-1271.
+"""
+
+
+import numpy as np
+from scipy import sparse
+from scipy.integrate import solve_ivp
+
+from .ASM2d_N2O import COMP_NAMES
+from .simulation import sim_result, RTOL, ATOL, _with_emissions, _emissions
+
+
+# components that settle with the sludge
+PARTICULATES = np.array([name.startswith('X_') for name in COMP_NAMES])
+_TSS = COMP_NAMES.index('X_TSS')
+
+
+class takacs_settler(object):
+    '''
+    Layered 1-D secondary settler (Takacs et al., 1991), without reactions.
+
+    Layers are numbered from the top. The bulk flow carries all components
+    up from the feed layer to the effluent and down to the underflow; the
+    particulates also settle with the gravity flux of X_TSS, split between
+    them in the proportions of the layer they leave. The defaults are the
+    settler of the IWA Benchmark Simulation Model no. 1.
+
+    '''
+
+    def __init__(self, area=1500.0, height=4.0, n_layers=10, feed_layer=5, v0_max=250.0, v0=474.0,
+                 r_h=5.76e-4, r_p=2.86e-3, f_ns=2.28e-3, X_t=3000.0):
+        '''
+        Args:
+            area:           surface area, m2;
+            height:         depth, m;
+            n_layers:       number of layers;
+            feed_layer:     layer receiving the feed, counted from the top (0);
+            v0_max:         maximum practical settling velocity, m/d;
+            v0:             maximum Vesilind settling velocity, m/d;
+            r_h:            hindered zone settling parameter, m3/g;
+            r_p:            flocculant zone settling parameter, m3/g;
+            f_ns:           non-settleable fraction of the feed X_TSS;
+            X_t:            threshold X_TSS of the clarification zone, mg/L
+
+        Return:
+            None
+
+        '''
+        if n_layers < 2:
+            raise ValueError('a settler needs at least 2 layers')
+        if not 0 <= feed_layer < n_layers:
+            raise ValueError('feed layer {} is not one of the {} layers'.format(feed_layer, n_layers))
+
+        self.area = float(area)
+        self.height = float(height)
+        self.n_layers = int(n_layers)
+        self.feed_layer = int(feed_layer)
+        self._v0_max = v0_max
+        self._v0 = v0
+        self._r_h = r_h
+        self._r_p = r_p
+        self._f_ns = f_ns
+        self._X_t = X_t
+
+        # layer thickness, m, and volume, m3
+        self._h = self.height / self.n_layers
+        self.layer_vol = self.area * self._h
+
+        # gravity fluxes above the feed layer are limited by the clarification threshold
+        self._clarifying = np.arange(self.n_layers - 1) < self.feed_layer
+
+        return None
+
+
+    def settling_velocity(self, X, X_min):
+        '''
+        Double-exponential settling velocity, m/d.
+
+        Args:
+            X:          X_TSS, mg/L (any shape; complex values are compared by their real part);
+            X_min:      non-settleable X_TSS, mg/L, broadcastable against X
+
+        Return:
+            numpy.ndarray of the shape of X
+
+        '''
+        dX = X - X_min
+        v = self._v0 * (np.exp(-self._r_h * dX) - np.exp(-self._r_p * dX))
+        v = np.where(v.real > self._v0_max, self._v0_max, v)
+
+        return np.where(v.real < 0.0, 0.0, v)
+
+
+    def settling_rates(self, layers, X_feed):
+        '''
+        dC/dt of each layer due to the gravity flux, vectorized over the layers
+        and any leading batch axes.
+
+        Args:
+            layers:     layer concentrations, mg/L, shape (..., n_layers, 24);
+            X_feed:     X_TSS of the settler feed, mg/L, shape (...)
+
+        Return:
+            numpy.ndarray of the shape of layers, mg/L/d
+
+        '''
+        X = layers[..., _TSS]
+        flux = self.settling_velocity(X, self._f_ns * np.asarray(X_feed)[..., None]) * X
+
+        # flux from each layer to the one below: the smaller of the two, except in the
+        # clarification zone while the layer below is under the threshold
+        up, lo = flux[..., :-1], flux[..., 1:]
+        J = np.where(lo.real < up.real, lo, up)
+        J = np.where(self._clarifying & (X[..., 1:].real <= self._X_t), up, J)
+
+        # split between the particulates as in the layer the sludge leaves
+        frac = layers[..., :-1, PARTICULATES] / np.where(X[..., :-1].real > 0.0, X[..., :-1], 1.0)[..., None]
+        moved = J[..., None] * frac / self._h
+
+        dCdt = np.zeros_like(layers)
+        dCdt[..., :-1, PARTICULATES] -= moved
+        dCdt[..., 1:, PARTICULATES] += moved
+
+        return dCdt
+
+
+class tanks_in_series(object):
+    '''
+    Completely mixed tanks in series sharing one ASM2d-N2O kinetic model.
+
+    The state is stacked tank-major, y[24 * k + i] is component i in tank k.
+    Kinetics of all tanks are evaluated in one batched call, and the
+    Jacobian is block-sparse: one 24x24 kinetic block per tank plus the
+    flow coupling between tanks.
+
+    With a settler, the last tank feeds it and its layers follow the tanks
+    in the stacked state, top to bottom. Its underflow returns to a tank
+    (return sludge) or is wasted, and its top layer is the effluent. The
+    settling terms of a layer only involve its neighbours, so the settler
+    block of the Jacobian is banded; it is taken by complex step with the
+    layers perturbed three at a time.
+
+    '''
+
+    def __init__(self, model, vols, flow, in_comps, recycles=(), feed_split=None,
+                 KLa=None, DO_setpoints=None, DO_sat_T=9.0, settler=None, RAS_flow=0.0, RAS_tank=0,
+                 waste_flow=0.0):
+        '''
+        Args:
+            model:          an ASM2d_N2O instance providing the kinetics;
+            vols:           tank volumes, m3 (n_tanks values);
+            flow:           influent flow rate, m3/d;
+            in_comps:       influent component concentrations, mg/L (24 values), or a callable
+                            of time returning them (e.g. influent.influent_reader);
+            recycles:       (from_tank, to_tank, flow) tuples, flow in m3/d;
+            feed_split:     fraction of the influent fed to each tank (default: all to tank 0);
+            KLa:            oxygen transfer coefficient of each tank, 1/d (default: model KLa; 0 for anoxic),
+                            also stripping the gases of ASM2d_N2O.set_stripping;
+            DO_setpoints:   fixed DO of each tank, mg/L, or None where DO is not fixed;
+            DO_sat_T:       saturation DO at the chosen temperature, mg/L;
+            settler:        optional takacs_settler fed by the last tank;
+            RAS_flow:       return sludge flow from the settler underflow, m3/d;
+            RAS_tank:       tank receiving the return sludge;
+            waste_flow:     waste sludge flow from the settler underflow, m3/d
+
+        Return:
+            None
+
+        '''
+        if settler is None and (RAS_flow or waste_flow):
+            raise ValueError('return and waste sludge flows need a settler')
+        if settler is not None and not 0 <= RAS_tank < len(vols):
+            raise ValueError('return sludge tank {} does not exist'.format(RAS_tank))
+
+        self._model = model
+        self._vols = np.array(vols, dtype=float)
+        self._n_tanks = n = len(self._vols)
+        self._flow = float(flow)
+        self._in_comps = in_comps if callable(in_comps) else np.array(in_comps, dtype=float)
+        self._recycles = [(int(i), int(j), float(q)) for i, j, q in recycles]
+        self._DO_sat_T = DO_sat_T
+        self._settler = settler
+        self._RAS = (int(RAS_tank), float(RAS_flow))
+        self._waste_flow = float(waste_flow)
+        self._n_layers = m = 0 if settler is None else settler.n_layers
+        self._n_nodes = n + m
+
+        if feed_split is None:
+            feed_split = np.zeros(n)
+            feed_split[0] = 1.0
+        self._feed_split = np.array(feed_split, dtype=float)
+
+        if KLa is None:
+            KLa = [model._KLa] * n
+        self._KLa = np.array(KLa, dtype=float)
+
+        # tanks with a fixed DO, and their setpoints
+        if DO_setpoints is None:
+            DO_setpoints = [None] * n
+        self._fixed_DO = np.flatnonzero([do is not None for do in DO_setpoints])
+        self._DO_set = np.array([0.0 if do is None else do for do in DO_setpoints])
+
+        self._set_flow_matrix()
+
+        # perturbed states for the complex-step kinetic blocks
+        self._cs_states = np.empty((n * 24, 24), dtype=complex)
+
+        # static sparsity pattern of the stacked Jacobian
+        blocks = [sparse.kron(sparse.eye(n), sparse.csr_matrix(model.get_jac_sparsity()))]
+        if settler is not None:
+            self._set_settler_pattern()
+            blocks.append(sparse.csr_matrix((np.ones(len(self._settle_rows)),
+                                             (self._settle_rows, self._settle_cols)), shape=(24 * m, 24 * m)))
+        self._jac_sparsity = (sparse.block_diag(blocks)
+                              + sparse.kron(sparse.csr_matrix(self._flow_mat != 0), sparse.eye(24))).tocsc()
+        if settler is not None:
+            self._jac_sparsity = self._jac_sparsity + self._feed_column(np.ones(len(self._feed_rows)))
+        self._jac_sparsity.data[:] = 1.0
+
+        return None
+
+
+    def _set_flow_matrix(self):
+        '''
+        Build the linear flow operator between tanks and settler layers, 1/d.
+
+        dC_k/dt (transport) == sum_j flow_mat[k, j] * C_j + feed_vec[k] * C_in
+
+        '''
+        n, m = self._n_tanks, self._n_layers
+        # inflow[k, j]: flow from tank (or layer) j into tank (or layer) k, m3/d
+        inflow = np.zeros((n + m, n + m))
+        outflow = np.zeros(n + m)
+        for i, j, q in self._recycles:
+            if not (0 <= i < n and 0 <= j < n):
+                raise ValueError('recycle ({}, {}) refers to a tank that does not exist'.format(i, j))
+            inflow[j, i] += q
+            outflow[i] += q
+
+        if m:
+            # return sludge from the bottom layer
+            RAS_tank, RAS_flow = self._RAS
+            inflow[RAS_tank, n + m - 1] += RAS_flow
+            outflow[n + m - 1] += RAS_flow
+
+        # forward flow from each tank to the next; the last one leaves as effluent
+        feed = self._flow * self._feed_split
+        for k in range(n):
+            # inflow[k] already holds the forward flow from tank k - 1
+            fwd = feed[k] + inflow[k].sum() - outflow[k]
+            if fwd < 0:
+                raise ValueError('recycles withdraw more than flows through tank {}'.format(k))
+            if k + 1 < n:
+                inflow[k + 1, k] += fwd
+            elif m:
+                inflow[n + self._settler.feed_layer, k] += fwd
+            outflow[k] += fwd
+
+        vols = self._vols
+        if m:
+            # up from the feed layer to the effluent, down to the underflow
+            f = self._settler.feed_layer
+            self._underflow = self._RAS[1] + self._waste_flow
+            self._effluent_flow = fwd - self._underflow
+            if self._effluent_flow < 0:
+                raise ValueError('return and waste sludge withdraw more than flows into the settler')
+            for j in range(f):
+                inflow[n + j, n + j + 1] += self._effluent_flow
+                outflow[n + j + 1] += self._effluent_flow
+            for j in range(f, m - 1):
+                inflow[n + j + 1, n + j] += self._underflow
+                outflow[n + j] += self._underflow
+            outflow[n] += self._effluent_flow
+            outflow[n + m - 1] += self._waste_flow
+            vols = np.concatenate([vols, np.full(m, self._settler.layer_vol)])
+
+        self._flow_mat = (inflow - np.diag(outflow)) / vols[:, None]
+        self._feed_vec = np.concatenate([feed, np.zeros(m)]) / vols
+
+        return None
+
+
+    def _set_settler_pattern(self):
+        '''
+        Index the banded settling block of the Jacobian and the complex-step
+        evaluations it is read from.
+
+        Settling terms of particulate i in a layer depend on particulate i and
+        X_TSS in the layer and its two neighbours, and on the X_TSS of the
+        feed. Layers three apart share an evaluation, so the block needs
+        3 * n_particulates + 1 of them whatever the number of layers.
+
+        '''
+        m = self._n_layers
+        part = np.flatnonzero(PARTICULATES)
+        n_part = len(part)
+        # position of each particulate among the particulates
+        slot = np.zeros(24, dtype=int)
+        slot[part] = np.arange(n_part)
+
+        pair = np.diag(PARTICULATES).astype(float)
+        pair[part, _TSS] = 1.0
+        band = sparse.diags([np.ones(m - 1), np.ones(m), np.ones(m - 1)], [-1, 0, 1])
+        pattern = sparse.kron(band, sparse.csr_matrix(pair)).tocoo()
+        self._settle_rows, self._settle_cols = pattern.row, pattern.col
+        self._settle_eval = (pattern.col // 24 % 3) * n_part + slot[pattern.col % 24]
+
+        # evaluation c * n_part + k perturbs particulate part[k] of the layers l with l % 3 == c
+        layer = np.arange(m)
+        evals, layers, comps = [], [], []
+        for c in range(3):
+            for k, p in enumerate(part):
+                sel = layer[layer % 3 == c]
+                evals.append(np.full(len(sel), c * n_part + k))
+                layers.append(sel)
+                comps.append(np.full(len(sel), p))
+        self._cs_index = (np.concatenate(evals), np.concatenate(layers), np.concatenate(comps))
+
+        # the last evaluation perturbs the feed X_TSS, seen by all particulates of all layers
+        self._feed_rows = (24 * layer[:, None] + part).ravel()
+        self._cs_layers = np.empty((3 * n_part + 1, m, 24), dtype=complex)
+        self._cs_feed = np.empty(3 * n_part + 1, dtype=complex)
+
+        return None
+
+
+    def _feed_column(self, vals):
+        '''
+        Jacobian entries of the settler layers with respect to the X_TSS of the last tank.
+
+        '''
+        size = 24 * self._n_nodes
+
+        return sparse.csc_matrix((vals, (24 * self._n_tanks + self._feed_rows,
+                                         np.full(len(vals), 24 * (self._n_tanks - 1) + _TSS))),
+                                 shape=(size, size))
+
+
+    def _forced_states(self, t, y):
+        '''
+        Apply the model forcing at time t and return the (n_tanks + n_layers, 24)
+        states seen by the kinetics, with fixed DO tanks at their setpoints.
+
+        '''
+        self._model._apply_forcing(t)
+
+        comps = y.reshape(self._n_nodes, 24)
+        if len(self._fixed_DO):
+            comps = comps.copy()
+            comps[self._fixed_DO, 0] = self._DO_set[self._fixed_DO]
+
+        return comps
+
+
+    def rhs(self, t, y):
+        '''
+        dC/dt of the stacked state.
+
+        Args:
+            t:      time, days;
+            y:      stacked concentrations, mg/L ((n_tanks + n_layers) * 24 values)
+
+        Return:
+            numpy.ndarray of shape ((n_tanks + n_layers) * 24,), mg/L/d
+
+        '''
+        n = self._n_tanks
+        comps = self._forced_states(t, y)
+        _, net_rates = self._model.batch_reaction_rate(comps[:n])
+
+        in_comps = self._in_comps(t) if callable(self._in_comps) else self._in_comps
+        dCdt = self._flow_mat @ comps + np.outer(self._feed_vec, in_comps)
+        dCdt[:n] += net_rates
+        dCdt[:n, 0] += self._KLa * (self._DO_sat_T - comps[:n, 0])
+        dCdt[self._fixed_DO, 0] = 0.0
+        dCdt[:n, self._model._strip_idx] -= self._model.stripping_rates(comps[:n], self._KLa)
+        if self._settler is not None:
+            dCdt[n:] += self._settler.settling_rates(comps[n:], comps[n - 1, _TSS])
+
+        return dCdt.ravel()
+
+
+    def jacobian(self, t, y):
+        '''
+        Block-sparse Jacobian of rhs with respect to the stacked state.
+
+        Args:
+            t:      time, days;
+            y:      stacked concentrations, mg/L ((n_tanks + n_layers) * 24 values)
+
+        Return:
+            scipy.sparse.csc_matrix of shape ((n_tanks + n_layers) * 24, (n_tanks + n_layers) * 24)
+
+        '''
+        n, m = self._n_tanks, self._n_layers
+        comps = self._forced_states(t, y)
+
+        # complex-step: rows 24 * k + j perturb component j of tank k
+        h = 1e-30
+        states = self._cs_states
+        states[:] = np.repeat(comps[:n], 24, axis=0)
+        states[np.arange(n * 24), np.tile(np.arange(24), n)] += 1j * h
+        _, net_rates = self._model.batch_reaction_rate(states)
+
+        blocks = net_rates.imag.reshape(n, 24, 24).transpose(0, 2, 1) / h
+        blocks[:, 0, 0] -= self._KLa
+        strip = self._model._strip_idx
+        blocks[:, strip, strip] -= np.outer(self._KLa, self._model._strip_ratio)
+        blocks = [sparse.block_diag(list(blocks))]
+
+        feed_column = None
+        if m:
+            # settling block, from evaluations of layers perturbed three apart
+            layers, feed = self._cs_layers, self._cs_feed
+            layers[:] = comps[n:]
+            layers[self._cs_index] += 1j * h
+            feed[:] = comps[n - 1, _TSS]
+            feed[-1] += 1j * h
+            d = self._settler.settling_rates(layers, feed).imag.reshape(len(feed), 24 * m) / h
+            blocks.append(sparse.csc_matrix((d[self._settle_eval, self._settle_rows],
+                                             (self._settle_rows, self._settle_cols)), shape=(24 * m, 24 * m)))
+            feed_column = self._feed_column(d[-1, self._feed_rows])
+
+        jac = (sparse.block_diag(blocks, format='csc')
+               + sparse.kron(sparse.csc_matrix(self._flow_mat), sparse.eye(24), format='csc'))
+        if feed_column is not None:
+            jac = jac + feed_column
+
+        # a fixed DO is constant and is also what flows on to other tanks
+        if len(self._fixed_DO):
+            keep = np.ones((n + m) * 24)
+            keep[24 * self._fixed_DO] = 0.0
+            keep = sparse.diags(keep)
+            jac = (keep @ jac @ keep).tocsc()
+
+        return jac
+
+
+    def sludge_age(self, comps):
+        '''
+        Sludge retention time of the tanks, days: their X_TSS mass over the X_TSS
+        mass leaving in the waste sludge and the effluent.
+
+        Args:
+            comps:  concentrations, mg/L, shape (..., n_tanks + n_layers, 24)
+
+        Return:
+            float, or numpy.ndarray of the leading shape of comps
+
+        '''
+        if self._settler is None:
+            raise ValueError('the sludge age is only defined with a settler')
+
+        comps = np.asarray(comps, dtype=float)
+        X = comps[..., _TSS]
+        mass = X[..., :self._n_tanks] @ self._vols
+        lost = self._waste_flow * X[..., -1] + self._effluent_flow * X[..., self._n_tanks]
+
+        return mass / lost
+
+
+    def get_jac_sparsity(self):
+        '''
+        Return a copy of the static sparsity pattern of the stacked Jacobian.
+
+        '''
+        return self._jac_sparsity.copy()
+
+
+    def simulate(self, init_comps, t_end, t_eval=None, t_start=0.0, dense_output=False,
+                 method='BDF', rtol=RTOL, atol=ATOL, emissions=False):
+        '''
+        Integrate the flowsheet from t_start to t_end.
+
+        With emissions, the masses of the stripped gases sent to the gas
+        phase by all tanks, the sum of vol * stripping rate, are appended to
+        the stacked state as integrals from t_start (see simulation.simulate).
+
+        Args:
+            init_comps:     initial concentrations, mg/L, shape (n_tanks + n_layers, 24) or (24,) for
+                            all tanks and layers;
+            t_end:          end of the time horizon, days;
+            t_eval:         output times, days (default: t_start and t_end only);
+            t_start:        start of the time horizon, days;
+            dense_output:   whether to keep a continuous interpolant in the result;
+            method:         stiff solver passed to scipy solve_ivp ('BDF' or 'Radau');
+            rtol:           relative tolerance;
+            atol:           absolute tolerance, mg/L;
+            emissions:      whether to integrate the cumulative emissions of the stripped gases
+
+        Return:
+            sim_result, with comps of shape (len(t), n_tanks + n_layers, 24)
+
+        '''
+        size = 24 * self._n_nodes
+        y0 = np.broadcast_to(np.asarray(init_comps, dtype=float), (self._n_nodes, 24)).ravel()
+        if t_eval is None:
+            t_eval = np.array([t_start, t_end], dtype=float)
+
+        rhs, jac = self.rhs, self.jacobian
+        if emissions:
+            rhs, jac, y0 = _with_emissions(self._model, rhs, jac, y0, self._vols, self._KLa)
+
+        res = solve_ivp(rhs, (t_start, t_end), y0, method=method, t_eval=t_eval,
+                        dense_output=dense_output, jac=jac, rtol=rtol, atol=atol)
+
+        # solve_ivp leaves y a list when it fails before the first output time
+        y = np.reshape(res.y, (len(y0), -1)).T
+
+        return sim_result(res.t, y[:, :size].reshape(-1, self._n_nodes, 24), res.sol, res.nfev,
+                          res.njev, res.nlu, res.success, res.message, _emissions(y, size))
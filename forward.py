@@ -0,0 +1,302 @@
+"""
+    Forward parameter sensitivities of the ASM2d-N2O reactor model.
+
+    -   forward_sensitivity(): integrate the single-CSTR mass balance (ASM2d_N2O._dCdt) together with
+        the sensitivities of all components to chosen 20C kinetic constants, dC/dp, with a linearly
+        implicit Rosenbrock (W-) method whose LU factorization is shared by states and sensitivities.
+
+    Reference:
+        Massara, T.M., Solís, B., Guisasola, A., Katsou, E. and Baeza, J.A., 2018.
+        Development of an ASM2d-N2O model to describe nitrous oxide emissions in municipal WWTPs under dynamic conditions.
+        Chemical Engineering Journal, 335, pp.185-196.
+        (https://doi.org/10.1016/j.cej.2017.10.119)
+
+        Shampine, L.F. and Reichelt, M.W., 1997. The MATLAB ODE suite.
+        SIAM Journal on Scientific Computing, 18(1), pp.1-22.
+"""
+
+
+import numpy as np
+from scipy.linalg import lu_factor, lu_solve
+
+from .simulation import RTOL, ATOL
+
+
+# coefficients of the Rosenbrock (2,3) pair of Shampine & Reichelt (ode23s)
+_D = 1.0 / (2.0 + np.sqrt(2.0))
+_E32 = 6.0 + np.sqrt(2.0)
+
+# complex step of the directional derivatives
+_H_CS = 1e-30
+
+# a stale Jacobian is refreshed when the step size has changed by more than this factor
+# since its evaluation, when the scaled error of the last step exceeded _JAC_ERR (the stale
+# J then starts to limit the step size), or after _JAC_AGE accepted steps
+_JAC_H_RATIO = 5.0
+_JAC_ERR = 0.8
+_JAC_AGE = 5
+
+# step size growth too small to be worth a new LU factorization
+_HOLD_H_FACTOR = 1.2
+
+
+class sens_result(object):
+    '''
+    Result of a simulation with forward sensitivities.
+
+    '''
+
+    def __init__(self, t, comps, sens, names, nfev, njev, nlu, success, message):
+        '''
+        Args:
+            t:          output times, days;
+            comps:      component concentrations at t, mg/L, shape (len(t), 24);
+            sens:       sensitivities d(comps)/d(20C constant) at t, shape (len(t), 24, len(names)),
+                        followed by any extra columns of init_sens;
+            names:      the kinetic constants of the sensitivities;
+            nfev:       number of evaluations of dC/dt (with the sensitivity right-hand sides);
+            njev:       number of Jacobian evaluations;
+            nlu:        number of LU decompositions;
+            success:    whether the integration reached the end of the horizon;
+            message:    status message
+
+        Return:
+            None
+
+        '''
+        self.t = t
+        self.comps = comps
+        self.sens = sens
+        self.names = names
+        self.nfev = nfev
+        self.njev = njev
+        self.nlu = nlu
+        self.success = success
+        self.message = message
+
+        return None
+
+
+    def final(self):
+        '''
+        Return copies of the components and sensitivities at the last output time.
+
+        '''
+        return self.comps[-1].copy(), self.sens[-1].copy()
+
+
+def _param_directions(model, names):
+    '''
+    Derivatives of the parameters at the project temperature with respect to
+    the 20C constants names, shape (len(names), n_params).
+
+    '''
+    dirs = np.zeros((len(names), len(model._param_names)))
+    for j, name in enumerate(names):
+        i = model._param_index[name]
+        dirs[j, i] = np.exp(model._log_theta[i] * model._delta_t)
+
+    return dirs
+
+
+def forward_sensitivity(model, names, init_comps, in_comps, t_end, vol, flow, fix_DO=False, DO_sat_T=9.0,
+                        t_eval=None, t_start=0.0, rtol=RTOL, atol=ATOL, init_sens=None, first_step=None,
+                        max_step=np.inf):
+    '''
+    Integrate a single CSTR and the sensitivities of its components to 20C kinetic constants.
+
+    The sensitivity S_j = dC/dp_j obeys dS_j/dt = J S_j + df/dp_j. Its
+    right-hand side is the directional derivative of dC/dt along
+    (S_j, e_j), evaluated for all j at once by complex-step through the
+    batched rate kernel, with the parameters and the stoichiometry
+    perturbed with p_j. States and sensitivities are advanced together by
+    the Rosenbrock (2,3) pair of ode23s; it is a W-method, so the one LU
+    factorization of W = I - h d J per step serves the state and all
+    sensitivity columns, and J (the complex-step model.jacobian) may be
+    stale: it is evaluated again when the error test fails with an old J,
+    when the last step error was large, after a few steps, or when the step
+    size has changed by more than a factor _JAC_H_RATIO since, and the
+    factorization is kept while h is. Step sizes are controlled on the
+    states.
+    Columns of init_sens beyond names are carried along as sensitivities
+    to the initial state, without a parameter term.
+
+    Args:
+        model:          an ASM2d_N2O instance;
+        names:          20C kinetic constants to differentiate with respect to;
+        init_comps:     initial component concentrations, mg/L (24 values);
+        in_comps:       influent component concentrations, mg/L (24 values), or a callable of time;
+        t_end:          end of the time horizon, days;
+        vol:            reactor volume, m3;
+        flow:           influent flow rate, m3/d;
+        fix_DO:         whether to fix the DO concentration;
+        DO_sat_T:       saturation DO at the chosen temperature, mg/L;
+        t_eval:         output times, days (default: t_start and t_end only);
+        t_start:        start of the time horizon, days;
+        rtol:           relative tolerance;
+        atol:           absolute tolerance, mg/L;
+        init_sens:      initial sensitivities, shape (24, len(names) + n_extra) (default: zero);
+                        the n_extra trailing columns follow dS/dt = J S only, e.g. the identity
+                        matrix for the sensitivities to the initial components;
+        first_step:     initial step size, days (default: estimated);
+        max_step:       maximum step size, days
+
+    Return:
+        sens_result
+
+    '''
+    names = list(names)
+    for name in names:
+        if name not in model._param_index:
+            raise ValueError('unknown kinetic constant: {}'.format(name))
+    # columns past len(names) are sensitivities to the initial state, with no parameter direction
+    n_sens = len(names) if init_sens is None else np.shape(init_sens)[1]
+    if n_sens < len(names):
+        raise ValueError('init_sens needs a column for each kinetic constant')
+
+    inf = in_comps if callable(in_comps) else np.array(in_comps, dtype=float)
+    if t_eval is None:
+        t_eval = np.array([t_start, t_end], dtype=float)
+    t_eval = np.asarray(t_eval, dtype=float)
+    time_dependent = (callable(in_comps) or model._temp_forcing is not None
+                      or model._DO_forcing is not None or model._pH_forcing is not None)
+
+    # perturbed parameters and stoichiometric matrices, kept until the temperature changes
+    perturbed = [None, None, None]
+
+    def _perturbed():
+        if perturbed[0] != model._temperature:
+            dirs = np.zeros((n_sens, len(model._param_names)))
+            dirs[:len(names)] = _param_directions(model, names)
+            params = model._param_vals + 1j * _H_CS * dirs
+            perturbed[:] = [model._temperature, params, model.batch_stoich_mat(params)]
+        return perturbed[1], perturbed[2]
+
+    def _fun(t, z):
+        # z[:, 0] is the state, z[:, 1:] the sensitivities
+        out = np.empty_like(z)
+        y = z[:, 0]
+        out[:, 0] = model._dCdt(t, y, vol, flow, inf, fix_DO, DO_sat_T)
+
+        comps = np.asarray(model._forced_comps(t, y, fix_DO), dtype=float)
+        states = comps[None, :] + 1j * _H_CS * z[:, 1:].T
+        if fix_DO and model._DO_forcing is not None:
+            states[:, 0] = comps[0]
+        params, stoich_mat = _perturbed()
+        _, net_rates = model.batch_reaction_rate(states, params=params, stoich_mat=stoich_mat)
+
+        dS = net_rates.imag.T / _H_CS - z[:, 1:] * (flow / vol)
+        if fix_DO or model._bulk_DO == 0:
+            dS[0] = 0.0
+        else:
+            dS[0] -= model._KLa * z[0, 1:]
+        strip = model._strip_idx
+        dS[strip] -= (model._aeration_KLa() * model._strip_ratio)[:, None] * z[strip, 1:]
+        out[:, 1:] = dS
+
+        return out
+
+    z = np.zeros((24, 1 + n_sens))
+    z[:, 0] = init_comps
+    if init_sens is not None:
+        z[:, 1:] = init_sens
+
+    eye = np.eye(24)
+    jac_buf = np.empty((24, 24))
+    nfev = njev = nlu = 0
+
+    t = float(t_start)
+    f0 = _fun(t, z)
+    nfev += 1
+
+    # initial step from the scaled size of the state and of its derivative
+    if first_step is None:
+        scale = atol + rtol * np.abs(z[:, 0])
+        d0, d1 = np.max(np.abs(z[:, 0]) / scale), np.max(np.abs(f0[:, 0]) / scale)
+        first_step = 1e-6 if d0 < 1e-5 or d1 < 1e-5 else 0.01 * d0 / d1
+    h = min(first_step, max_step, t_end - t)
+
+    out_t, out_z = [], []
+    i_out = int(np.searchsorted(t_eval, t, side='right'))
+    if i_out > 0:
+        out_t.append(t_eval[:i_out])
+        out_z.append(np.repeat(z[None], i_out, axis=0))
+
+    def _jacobian(t, z, f0):
+        # J and, for a non-autonomous system, df/dt at the start of the step
+        jac = model.jacobian(t, z[:, 0], vol, flow, inf, fix_DO, DO_sat_T, out=jac_buf)
+        if not time_dependent:
+            return jac, 0.0, 0
+        dt = np.sqrt(np.finfo(float).eps) * max(abs(t), 1.0)
+        return jac, (_fun(t + dt, z) - f0) / dt, 1
+
+    jac = lu = None
+    err_prev, age = 0.0, 0
+    # step sizes of the last Jacobian evaluation and LU factorization
+    h_jac = h_lu = None
+
+    success, message = True, 'The solver successfully reached the end of the integration interval.'
+    while t < t_end:
+        h = min(h, max_step, t_end - t)
+        fresh = (jac is None or not 1.0 / _JAC_H_RATIO <= h / h_jac <= _JAC_H_RATIO
+                 or err_prev > _JAC_ERR or age >= _JAC_AGE)
+        if fresh:
+            jac, tdot, n = _jacobian(t, z, f0)
+            njev += 1
+            nfev += n
+            h_jac, lu, age = h, None, 0
+
+        ## Rosenbrock (2,3) step, retried with a smaller h until the error test passes
+        while True:
+            h = min(h, max_step, t_end - t)
+            if lu is None or h != h_lu:
+                lu = lu_factor(eye - h * _D * jac)
+                h_lu = h
+                nlu += 1
+
+            k1 = lu_solve(lu, f0 + h * _D * tdot)
+            f1 = _fun(t + 0.5 * h, z + 0.5 * h * k1)
+            k2 = lu_solve(lu, f1 - k1) + k1
+            z_new = z + h * k2
+            f2 = _fun(t + h, z_new)
+            k3 = lu_solve(lu, f2 - _E32 * (k2 - f1) - 2.0 * (k1 - f0) + h * _D * tdot)
+            nfev += 2
+
+            scale = atol + rtol * np.maximum(np.abs(z[:, 0]), np.abs(z_new[:, 0]))
+            err = np.max(np.abs(h / 6.0 * (k1[:, 0] - 2.0 * k2[:, 0] + k3[:, 0])) / scale)
+            if np.isfinite(err) and err <= 1.0:
+                break
+            if not fresh:
+                # the failure may be the stale Jacobian's
+                jac, tdot, n = _jacobian(t, z, f0)
+                njev += 1
+                nfev += n
+                fresh, lu = True, None
+            h *= 0.2 if not np.isfinite(err) else max(0.2, 0.8 * err ** (-1.0 / 3.0))
+            h_jac = h
+            if h < 1e-14 * max(abs(t), 1.0):
+                success, message = False, 'Required step size is less than spacing between numbers.'
+                break
+        if not success:
+            break
+
+        ## Outputs passed by the step, by cubic Hermite interpolation
+        j_out = int(np.searchsorted(t_eval, t + h, side='right'))
+        if j_out > i_out:
+            theta = ((t_eval[i_out:j_out] - t) / h)[:, None, None]
+            out_t.append(t_eval[i_out:j_out])
+            out_z.append((2 * theta ** 3 - 3 * theta ** 2 + 1) * z + (theta ** 3 - 2 * theta ** 2 + theta) * h * f0
+                         + (3 * theta ** 2 - 2 * theta ** 3) * z_new + (theta ** 3 - theta ** 2) * h * f2)
+            i_out = j_out
+
+        t, z, f0 = t + h, z_new, f2
+        err_prev, age = err, age + 1
+        factor = 5.0 if err == 0 else min(5.0, 0.8 * err ** (-1.0 / 3.0))
+        # a small growth keeps h, and with it the LU factorization
+        if not 1.0 <= factor <= _HOLD_H_FACTOR:
+            h *= factor
+
+    out_t = np.concatenate(out_t) if out_t else np.zeros(0)
+    out_z = np.concatenate(out_z) if out_z else np.zeros((0, 24, 1 + n_sens))
+
+    return sens_result(out_t, out_z[:, :, 0], out_z[:, :, 1:], names, nfev, njev, nlu, success, message)
@@ -0,0 +1,267 @@
+"""
+    Influent time series for the ASM2d-N2O reactor model.
+
+    -   influent_reader: stream a long influent log (CSV, or a memory-mapped .npy array) and return
+        linearly interpolated influent concentrations at arbitrary solver times, keeping only a
+        sliding window of rows in memory. Instances are callables of time, so they can be passed
+        as in_comps to ASM2d_N2O._dCdt, simulation.simulate() and flowsheet.tanks_in_series.
+    -   csv_to_npy(): convert a CSV influent log to the .npy layout read with memory mapping.
+
+    Reference:
+        Massara, T.M., Solís, B., Guisasola, A., Katsou, E. and Baeza, J.A., 2018.
+        Development of an ASM2d-N2O model to describe nitrous oxide emissions in municipal WWTPs under dynamic conditions.
+        Chemical Engineering Journal, 335, pp.185-196.
+        (https://doi.org/10.1016/j.cej.2017.10.119)
+"""
+
+
+import numpy as np
+
+from .ASM2d_N2O import COMP_NAMES
+
+
+# default number of CSV rows read at a time
+CHUNK_ROWS = 10000
+
+
+def _csv_columns(header, delimiter, time_col, comp_cols):
+    '''
+    Return the column positions of time and of the components in a CSV header line.
+
+    '''
+    names = [name.strip() for name in header.split(delimiter)]
+    missing = [name for name in [time_col] + list(comp_cols) if name not in names]
+    if missing:
+        raise ValueError('influent file has no column(s): {}'.format(', '.join(missing)))
+
+    return [names.index(time_col)] + [names.index(name) for name in comp_cols]
+
+
+class influent_reader(object):
+    '''
+    Interpolated influent concentrations from a streamed time series.
+
+    The file holds one row per sample: time (days) and the concentrations
+    of the 24 model components (mg/L), with times increasing. CSV files
+    need a header naming the columns and are read in chunks of chunk_rows
+    rows; two consecutive chunks are kept in memory and the window slides
+    forward as the solver advances (and back, by seeking, if it is
+    restarted earlier). A .npy file must hold an (n_rows, 25) float array
+    with time in column 0; it is memory-mapped and only the time column is
+    read into memory.
+
+    Outside the time range of the file, the first or last row is used.
+    Readers are pickled by their arguments and reopen the file, so they can
+    be sent to worker processes.
+
+    '''
+
+    def __init__(self, path, time_col='t', comp_cols=COMP_NAMES, chunk_rows=CHUNK_ROWS, delimiter=','):
+        '''
+        Args:
+            path:           CSV or .npy influent file;
+            time_col:       CSV column name of the time, days;
+            comp_cols:      CSV column names of the 24 components, in model order;
+            chunk_rows:     number of CSV rows read at a time;
+            delimiter:      CSV field delimiter
+
+        Return:
+            None
+
+        '''
+        if len(comp_cols) != 24:
+            raise ValueError('comp_cols must name the 24 model components')
+        if chunk_rows < 2:
+            raise ValueError('chunk_rows must be at least 2')
+
+        # constructor arguments, to reopen the file when unpickled in another process
+        self._args = (path, time_col, tuple(comp_cols), chunk_rows, delimiter)
+
+        self._path = path
+        self._chunk_rows = int(chunk_rows)
+        self._delimiter = delimiter
+        self._file = None
+
+        if str(path).endswith('.npy'):
+            self._data = np.load(path, mmap_mode='r')
+            if self._data.ndim != 2 or self._data.shape[1] != 25:
+                raise ValueError('a .npy influent file must have shape (n_rows, 25)')
+            self._times = np.array(self._data[:, 0])
+            self._vals = self._data[:, 1:]
+            return None
+
+        self._data = None
+        self._file = open(path, 'rb')
+        self._usecols = _csv_columns(self._file.readline().decode(), delimiter, time_col, comp_cols)
+
+        # byte offset of the first row of each chunk read so far, and the
+        # number of chunks once the end of the file has been reached
+        self._offsets = [self._file.tell()]
+        self._n_chunks = None
+
+        # first chunk of the window, and the window rows
+        self._win = None
+        self._times = np.zeros(0)
+        self._vals = np.zeros((0, 24))
+        self._set_window(0)
+        if len(self._times) == 0:
+            raise ValueError('influent file has no data rows')
+
+        return None
+
+
+    def __call__(self, t, out=None):
+        '''
+        Influent concentrations at time t.
+
+        Args:
+            t:      time, days;
+            out:    optional (24,) float array to write the result into
+
+        Return:
+            numpy.ndarray of shape (24,), mg/L
+
+        '''
+        if self._file is not None:
+            self._slide(t)
+
+        times, vals = self._times, self._vals
+        if out is None:
+            out = np.empty(24)
+
+        i = int(np.searchsorted(times, t, side='right'))
+        if i == 0:
+            out[:] = vals[0]
+        elif i == len(times):
+            out[:] = vals[-1]
+        else:
+            # linear interpolation between rows i - 1 and i
+            w = (t - times[i - 1]) / (times[i] - times[i - 1])
+            np.subtract(vals[i], vals[i - 1], out=out)
+            out *= w
+            out += vals[i - 1]
+
+        return out
+
+
+    def __reduce__(self):
+        return (influent_reader, self._args)
+
+
+    def time_range(self):
+        '''
+        Return the (first, last) time of the series read so far, days.
+
+        '''
+        return self._times[0], self._times[-1]
+
+
+    def close(self):
+        '''
+        Close the underlying CSV file, if any.
+
+        '''
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+        return None
+
+
+    def _read_chunk(self, k):
+        '''
+        Read CSV chunk k; return an (n_rows, 25) array, or None past the end of the file.
+
+        '''
+        if k >= len(self._offsets):
+            return None
+
+        self._file.seek(self._offsets[k])
+        lines = []
+        while len(lines) < self._chunk_rows:
+            line = self._file.readline()
+            if not line:
+                break
+            if line.strip():
+                lines.append(line.decode())
+
+        if k + 1 == len(self._offsets):
+            if len(lines) < self._chunk_rows:
+                self._n_chunks = k + 1 if lines else k
+            else:
+                self._offsets.append(self._file.tell())
+
+        if not lines:
+            return None
+
+        return np.loadtxt(lines, delimiter=self._delimiter, usecols=self._usecols, ndmin=2)
+
+
+    def _set_window(self, k):
+        '''
+        Load CSV chunks k and k + 1 as the window.
+
+        '''
+        chunks = [chunk for chunk in (self._read_chunk(k), self._read_chunk(k + 1)) if chunk is not None]
+        if chunks:
+            data = np.vstack(chunks)
+            self._times = np.ascontiguousarray(data[:, 0])
+            self._vals = np.ascontiguousarray(data[:, 1:])
+        self._win = k
+
+        return None
+
+
+    def _slide(self, t):
+        '''
+        Move the CSV window until it brackets t, or reaches an end of the file.
+
+        '''
+        # forward, one chunk at a time
+        while t > self._times[-1] and (self._n_chunks is None or self._win + 2 < self._n_chunks):
+            self._set_window(self._win + 1)
+        # back, e.g. when a simulation is restarted earlier
+        while t < self._times[0] and self._win > 0:
+            self._set_window(self._win - 1)
+
+        return None
+
+
+def csv_to_npy(src, dst, time_col='t', comp_cols=COMP_NAMES, chunk_rows=CHUNK_ROWS, delimiter=','):
+    '''
+    Convert a CSV influent log to an (n_rows, 25) .npy file, chunk by chunk.
+
+    Args:
+        src:            CSV influent file with a header line;
+        dst:            .npy file to write;
+        time_col:       column name of the time, days;
+        comp_cols:      column names of the 24 components, in model order;
+        chunk_rows:     number of rows converted at a time;
+        delimiter:      CSV field delimiter
+
+    Return:
+        number of rows written
+
+    '''
+    with open(src, 'rb') as f:
+        usecols = _csv_columns(f.readline().decode(), delimiter, time_col, comp_cols)
+        n_rows = sum(1 for line in f if line.strip())
+
+    out = np.lib.format.open_memmap(dst, mode='w+', dtype=np.float64, shape=(n_rows, 25))
+    with open(src, 'rb') as f:
+        f.readline()
+        row = 0
+        lines = []
+        for line in f:
+            if line.strip():
+                lines.append(line.decode())
+            if len(lines) == chunk_rows:
+                out[row:row + len(lines)] = np.loadtxt(lines, delimiter=delimiter, usecols=usecols, ndmin=2)
+                row += len(lines)
+                lines = []
+        if lines:
+            out[row:row + len(lines)] = np.loadtxt(lines, delimiter=delimiter, usecols=usecols, ndmin=2)
+    out.flush()
+    del out
+
+    return n_rows
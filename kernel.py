@@ -0,0 +1,446 @@
+"""
+    Code generation of flat kinetic kernels for ASM models.
+
+    -   kernel_source(): emit the Python source of straight-line functions that evaluate the
+        Monod/inhibition terms, process rates and net component rates of a declarative kinetic
+        table, with every component, parameter and intermediate term bound to a local variable,
+        and their reverse-mode derivative (weighted rate gradients for all components and
+        parameters in one pass).
+    -   load_kernel(): generate such a kernel once, cache it on disk keyed by a hash of the model
+        definition, import it, and optionally compile it with numba.
+
+    Reference:
+        Massara, T.M., Solís, B., Guisasola, A., Katsou, E. and Baeza, J.A., 2018.
+        Development of an ASM2d-N2O model to describe nitrous oxide emissions in municipal WWTPs under dynamic conditions.
+        Chemical Engineering Journal, 335, pp.185-196.
+        (https://doi.org/10.1016/j.cej.2017.10.119)
+"""
+
+
+import ast
+import hashlib
+import importlib.util
+import os
+import re
+import sys
+import tempfile
+import types
+
+
+# bump whenever the emitted source changes, so stale cached kernels are not reused
+GENERATOR_VERSION = 2
+
+# environment variable overriding the kernel cache directory
+CACHE_ENV = 'ASM2D_N2O_CACHE'
+
+# kernels already loaded in this process, keyed by (definition hash, use_numba)
+_loaded = {}
+
+_NAME_RE = re.compile(r'\b[A-Za-z_]\w*')
+
+# binary operators of the rate expressions that rates_vjp can differentiate
+_BIN_OPS = {ast.Add: '+', ast.Sub: '-', ast.Mult: '*', ast.Div: '/', ast.Pow: '**'}
+
+
+class kinetic_kernel(object):
+    '''
+    Generated kinetic functions of one model definition.
+
+    rates(comps, params, fna_factor, out):
+        process rates into out[0..n_procs-1]; the entries of comps may be
+        floats, complex numbers or equally shaped NumPy arrays (component
+        rows of a batch), so the same function serves the scalar, batched
+        and complex-step paths.
+
+    net_rates(comps, params, stoichs, fna_factor, rates, out):
+        process rates into rates and net component rates into out, with the
+        stoichiometric sums unrolled over the nonzero entries; stoichs holds
+        the stoichiometric values in the order of the stoich_keys the kernel
+        was generated with.
+
+    rates_vjp(comps, params, fna_factor, weights, comps_bar, params_bar):
+        sum over processes of weights[k] times the gradient of rate k with
+        respect to the components into comps_bar and to the parameters into
+        params_bar, by reverse-mode differentiation at the cost of a few
+        rate evaluations; None if an expression cannot be differentiated.
+
+    '''
+
+    def __init__(self, digest, source, path, rates, net_rates, rates_vjp, compiled):
+        '''
+        Args:
+            digest:     hash of the model definition and generator version;
+            source:     generated Python source;
+            path:       cached source file, or None if the cache was not writable;
+            rates:      process rate function;
+            net_rates:  process and net component rate function;
+            rates_vjp:  weighted rate gradient function, or None;
+            compiled:   whether the functions are numba-compiled
+
+        Return:
+            None
+
+        '''
+        self.digest = digest
+        self.source = source
+        self.path = path
+        self.rates = rates
+        self.net_rates = net_rates
+        self.rates_vjp = rates_vjp
+        self.compiled = compiled
+
+        return None
+
+
+def _names(expr):
+    '''
+    Return the identifiers used in an expression.
+
+    '''
+    return _NAME_RE.findall(expr)
+
+
+def _check_names(expr, known, where):
+    '''
+    Raise ValueError if expr uses an identifier that is not defined yet.
+
+    '''
+    unknown = sorted(set(_names(expr)) - known)
+    if unknown:
+        raise ValueError('{} uses undefined names: {}'.format(where, ', '.join(unknown)))
+
+    return None
+
+
+def _split_key(key):
+    '''
+    Return the 0-based (process, component) of a stoichiometric key 'x_y'.
+
+    '''
+    proc, comp = key.split('_')
+
+    return int(proc) - 1, int(comp) - 1
+
+
+def _is_number(expr):
+    '''
+    Return True if expr is a numeric literal.
+
+    '''
+    try:
+        float(expr)
+    except ValueError:
+        return False
+
+    return True
+
+
+def kernel_source(comp_names, param_names, aux_terms, monod_terms, rate_exprs, stoich_keys):
+    '''
+    Generate the source of the flat kinetic functions of a model.
+
+    Args:
+        comp_names:     component names, in state vector order;
+        param_names:    parameter names, in parameter array order;
+        aux_terms:      (name, expression) pairs evaluated before the Monod terms;
+        monod_terms:    (term in numerator & denominator, term only in denominator) expression
+                        pairs; term i is available to later expressions as m<i>;
+        rate_exprs:     one process rate expression per process;
+        stoich_keys:    stoichiometric keys 'x_y' (process x, component y, 1-based)
+
+    Return:
+        str, the source of a module defining rates(), net_rates() and rates_vjp()
+
+    '''
+    n_comps = len(comp_names)
+    n_procs = len(rate_exprs)
+
+    ## Validate the tables, so errors point at the definition and not at generated code
+    known = set(comp_names) | set(param_names) | {'fna_factor'}
+    if len(known) != n_comps + len(param_names) + 1:
+        raise ValueError('component and parameter names must be unique')
+    for name, expr in aux_terms:
+        _check_names(expr, known, 'auxiliary term ' + name)
+        known.add(name)
+    for i, (num, den) in enumerate(monod_terms):
+        _check_names(num, known, 'Monod term m{}'.format(i))
+        _check_names(den, known, 'Monod term m{}'.format(i))
+        known.add('m{}'.format(i))
+    for i, expr in enumerate(rate_exprs):
+        _check_names(expr, known, 'rate expression {}'.format(i))
+
+    # (column, [(position in stoichs, process)]) for every component with a stoichiometric entry
+    by_comp = [[] for _ in range(n_comps)]
+    for pos, key in enumerate(stoich_keys):
+        proc, comp = _split_key(key)
+        if not (0 <= proc < n_procs and 0 <= comp < n_comps):
+            raise ValueError('stoichiometric key {} is out of range'.format(key))
+        by_comp[comp].append((pos, proc))
+
+    ## Only bind the components and parameters that are actually used
+    used = set()
+    for _, expr in aux_terms:
+        used.update(_names(expr))
+    for num, den in monod_terms:
+        used.update(_names(num))
+        used.update(_names(den))
+    for expr in rate_exprs:
+        used.update(_names(expr))
+
+    binds = []
+    for i, name in enumerate(comp_names):
+        if name in used:
+            binds.append('{} = comps[{}]'.format(name, i))
+    for i, name in enumerate(param_names):
+        if name in used:
+            binds.append('{} = params[{}]'.format(name, i))
+
+    # (name, expression) of the intermediate terms, in evaluation order
+    assigns = list(aux_terms)
+    for i, (num, den) in enumerate(monod_terms):
+        if not num.isidentifier():
+            assigns.append(('n{}'.format(i), num))
+            num = 'n{}'.format(i)
+        if not (den.isidentifier() or _is_number(den)):
+            den = '({})'.format(den)
+        assigns.append(('m{}'.format(i), '{0} / ({0} + {1})'.format(num, den)))
+    body = binds + ['{} = {}'.format(name, expr) for name, expr in assigns]
+
+    lines = ['# Generated by kernel.py (generator version {}). Do not edit.'.format(GENERATOR_VERSION),
+             '',
+             '',
+             'def rates(comps, params, fna_factor, out):']
+    lines += ['    ' + line for line in body]
+    lines += ['    out[{}] = {}'.format(k, expr) for k, expr in enumerate(rate_exprs)]
+    lines += ['    return out',
+              '',
+              '',
+              'def net_rates(comps, params, stoichs, fna_factor, rates, out):']
+    lines += ['    ' + line for line in body]
+    lines += ['    r{} = {}'.format(k, expr) for k, expr in enumerate(rate_exprs)]
+    lines += ['    rates[{0}] = r{0}'.format(k) for k in range(n_procs)]
+    for i, terms in enumerate(by_comp):
+        if terms:
+            net = ' + '.join('stoichs[{}] * r{}'.format(pos, proc) for pos, proc in terms)
+        else:
+            net = '0.0'
+        lines.append('    out[{}] = {}'.format(i, net))
+    lines += ['    return out',
+              '',
+              '']
+    try:
+        lines += _vjp_lines(comp_names, param_names, binds, assigns, rate_exprs)
+    except NotImplementedError:
+        lines += ['rates_vjp = None', '']
+
+    return '\n'.join(lines)
+
+
+def _lower(expr, code):
+    '''
+    Append the three-address form of expr to code as (target, op, operands)
+    tuples and return the operand holding its value.
+
+    '''
+    def visit(node):
+        if isinstance(node, ast.Name):
+            return node.id
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+            return repr(float(node.value))
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.UAdd):
+            return visit(node.operand)
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            op, args = 'neg', (visit(node.operand),)
+        elif isinstance(node, ast.BinOp) and type(node.op) in _BIN_OPS:
+            op, args = _BIN_OPS[type(node.op)], (visit(node.left), visit(node.right))
+            if op == '**' and not _is_number(args[1]):
+                raise NotImplementedError('only constant exponents are differentiated')
+        else:
+            raise NotImplementedError('cannot differentiate {}'.format(ast.dump(node)))
+        target = '_t{}'.format(len(code))
+        code.append((target, op, args))
+        return target
+
+    return visit(ast.parse(expr.strip(), mode='eval').body)
+
+
+def _vjp_lines(comp_names, param_names, binds, assigns, rate_exprs):
+    '''
+    Return the source lines of rates_vjp(), the reverse-mode derivative of the process rates.
+
+    The intermediate terms and rates are lowered to three-address code and
+    evaluated forward; the adjoints b_<name> are then accumulated backward
+    through it, starting from b_r<k> = weights[k]. Raise NotImplementedError
+    if an expression uses an operation without a derivative rule.
+
+    '''
+    code = []
+    for name, expr in list(assigns) + [('r{}'.format(k), expr) for k, expr in enumerate(rate_exprs)]:
+        operand = _lower(expr, code)
+        if operand.startswith('_t') and operand == code[-1][0]:
+            code[-1] = (name, code[-1][1], code[-1][2])
+        else:
+            code.append((name, 'copy', (operand,)))
+
+    forward = []
+    for target, op, args in code:
+        if op == 'neg':
+            forward.append('{} = -{}'.format(target, args[0]))
+        elif op == 'copy':
+            forward.append('{} = {}'.format(target, args[0]))
+        else:
+            forward.append('{} = {} {} {}'.format(target, args[0], op, args[1]))
+
+    ## Reverse sweep; an adjoint is created by its first contribution
+    backward = ['b_r{0} = weights[{0}]'.format(k) for k in range(len(rate_exprs))]
+    defined = set('r{}'.format(k) for k in range(len(rate_exprs)))
+
+    def accumulate(name, term):
+        if _is_number(name) or name == 'fna_factor':
+            return
+        if name in defined:
+            backward.append('b_{0} = b_{0} + {1}'.format(name, term))
+        else:
+            backward.append('b_{} = {}'.format(name, term))
+            defined.add(name)
+
+    for target, op, args in reversed(code):
+        if target not in defined:
+            continue
+        bar = 'b_' + target
+        if op in ('+', 'copy'):
+            for arg in args:
+                accumulate(arg, bar)
+        elif op == '-':
+            accumulate(args[0], bar)
+            accumulate(args[1], '-' + bar)
+        elif op == 'neg':
+            accumulate(args[0], '-' + bar)
+        elif op == '*':
+            accumulate(args[0], '{} * {}'.format(bar, args[1]))
+            accumulate(args[1], '{} * {}'.format(bar, args[0]))
+        elif op == '/':
+            accumulate(args[0], '{} / {}'.format(bar, args[1]))
+            accumulate(args[1], '-{} * {} / {}'.format(bar, target, args[1]))
+        else:
+            power = float(args[1])
+            accumulate(args[0], '{} * {!r} * {} ** {!r}'.format(bar, power, args[0], power - 1.0))
+
+    outputs = []
+    for i, name in enumerate(comp_names):
+        outputs.append('comps_bar[{}] = {}'.format(i, 'b_' + name if name in defined else '0.0'))
+    for i, name in enumerate(param_names):
+        outputs.append('params_bar[{}] = {}'.format(i, 'b_' + name if name in defined else '0.0'))
+
+    lines = ['def rates_vjp(comps, params, fna_factor, weights, comps_bar, params_bar):']
+    lines += ['    ' + line for line in binds + forward + backward + outputs]
+    lines += ['    return params_bar', '']
+
+    return lines
+
+
+def _cache_dir():
+    '''
+    Return the kernel cache directory.
+
+    '''
+    return os.environ.get(CACHE_ENV) or os.path.join(os.path.expanduser('~'), '.cache', 'asm2d_n2o')
+
+
+def _write_source(path, source):
+    '''
+    Atomically write the kernel source to path; return False if that is not possible.
+
+    '''
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+        with os.fdopen(fd, 'w') as f:
+            f.write(source)
+        os.replace(tmp, path)
+    except OSError:
+        return False
+
+    return True
+
+
+def _import_source(name, path, source):
+    '''
+    Import the kernel from its cached file, or execute it in memory if path is None.
+
+    '''
+    if path is None:
+        module = types.ModuleType(name)
+        exec(compile(source, '<{}>'.format(name), 'exec'), module.__dict__)
+        return module
+
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    # numba's on-disk cache looks the module up by name when it reloads compiled functions
+    sys.modules.setdefault(name, module)
+
+    return module
+
+
+def load_kernel(comp_names, param_names, aux_terms, monod_terms, rate_exprs, stoich_keys,
+                use_numba=False):
+    '''
+    Return the kinetic kernel of a model definition, generating it if needed.
+
+    The generated source is cached as kernel_<hash>.py in the directory
+    named by the ASM2D_N2O_CACHE environment variable (default
+    ~/.cache/asm2d_n2o), where <hash> covers the whole definition and the
+    generator version, so an edited table regenerates its kernel. If the
+    cache cannot be written the kernel is built in memory instead.
+
+    Args:
+        comp_names, param_names, aux_terms, monod_terms, rate_exprs, stoich_keys:
+                        the model definition, see kernel_source();
+        use_numba:      compile the functions with numba.njit(cache=True) if numba is
+                        installed; otherwise the plain Python functions are returned
+
+    Return:
+        kinetic_kernel
+
+    '''
+    definition = (GENERATOR_VERSION, tuple(comp_names), tuple(param_names),
+                  tuple(tuple(term) for term in aux_terms), tuple(tuple(term) for term in monod_terms),
+                  tuple(rate_exprs), tuple(stoich_keys))
+    digest = hashlib.sha256(repr(definition).encode()).hexdigest()[:16]
+
+    kernel = _loaded.get((digest, use_numba))
+    if kernel is not None:
+        return kernel
+
+    name = 'kernel_' + digest
+    path = os.path.join(_cache_dir(), name + '.py')
+    if os.path.exists(path):
+        with open(path) as f:
+            source = f.read()
+    else:
+        source = kernel_source(comp_names, param_names, aux_terms, monod_terms, rate_exprs, stoich_keys)
+        if not _write_source(path, source):
+            path = None
+
+    module = _import_source(name, path, source)
+    rates, net_rates, rates_vjp = module.rates, module.net_rates, module.rates_vjp
+
+    compiled = False
+    if use_numba:
+        try:
+            import numba
+        except ImportError:
+            numba = None
+        if numba is not None:
+            # on-disk caching of the machine code needs the source file
+            rates = numba.njit(cache=path is not None)(rates)
+            net_rates = numba.njit(cache=path is not None)(net_rates)
+            if rates_vjp is not None:
+                rates_vjp = numba.njit(cache=path is not None)(rates_vjp)
+            compiled = True
+
+    kernel = kinetic_kernel(digest, source, path, rates, net_rates, rates_vjp, compiled)
+    _loaded[(digest, use_numba)] = kernel
+
+    return kernel
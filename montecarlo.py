@@ -0,0 +1,172 @@
+"""
+    Monte Carlo uncertainty propagation for the ASM2d-N2O model.
+
+    -   sample_kinetics(): Latin hypercube or Sobol samples of 20C kinetic constants, mapped
+        through their (scipy.stats) distributions.
+    -   run_monte_carlo(): steady-state CSTR of every sample, solved in vectorized batches by
+        steady.batch_steady_state(), with percentile bands of the N2O emission factor (or any
+        other metric of the steady states).
+
+    Reference:
+        Massara, T.M., Solís, B., Guisasola, A., Katsou, E. and Baeza, J.A., 2018.
+        Development of an ASM2d-N2O model to describe nitrous oxide emissions in municipal WWTPs under dynamic conditions.
+        Chemical Engineering Journal, 335, pp.185-196.
+        (https://doi.org/10.1016/j.cej.2017.10.119)
+"""
+
+
+import numpy as np
+from scipy.stats import qmc
+
+from .ASM2d_N2O import COMP_NAMES, STRIPPED_GASES
+from .steady import batch_steady_state
+
+
+# number of samples solved together by run_monte_carlo
+BATCH_SIZE = 500
+
+# default percentiles of the bands reported by mc_result.bands
+PERCENTILES = (5, 25, 50, 75, 95)
+
+_N2O = COMP_NAMES.index('S_N2O')
+_NH4 = COMP_NAMES.index('S_NH4')
+
+
+class mc_result(object):
+    '''
+    Result of a Monte Carlo run.
+
+    '''
+
+    def __init__(self, samples, comps, converged, metric):
+        '''
+        Args:
+            samples:    dict of kinetic constant name to its sampled 20C values, (N,) arrays;
+            comps:      steady-state component concentrations, mg/L, shape (N, 24);
+            converged:  whether each steady-state solve converged, shape (N,);
+            metric:     metric of each steady state, shape (N,) (nan if not converged)
+
+        Return:
+            None
+
+        '''
+        self.samples = samples
+        self.comps = comps
+        self.converged = converged
+        self.metric = metric
+
+        return None
+
+
+    def bands(self, q=PERCENTILES):
+        '''
+        Return the percentiles q of the metric over the converged samples.
+
+        '''
+        return np.percentile(self.metric[self.converged], q)
+
+
+def n2o_emission_factor(comps, in_comps, model, vol, flow):
+    '''
+    N2O-N production per unit of influent ammonium nitrogen, gN/gN.
+
+    The production is the net dissolved N2O leaving with the effluent plus
+    the N2O stripped to the off-gas (ASM2d_N2O.set_stripping), so that
+    stripping moves N2O between the two terms without lowering the factor.
+
+    Args:
+        comps:      steady-state concentrations, mg/L, shape (N, 24);
+        in_comps:   influent concentrations, mg/L (24 values);
+        model:      the ASM2d_N2O instance of the steady states (for its stripping rates);
+        vol:        reactor volume, m3;
+        flow:       influent flow rate, m3/d
+
+    Return:
+        numpy.ndarray of shape (N,)
+
+    '''
+    stripped = model.stripping_rates(comps)[:, STRIPPED_GASES.index('S_N2O')] * vol / flow
+
+    return (comps[:, _N2O] - in_comps[_N2O] + stripped) / in_comps[_NH4]
+
+
+def sample_kinetics(dists, n, method='lhs', seed=None):
+    '''
+    Sample 20C kinetic constants from their distributions.
+
+    Uniform points of the unit hypercube are drawn by Latin hypercube or
+    scrambled Sobol sampling and mapped through the inverse CDF (ppf) of
+    each distribution.
+
+    Args:
+        dists:      dict of kinetic constant name to a frozen scipy.stats distribution
+                    (e.g. scipy.stats.uniform(0.001, 0.009), scipy.stats.lognorm(0.3, scale=0.8));
+        n:          number of samples (a power of 2 keeps Sobol sequences balanced);
+        method:     'lhs' or 'sobol';
+        seed:       seed of the sampler
+
+    Return:
+        dict of kinetic constant name to an (n,) array of 20C values
+
+    '''
+    names = list(dists)
+    if method == 'lhs':
+        sampler = qmc.LatinHypercube(d=len(names), seed=seed)
+    elif method == 'sobol':
+        sampler = qmc.Sobol(d=len(names), scramble=True, seed=seed)
+    else:
+        raise ValueError("method must be 'lhs' or 'sobol'")
+
+    u = sampler.random(n)
+
+    return {name: np.asarray(dists[name].ppf(u[:, j]), dtype=float) for j, name in enumerate(names)}
+
+
+def run_monte_carlo(model, dists, n, init_comps, in_comps, vol, flow, method='lhs', seed=None,
+                    metric=n2o_emission_factor, fix_DO=False, DO_sat_T=9.0, batch_size=BATCH_SIZE,
+                    tol=1e-9, max_iter=500):
+    '''
+    Propagate kinetic parameter uncertainty to the steady state of a single CSTR.
+
+    The samples are solved batch_size at a time: the kinetic rates and
+    complex-step Jacobians of a whole batch are evaluated in one call of
+    the generated kernel, with one parameter set per row.
+
+    Args:
+        model:          an ASM2d_N2O instance giving temperature, DO, pH, KLa and the
+                        unsampled kinetic constants;
+        dists:          dict of kinetic constant name to a frozen scipy.stats distribution;
+        n:              number of samples;
+        init_comps:     initial guess of the steady state, mg/L (24 values);
+        in_comps:       influent component concentrations, mg/L (24 values);
+        vol:            reactor volume, m3;
+        flow:           influent flow rate, m3/d;
+        method:         'lhs' or 'sobol';
+        seed:           seed of the sampler;
+        metric:         function of (comps (N, 24), in_comps, model, vol, flow) returning an (N,) array;
+        fix_DO:         whether to fix the DO concentration;
+        DO_sat_T:       saturation DO at the chosen temperature, mg/L;
+        batch_size:     number of samples solved together;
+        tol:            tolerance on the scaled steady-state residual, 1/d;
+        max_iter:       maximum number of continuation iterations per batch
+
+    Return:
+        mc_result
+
+    '''
+    samples = sample_kinetics(dists, n, method, seed)
+    inf = np.array(in_comps, dtype=float)
+
+    comps = np.empty((n, 24))
+    converged = np.zeros(n, dtype=bool)
+    for start in range(0, n, batch_size):
+        stop = min(start + batch_size, n)
+        params = model.batch_params({name: vals[start:stop] for name, vals in samples.items()})
+        res = batch_steady_state(model, init_comps, inf, vol, flow, params, fix_DO=fix_DO,
+                                 DO_sat_T=DO_sat_T, tol=tol, max_iter=max_iter)
+        comps[start:stop] = res.comps
+        converged[start:stop] = res.converged
+
+    values = np.where(converged, metric(comps, inf, model, vol, flow), np.nan)
+
+    return mc_result(samples, comps, converged, values)
@@ -0,0 +1,338 @@
+"""
+    Columnar on-disk results for long ASM2d-N2O simulations.
+
+    -   result_writer: append output rows (time, 24 components, optionally the 40 process rates)
+        chunk by chunk to a result directory, one column per file, never holding the whole
+        trajectory in memory. Columns are .npy files (memory-mappable), zlib-compressed chunks,
+        or one Parquet file when pyarrow is installed.
+    -   result_store: open a result directory and load or memory-map single columns.
+
+    A result directory holds header.json (columns, dtype, number of rows, layout, user attributes)
+    and the column data.
+
+    Reference:
+        Massara, T.M., Solís, B., Guisasola, A., Katsou, E. and Baeza, J.A., 2018.
+        Development of an ASM2d-N2O model to describe nitrous oxide emissions in municipal WWTPs under dynamic conditions.
+        Chemical Engineering Journal, 335, pp.185-196.
+        (https://doi.org/10.1016/j.cej.2017.10.119)
+"""
+
+
+import json
+import os
+import struct
+import zlib
+
+import numpy as np
+
+from .ASM2d_N2O import COMP_NAMES
+
+
+# process rate columns, numbered like the process prefix of the stoichiometric keys
+RATE_NAMES = tuple('rate_{}'.format(k + 1) for k in range(40))
+
+# default number of rows buffered before a chunk is written
+CHUNK_ROWS = 65536
+
+# layout version written to header.json
+_FORMAT_VERSION = 1
+
+# fixed size of the .npy headers, so the row count can be patched in on close
+_NPY_HEADER_LEN = 128
+
+
+def _npy_header(dtype, n_rows):
+    '''
+    Return a fixed-size .npy (version 1.0) header for a 1-d array.
+
+    '''
+    desc = "{{'descr': '{}', 'fortran_order': False, 'shape': ({},), }}".format(np.dtype(dtype).str, n_rows)
+    desc = desc.ljust(_NPY_HEADER_LEN - 11) + '\n'
+
+    return b'\x93NUMPY\x01\x00' + struct.pack('<H', len(desc)) + desc.encode('latin1')
+
+
+class result_writer(object):
+    '''
+    Chunked, column-oriented sink for simulation output.
+
+    Rows are buffered and written every chunk_rows rows, so memory use is
+    bounded by one chunk whatever the length of the run. The time column
+    is always stored as float64; the other columns use dtype (float32
+    halves the file size).
+
+    Layouts:
+        'npy':      one .npy file per column, memory-mappable by result_store;
+        'zlib':     one file of zlib-compressed chunks per column, with the chunk
+                    offsets in header.json (read back whole columns only);
+        'parquet':  one Parquet file with a row group per chunk (needs pyarrow).
+
+    '''
+
+    def __init__(self, path, rates=False, dtype=np.float64, chunk_rows=CHUNK_ROWS, layout='npy',
+                 compress_level=6, attrs=None):
+        '''
+        Args:
+            path:           result directory, created if needed;
+            rates:          whether the 40 process rates are stored after the components;
+            dtype:          storage dtype of the value columns, float64 or float32;
+            chunk_rows:     number of rows buffered before a chunk is written;
+            layout:         'npy', 'zlib' or 'parquet';
+            compress_level: zlib (or Parquet zstd) compression level;
+            attrs:          dict of user metadata stored in header.json (JSON-serializable)
+
+        Return:
+            None
+
+        '''
+        if layout not in ('npy', 'zlib', 'parquet'):
+            raise ValueError("layout must be 'npy', 'zlib' or 'parquet'")
+        if np.dtype(dtype) not in (np.dtype(np.float64), np.dtype(np.float32)):
+            raise ValueError('dtype must be float64 or float32')
+
+        self._path = path
+        self._columns = ['t'] + list(COMP_NAMES) + (list(RATE_NAMES) if rates else [])
+        self._rates = rates
+        self._dtype = np.dtype(dtype)
+        self._chunk_rows = int(chunk_rows)
+        self._layout = layout
+        self._compress_level = compress_level
+        self._attrs = dict(attrs or {})
+
+        # row buffer, the number of rows in it and the number of rows written
+        self._buf = np.empty((self._chunk_rows, len(self._columns)))
+        self._n_buf = 0
+        self._n_rows = 0
+
+        # (offset, nbytes) of each compressed chunk, per column
+        self._chunks = {name: [] for name in self._columns}
+
+        os.makedirs(path, exist_ok=True)
+        self._files = {}
+        self._parquet = None
+        if layout == 'npy':
+            for name in self._columns:
+                f = open(os.path.join(path, name + '.npy'), 'wb')
+                f.write(_npy_header(self._col_dtype(name), 0))
+                self._files[name] = f
+        elif layout == 'zlib':
+            for name in self._columns:
+                self._files[name] = open(os.path.join(path, name + '.z'), 'wb')
+        else:
+            try:
+                import pyarrow
+                import pyarrow.parquet
+            except ImportError:
+                raise ImportError("layout='parquet' requires pyarrow")
+            self._pa = pyarrow
+            self._schema = pyarrow.schema([(name, pyarrow.from_numpy_dtype(self._col_dtype(name)))
+                                           for name in self._columns])
+            self._parquet = pyarrow.parquet.ParquetWriter(os.path.join(path, 'data.parquet'), self._schema,
+                                                          compression='zstd', compression_level=compress_level)
+
+        return None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+    def has_rates(self):
+        '''
+        Return True if the process rates are stored.
+
+        '''
+        return self._rates
+
+
+    def append(self, t, comps, rates=None):
+        '''
+        Append output rows.
+
+        Args:
+            t:          output times, days, shape (n,) or a scalar;
+            comps:      component concentrations, mg/L, shape (n, 24) or (24,);
+            rates:      process rates, shape (n, 40) or (40,), if the writer stores rates
+
+        Return:
+            None
+
+        '''
+        t = np.atleast_1d(np.asarray(t, dtype=float))
+        comps = np.atleast_2d(comps)
+        if comps.shape != (len(t), 24):
+            raise ValueError('comps must have shape (len(t), 24)')
+        if self._rates:
+            if rates is None:
+                raise ValueError('this writer stores process rates, but none were given')
+            rates = np.atleast_2d(rates)
+
+        start = 0
+        while start < len(t):
+            n = min(len(t) - start, self._chunk_rows - self._n_buf)
+            rows = self._buf[self._n_buf:self._n_buf + n]
+            rows[:, 0] = t[start:start + n]
+            rows[:, 1:25] = comps[start:start + n]
+            if self._rates:
+                rows[:, 25:] = rates[start:start + n]
+            self._n_buf += n
+            start += n
+            if self._n_buf == self._chunk_rows:
+                self._flush()
+
+        return None
+
+
+    def close(self):
+        '''
+        Write the buffered rows, finalize the column files and write header.json.
+
+        '''
+        if self._buf is None:
+            return None
+
+        self._flush()
+        self._buf = None
+
+        if self._layout == 'npy':
+            for name, f in self._files.items():
+                # patch the final row count into the fixed-size header
+                f.seek(0)
+                f.write(_npy_header(self._col_dtype(name), self._n_rows))
+        for f in self._files.values():
+            f.close()
+        if self._parquet is not None:
+            self._parquet.close()
+
+        header = {'format_version': _FORMAT_VERSION,
+                  'layout': self._layout,
+                  'columns': self._columns,
+                  'dtype': self._dtype.name,
+                  'n_rows': self._n_rows,
+                  'chunk_rows': self._chunk_rows,
+                  'attrs': self._attrs}
+        if self._layout == 'zlib':
+            header['chunks'] = self._chunks
+        with open(os.path.join(self._path, 'header.json'), 'w') as f:
+            json.dump(header, f, indent=1)
+
+        return None
+
+
+    def _col_dtype(self, name):
+        '''
+        Storage dtype of a column.
+
+        '''
+        return np.dtype(np.float64) if name == 't' else self._dtype
+
+
+    def _flush(self):
+        '''
+        Write the buffered rows as one chunk.
+
+        '''
+        n = self._n_buf
+        if n == 0:
+            return None
+
+        rows = self._buf[:n]
+        if self._layout == 'parquet':
+            arrays = [self._pa.array(rows[:, i].astype(self._col_dtype(name)))
+                      for i, name in enumerate(self._columns)]
+            self._parquet.write_table(self._pa.Table.from_arrays(arrays, schema=self._schema))
+        else:
+            for i, name in enumerate(self._columns):
+                data = rows[:, i].astype(self._col_dtype(name)).tobytes()
+                f = self._files[name]
+                if self._layout == 'zlib':
+                    data = zlib.compress(data, self._compress_level)
+                    self._chunks[name].append((f.tell(), len(data)))
+                f.write(data)
+
+        self._n_rows += n
+        self._n_buf = 0
+
+        return None
+
+
+class result_store(object):
+    '''
+    Read access to a result directory written by result_writer.
+
+    '''
+
+    def __init__(self, path):
+        '''
+        Args:
+            path:   result directory
+
+        Return:
+            None
+
+        '''
+        with open(os.path.join(path, 'header.json')) as f:
+            self._header = json.load(f)
+        if self._header['format_version'] > _FORMAT_VERSION:
+            raise ValueError('result directory was written by a newer version')
+
+        self._path = path
+        self.columns = self._header['columns']
+        self.n_rows = self._header['n_rows']
+        self.attrs = self._header['attrs']
+
+        return None
+
+
+    def __getitem__(self, name):
+        return self.column(name)
+
+
+    def column(self, name, mmap=True):
+        '''
+        Return one column.
+
+        Args:
+            name:   column name ('t', a component name such as 'S_N2O', or 'rate_k');
+            mmap:   memory-map the column instead of reading it ('npy' layout only)
+
+        Return:
+            numpy.ndarray (or numpy.memmap) of shape (n_rows,)
+
+        '''
+        if name not in self.columns:
+            raise KeyError(name)
+
+        layout = self._header['layout']
+        if layout == 'npy':
+            return np.load(os.path.join(self._path, name + '.npy'), mmap_mode='r' if mmap else None)
+
+        if layout == 'zlib':
+            dtype = np.dtype(np.float64) if name == 't' else np.dtype(self._header['dtype'])
+            out = np.empty(self.n_rows, dtype=dtype)
+            row = 0
+            with open(os.path.join(self._path, name + '.z'), 'rb') as f:
+                for offset, nbytes in self._header['chunks'][name]:
+                    f.seek(offset)
+                    chunk = np.frombuffer(zlib.decompress(f.read(nbytes)), dtype=dtype)
+                    out[row:row + len(chunk)] = chunk
+                    row += len(chunk)
+            return out
+
+        import pyarrow.parquet
+        table = pyarrow.parquet.read_table(os.path.join(self._path, 'data.parquet'), columns=[name],
+                                           memory_map=mmap)
+
+        return table.column(name).to_numpy()
+
+
+    def comps(self, names=COMP_NAMES):
+        '''
+        Return the given component columns stacked as an (n_rows, len(names)) array.
+
+        '''
+        return np.column_stack([self.column(name) for name in names])
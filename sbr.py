@@ -0,0 +1,410 @@
+"""
+    Sequencing batch reactor (SBR) operation of the ASM2d-N2O model.
+
+    -   sbr_phase: one step of the cycle schedule (fill, anoxic or aerobic reaction, settle, decant,
+        wasting), with its feed and draw flows and its aeration.
+    -   sequencing_batch_reactor: repeat a cycle of phases in one variable-volume reactor, phase by
+        phase, with the hydraulic terms left out of phases without feed, and stop once the state
+        at the end of a cycle no longer changes (cyclic steady state), optionally integrating the
+        cumulative off-gas emissions across the phases.
+
+    Reference:
+        Massara, T.M., Solís, B., Guisasola, A., Katsou, E. and Baeza, J.A., 2018.
+        Development of an ASM2d-N2O model to describe nitrous oxide emissions in municipal WWTPs under dynamic conditions.
+        Chemical Engineering Journal, 335, pp.185-196.
+        (https://doi.org/10.1016/j.cej.2017.10.119)
+"""
+
+
+import functools
+
+import numpy as np
+from scipy.integrate import solve_ivp
+
+from .ASM2d_N2O import COMP_NAMES, STRIPPED_GASES
+from .simulation import RTOL, ATOL, _with_emissions, _emissions
+
+
+# particulate components, retained in the reactor by settling
+PARTICULATES = np.array([name.startswith('X_') for name in COMP_NAMES])
+
+# 2-point Gauss-Legendre rule on [-1, 1], for the effluent quadrature
+_GAUSS_NODES = np.array([-1.0, 1.0]) / np.sqrt(3.0)
+
+
+class sbr_phase(object):
+    '''
+    One phase of an SBR cycle.
+
+    '''
+
+    def __init__(self, name, duration, feed=0.0, draw=0.0, settled=False, DO=None, KLa=0.0):
+        '''
+        Args:
+            name:       label of the phase (e.g. 'fill', 'aerobic', 'decant');
+            duration:   length of the phase, days;
+            feed:       influent flow rate during the phase, m3/d;
+            draw:       withdrawal flow rate during the phase, m3/d;
+            settled:    whether the sludge has settled, so that the draw is clear supernatant
+                        (decant) and not mixed liquor (wasting);
+            DO:         fixed DO during the phase, mg/L, or None to let DO evolve;
+            KLa:        oxygen transfer coefficient when DO is not fixed, 1/d (0 without aeration);
+                        it also strips the gases of ASM2d_N2O.set_stripping, whether DO is fixed or not
+
+        Return:
+            None
+
+        '''
+        if duration <= 0:
+            raise ValueError('duration of phase {} must be positive'.format(name))
+        if feed < 0 or draw < 0 or KLa < 0:
+            raise ValueError('feed, draw and KLa of phase {} must not be negative'.format(name))
+
+        self.name = name
+        self.duration = float(duration)
+        self.feed = float(feed)
+        self.draw = float(draw)
+        self.settled = settled
+        self.DO = DO
+        self.KLa = float(KLa)
+
+        return None
+
+
+class sbr_result(object):
+    '''
+    Result of an SBR simulation.
+
+    '''
+
+    def __init__(self, t, comps, vol, phase, cycle_comps, effluent, cycles, converged, nfev, njev, nlu,
+                 success, message, emissions=None):
+        '''
+        Args:
+            t:              output times, days;
+            comps:          component concentrations at t, mg/L, shape (len(t), 24);
+            vol:            reactor volume at t, m3;
+            phase:          index of the phase at t (the phase ending there at a phase switch);
+            cycle_comps:    components at the end of each cycle, mg/L, shape (cycles, 24);
+            effluent:       mean decanted concentrations of each cycle, mg/L, shape (cycles, 24)
+                            (nan without a settled draw);
+            cycles:         number of cycles simulated;
+            converged:      whether a cyclic steady state was detected;
+            nfev:           number of dC/dt evaluations;
+            njev:           number of Jacobian evaluations;
+            nlu:            number of LU decompositions;
+            success:        whether every phase reached its end;
+            message:        status message;
+            emissions:      dict of stripped gas to its cumulative emission since the start at t, g
+                            (mg/L x m3, in the units of the component), or None
+
+        Return:
+            None
+
+        '''
+        self.t = t
+        self.comps = comps
+        self.vol = vol
+        self.phase = phase
+        self.cycle_comps = cycle_comps
+        self.effluent = effluent
+        self.cycles = cycles
+        self.converged = converged
+        self.nfev = nfev
+        self.njev = njev
+        self.nlu = nlu
+        self.success = success
+        self.message = message
+        self.emissions = emissions
+
+        return None
+
+
+    def final(self):
+        '''
+        Return a copy of the component concentrations at the last output time.
+
+        '''
+        return self.comps[-1].copy()
+
+
+class sequencing_batch_reactor(object):
+    '''
+    Variable-volume batch reactor cycling through a schedule of phases.
+
+    Each phase is integrated on its own, so no solver step straddles a
+    switch of feed, draw or aeration, and the volume V(t) is linear within
+    a phase. With C_in the influent,
+
+        dC/dt == feed / V * (C_in - C) + r(C) + aeration,
+
+    and during a settled draw the particulates stay behind, so they
+    concentrate by draw / V * X. In phases without feed the influent is not
+    evaluated at all: the right-hand side and its Jacobian are the
+    kinetics alone, and the solver steps are only limited by the
+    reactions. Kinetics go on in the whole volume while the
+    sludge settles.
+
+    '''
+
+    def __init__(self, model, phases, in_comps, vol, DO_sat_T=9.0):
+        '''
+        Args:
+            model:      an ASM2d_N2O instance providing the kinetics (its temperature and pH
+                        forcing apply; aeration is set by the phases);
+            phases:     the sbr_phase schedule of one cycle;
+            in_comps:   influent component concentrations, mg/L (24 values), or a callable of time
+                        returning them (e.g. influent.influent_reader);
+            vol:        reactor volume at the start of a cycle, m3;
+            DO_sat_T:   saturation DO at the chosen temperature, mg/L
+
+        Return:
+            None
+
+        '''
+        self._model = model
+        self._phases = list(phases)
+        self._in_comps = in_comps if callable(in_comps) else np.array(in_comps, dtype=float)
+        self._vol = float(vol)
+        self._DO_sat_T = DO_sat_T
+
+        if not self._phases:
+            raise ValueError('an SBR cycle needs at least one phase')
+
+        # volume at the start of each phase, and at the end of the cycle
+        self._vol_starts = self._vol + np.concatenate(
+            [[0.0], np.cumsum([(p.feed - p.draw) * p.duration for p in self._phases])])
+        if np.any(self._vol_starts <= 0):
+            raise ValueError('the draws empty the reactor')
+        if not np.isclose(self._vol_starts[-1], self._vol, rtol=1e-9, atol=0.0):
+            raise ValueError('fed and drawn volumes of a cycle differ by {} m3'.format(
+                self._vol_starts[-1] - self._vol))
+
+        self._cycle_time = sum(p.duration for p in self._phases)
+
+        # the Python kernel evaluates a list of floats faster than an array
+        self._as_list = model.get_backend() == 'python'
+
+        return None
+
+
+    def get_cycle_time(self):
+        '''
+        Return the length of one cycle, days.
+
+        '''
+        return self._cycle_time
+
+
+    def _volume(self, k, t, t0):
+        '''
+        Volume in phase k at time t, for a phase started at t0, m3.
+
+        '''
+        phase = self._phases[k]
+
+        return self._vol_starts[k] + (phase.feed - phase.draw) * (t - t0)
+
+
+    def rhs(self, t, y, k, t0):
+        '''
+        dC/dt in phase k.
+
+        Args:
+            t:      time, days;
+            y:      concentrations, mg/L (24 values);
+            k:      index of the phase;
+            t0:     start of the phase, days
+
+        Return:
+            numpy.ndarray of shape (24,), mg/L/d
+
+        '''
+        model = self._model
+        phase = self._phases[k]
+        model._apply_forcing(t)
+
+        comps = y.tolist() if self._as_list else y
+        rates = model._reaction_rate(comps)
+        dCdt = rates @ model._stoich_mat
+
+        if phase.feed > 0 or (phase.draw > 0 and phase.settled):
+            vol = self._volume(k, t, t0)
+            if phase.feed > 0:
+                in_comps = self._in_comps(t) if callable(self._in_comps) else self._in_comps
+                dCdt += (in_comps - y) * (phase.feed / vol)
+            if phase.draw > 0 and phase.settled:
+                dCdt[PARTICULATES] += y[PARTICULATES] * (phase.draw / vol)
+
+        if phase.DO is None:
+            dCdt[0] += phase.KLa * (self._DO_sat_T - y[0])
+        else:
+            dCdt[0] = 0.0
+        dCdt[model._strip_idx] -= model.stripping_rates(y, phase.KLa)
+
+        return dCdt
+
+
+    def jacobian(self, t, y, k, t0):
+        '''
+        Jacobian of rhs in phase k with respect to the concentrations.
+
+        Args:
+            t:      time, days;
+            y:      concentrations, mg/L (24 values);
+            k:      index of the phase;
+            t0:     start of the phase, days
+
+        Return:
+            numpy.ndarray of shape (24, 24)
+
+        '''
+        model = self._model
+        phase = self._phases[k]
+        model._apply_forcing(t)
+
+        # complex-step: row j perturbs component j
+        h = 1e-30
+        states = np.tile(np.asarray(y, dtype=complex), (24, 1))
+        states[np.arange(24), np.arange(24)] += 1j * h
+        _, net_rates = model.batch_reaction_rate(states)
+        jac = net_rates.imag.T / h
+
+        if phase.feed > 0 or (phase.draw > 0 and phase.settled):
+            vol = self._volume(k, t, t0)
+            diag = np.zeros(24)
+            if phase.feed > 0:
+                diag -= phase.feed / vol
+            if phase.draw > 0 and phase.settled:
+                diag[PARTICULATES] += phase.draw / vol
+            jac[np.arange(24), np.arange(24)] += diag
+
+        if phase.DO is None:
+            jac[0, 0] -= phase.KLa
+        else:
+            jac[0, :] = 0.0
+        jac[model._strip_idx, model._strip_idx] -= phase.KLa * model._strip_ratio
+
+        return jac
+
+
+    def simulate(self, init_comps, cycles, t_start=0.0, t_eval=None, css_tol=None, method='BDF',
+                 rtol=RTOL, atol=ATOL, emissions=False):
+        '''
+        Run up to cycles SBR cycles from t_start.
+
+        After every cycle, the end state is compared with the one of the
+        previous cycle; with css_tol, the run stops at the first cycle where
+        no component changed by more than css_tol * |C| + atol, a cyclic
+        steady state.
+
+        With emissions, the masses of the stripped gases sent to the gas
+        phase, V(t) * stripping rate at the KLa of each phase, are integrated
+        with the state of every phase and carried over from one phase to
+        the next (see simulation.simulate).
+
+        Args:
+            init_comps:     concentrations at the start of the first cycle, mg/L (24 values);
+            cycles:         maximum number of cycles;
+            t_start:        start of the first cycle, days;
+            t_eval:         output times, days (default: the end of every phase);
+            css_tol:        relative change between cycle end states taken as a cyclic steady
+                            state, or None to run all cycles;
+            method:         stiff solver passed to scipy solve_ivp ('BDF', 'Radau' or 'LSODA');
+            rtol:           relative tolerance;
+            atol:           absolute tolerance, mg/L;
+            emissions:      whether to integrate the cumulative emissions of the stripped gases
+
+        Return:
+            sbr_result
+
+        '''
+        model = self._model
+        y = np.array(init_comps, dtype=float)
+        # emission totals since t_start, in the order of STRIPPED_GASES
+        emitted = np.zeros(len(STRIPPED_GASES) if emissions else 0)
+        t = float(t_start)
+        t_eval = None if t_eval is None else np.asarray(t_eval, dtype=float)
+
+        out_t, out_y, out_v, out_k = [], [], [], []
+        if t_eval is None or np.any(t_eval == t):
+            out_t.append([t])
+            out_y.append(np.concatenate([y, emitted])[None])
+            out_v.append([self._vol])
+            out_k.append([0])
+
+        cycle_comps, effluent = [], []
+        nfev = njev = nlu = 0
+        converged = False
+        success, message = True, 'The solver successfully reached the end of the last cycle.'
+
+        for _ in range(int(cycles)):
+            y_cycle = y.copy()
+            drawn = np.zeros(24)
+            drawn_vol = 0.0
+            for k, phase in enumerate(self._phases):
+                t0, t1 = t, t + phase.duration
+                if phase.DO is not None:
+                    y[0] = phase.DO
+
+                if t_eval is None:
+                    seg_eval = np.array([t1])
+                else:
+                    # phase ends accumulate round-off, so outputs on a boundary go to the phase ending there
+                    eps = 1e-9 * max(1.0, abs(t1))
+                    seg_eval = t_eval[(t_eval > t0 + eps) & (t_eval <= t1 + eps)]
+                # a settled draw needs the trajectory for the effluent quadrature
+                decant = phase.draw > 0 and phase.settled
+
+                fun = functools.partial(self.rhs, k=k, t0=t0)
+                jac = functools.partial(self.jacobian, k=k, t0=t0)
+                y0 = y
+                if emissions:
+                    fun, jac, y0 = _with_emissions(model, fun, jac, y, functools.partial(self._volume, k, t0=t0),
+                                                   phase.KLa, emitted)
+
+                # every solver step is returned; outputs before the end of the phase come from the interpolant
+                interior = bool(np.any(seg_eval < t1))
+                res = solve_ivp(fun, (t0, t1), y0, method=method, dense_output=decant or interior,
+                                jac=jac, rtol=rtol, atol=atol)
+                nfev += res.nfev
+                njev += res.njev
+                nlu += res.nlu
+                if not res.success:
+                    success, message = False, '{} (phase {})'.format(res.message, phase.name)
+                    break
+
+                if len(seg_eval):
+                    out_t.append(seg_eval)
+                    out_y.append(res.sol(np.minimum(seg_eval, t1)).T if res.sol is not None else res.y[:, -1:].T)
+                    out_v.append(self._volume(k, np.minimum(seg_eval, t1), t0))
+                    out_k.append(np.full(len(seg_eval), k))
+
+                if decant:
+                    # supernatant drawn, by Gauss-Legendre quadrature over the solver steps
+                    lo, hi = res.t[:-1], res.t[1:]
+                    t_q = ((hi + lo) / 2 + np.outer(_GAUSS_NODES, (hi - lo) / 2)).ravel()
+                    w_q = np.tile((hi - lo) / 2, 2)
+                    drawn += phase.draw * (res.sol(t_q)[:24] @ w_q) * ~PARTICULATES
+                    drawn_vol += phase.draw * phase.duration
+
+                y = res.y[:24, -1].copy()
+                emitted = res.y[24:, -1].copy()
+                t = t1
+            if not success:
+                break
+
+            cycle_comps.append(y.copy())
+            effluent.append(drawn / drawn_vol if drawn_vol > 0 else np.full(24, np.nan))
+            if css_tol is not None and np.all(np.abs(y - y_cycle) <= css_tol * np.abs(y) + atol):
+                converged = True
+                break
+
+        out_t = np.concatenate(out_t) if out_t else np.zeros(0)
+        out_y = np.concatenate(out_y) if out_y else np.zeros((0, 24 + len(emitted)))
+        out_v = np.concatenate(out_v) if out_v else np.zeros(0)
+        out_k = np.concatenate(out_k).astype(int) if out_k else np.zeros(0, dtype=int)
+
+        return sbr_result(out_t, out_y[:, :24].copy(), out_v, out_k, np.array(cycle_comps).reshape(-1, 24),
+                          np.array(effluent).reshape(-1, 24), len(cycle_comps), converged, nfev, njev, nlu,
+                          success, message, _emissions(out_y))
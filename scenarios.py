@@ -0,0 +1,193 @@
+"""
+    Parameter sweeps of the ASM2d-N2O model over a process pool.
+
+    -   run_scenarios(): run one simulation (or steady-state solve) of a configured model per set
+        of 20C kinetic constant changes, spread over worker processes that each receive the model
+        once, and yield summary metrics as the runs complete.
+    -   grid_deltas(): the full factorial combinations of a few kinetic constants.
+
+    Reference:
+        Massara, T.M., Solís, B., Guisasola, A., Katsou, E. and Baeza, J.A., 2018.
+        Development of an ASM2d-N2O model to describe nitrous oxide emissions in municipal WWTPs under dynamic conditions.
+        Chemical Engineering Journal, 335, pp.185-196.
+        (https://doi.org/10.1016/j.cej.2017.10.119)
+"""
+
+
+import itertools
+import multiprocessing
+import os
+
+from .ASM2d_N2O import COMP_NAMES
+from .simulation import simulate
+from .steady import steady_state
+
+
+# state of the current worker process, set by _init_worker
+_worker = {}
+
+
+class scenario_result(object):
+    '''
+    Outcome of one scenario run.
+
+    '''
+
+    def __init__(self, index, deltas, metrics, success, message):
+        '''
+        Args:
+            index:      position of the scenario in the input sequence;
+            deltas:     dict of the altered 20C kinetic constants;
+            metrics:    dict of summary metrics, or None if the run failed;
+            success:    whether the run completed (and, for steady state, converged);
+            message:    solver message, or the error of a failed run
+
+        Return:
+            None
+
+        '''
+        self.index = index
+        self.deltas = deltas
+        self.metrics = metrics
+        self.success = success
+        self.message = message
+
+        return None
+
+
+def final_metrics(result):
+    '''
+    Default summary metrics: the final (or steady-state) concentration of every component, mg/L.
+
+    '''
+    comps = result.final() if hasattr(result, 'final') else result.comps
+
+    return dict(zip(COMP_NAMES, (float(c) for c in comps)))
+
+
+def grid_deltas(grid):
+    '''
+    Return the full factorial combinations of a few kinetic constants.
+
+    Args:
+        grid:   dict of kinetic constant name to a sequence of 20C values
+
+    Return:
+        list of dicts, one per combination
+
+    '''
+    names = list(grid)
+
+    return [dict(zip(names, vals)) for vals in itertools.product(*(grid[name] for name in names))]
+
+
+def _init_worker(model, case, mode, metrics):
+    '''
+    Keep the model and the run settings in this worker process.
+
+    '''
+    # the temperature and DO of the model as configured, before any forcing is applied by a run
+    _worker.update(model=model, base=model.get_kinetics_20C(), ww_temp=model._temperature,
+                   DO=model._bulk_DO, case=case, mode=mode, metrics=metrics)
+
+    return None
+
+
+def _run_one(task):
+    '''
+    Run one scenario in the current worker and summarize it.
+
+    '''
+    index, deltas = task
+    model = _worker['model']
+
+    try:
+        for name, val in deltas.items():
+            model.alter_kinetic_20C(name, val)
+        model.update(_worker['ww_temp'], _worker['DO'])
+
+        if _worker['mode'] == 'steady':
+            res = steady_state(model, **_worker['case'])
+            success, message = res.converged, res.method
+        else:
+            res = simulate(model, **_worker['case'])
+            success, message = res.success, res.message
+        return scenario_result(index, deltas, _worker['metrics'](res), success, message)
+    except Exception as exc:
+        return scenario_result(index, deltas, None, False, '{}: {}'.format(type(exc).__name__, exc))
+    finally:
+        # back to the baseline constants for the next scenario of this worker
+        model.reset_kinetics_20C({name: _worker['base'][name] for name in deltas})
+        model.update(_worker['ww_temp'], _worker['DO'])
+
+
+def run_scenarios(model, deltas, case, mode='simulate', metrics=final_metrics, processes=None, chunksize=None,
+                  mp_context=None):
+    '''
+    Run one model per scenario over a process pool, yielding results as they complete.
+
+    Each worker receives a copy of model once, with its configuration
+    (temperature, DO, pH, KLa, forcing, stripping, backend and constants);
+    only the scenario index and its kinetic constant changes are sent per
+    run, and the baseline constants are restored after it. Scenarios are
+    handed out in chunks, by default about four per worker over the sweep,
+    which keeps every core busy without paying inter-process overhead per
+    run. Failed runs are reported, not raised; the sweep itself is
+    validated when this function is called.
+
+    Args:
+        model:          a configured ASM2d_N2O instance (picklable, for more than one process);
+        deltas:         sequence of dicts of 20C kinetic constant name to value (see grid_deltas);
+        case:           keyword arguments of the run except the model, i.e. of simulation.simulate()
+                        for mode 'simulate' or of steady.steady_state() for mode 'steady';
+        mode:           'simulate' or 'steady';
+        metrics:        picklable function of the run result returning a dict of summary metrics;
+        processes:      number of worker processes (default: all cores); 1 runs in this process,
+                        on model itself;
+        chunksize:      number of scenarios sent to a worker at a time;
+        mp_context:     multiprocessing start method ('fork', 'spawn', ...) or None for the default
+
+    Return:
+        iterator of scenario_result, in order of completion
+
+    '''
+    if mode not in ('simulate', 'steady'):
+        raise ValueError("mode must be 'simulate' or 'steady'")
+
+    tasks = list(enumerate(dict(d) for d in deltas))
+    names = model.get_kinetics_20C()
+    for _, d in tasks:
+        for name, val in d.items():
+            if name not in names:
+                raise ValueError('unknown kinetic constant: {}'.format(name))
+            if not val > 0:
+                raise ValueError('kinetic constant {} must be positive, got {}'.format(name, val))
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = max(1, min(processes, len(tasks)))
+    if chunksize is None:
+        chunksize = max(1, len(tasks) // (4 * processes))
+
+    return _iter_scenarios(tasks, (model, case, mode, metrics), processes, chunksize, mp_context)
+
+
+def _iter_scenarios(tasks, init_args, processes, chunksize, mp_context):
+    '''
+    Yield the results of validated scenario tasks, in this process or over a pool.
+
+    '''
+    if processes == 1:
+        _init_worker(*init_args)
+        try:
+            for task in tasks:
+                yield _run_one(task)
+        finally:
+            # do not keep the caller's model alive after the sweep
+            _worker.clear()
+        return
+
+    ctx = multiprocessing.get_context(mp_context)
+    with ctx.Pool(processes, initializer=_init_worker, initargs=init_args) as pool:
+        for res in pool.imap_unordered(_run_one, tasks, chunksize):
+            yield res
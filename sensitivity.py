@@ -0,0 +1,378 @@
+"""
+    Global sensitivity analysis of the ASM2d-N2O kinetic constants.
+
+    -   sensitivity_analysis(): staged screening of the _kinetics_20C entries for their influence on
+        the N2O emission factor, effluent N and effluent P of a steady-state CSTR. Morris elementary
+        effects over all constants first, then variance-based Sobol indices (first order and total)
+        of the constants that survive the screening.
+
+    Model evaluations are steady-state solves done in vectorized batches (steady.batch_steady_state),
+    optionally spread over a process pool. Every finished batch is saved under a cache directory
+    keyed by the whole configuration, so an interrupted run resumes where it stopped.
+
+    Reference:
+        Massara, T.M., Solís, B., Guisasola, A., Katsou, E. and Baeza, J.A., 2018.
+        Development of an ASM2d-N2O model to describe nitrous oxide emissions in municipal WWTPs under dynamic conditions.
+        Chemical Engineering Journal, 335, pp.185-196.
+        (https://doi.org/10.1016/j.cej.2017.10.119)
+
+        Campolongo, F., Cariboni, J. and Saltelli, A., 2007. An effective screening design for sensitivity
+        analysis of large models. Environmental Modelling & Software, 22(10), pp.1509-1518.
+
+        Saltelli, A., Annoni, P., Azzini, I., Campolongo, F., Ratto, M. and Tarantola, S., 2010.
+        Variance based sensitivity analysis of model output. Design and estimator for the total
+        sensitivity index. Computer Physics Communications, 181(2), pp.259-270.
+"""
+
+
+import hashlib
+import multiprocessing
+import os
+
+import numpy as np
+from scipy.stats import qmc
+
+from .ASM2d_N2O import COMP_NAMES
+from .montecarlo import n2o_emission_factor
+from .steady import batch_steady_state
+
+
+# model outputs ranked by the analysis
+OUTPUTS = ('N2O_EF', 'effluent_N', 'effluent_P')
+
+# components summed into effluent_N, and the phosphate of effluent_P
+_INORGANIC_N = np.array([COMP_NAMES.index(name)
+                         for name in ('S_NH4', 'S_NH2OH', 'S_N2O', 'S_NO', 'S_NO2', 'S_NO3')])
+_PO4 = COMP_NAMES.index('S_PO4')
+
+# number of parameter sets per model evaluation batch (and per cached file)
+BATCH_SIZE = 256
+
+# state of the current worker process, set by _init_worker
+_worker = {}
+
+
+def model_outputs(comps, in_comps, model, vol, flow):
+    '''
+    Outputs of the analysis for steady states, shape (N, len(OUTPUTS)).
+
+    N2O_EF:         N2O-N production (effluent and stripped) per influent NH4-N, gN/gN;
+    effluent_N:     soluble inorganic N (NH4, NH2OH, N2O, NO, NO2, NO3), mgN/L;
+    effluent_P:     phosphate, mgP/L
+
+    '''
+    return np.column_stack([n2o_emission_factor(comps, in_comps, model, vol, flow),
+                            comps[:, _INORGANIC_N].sum(axis=1),
+                            comps[:, _PO4]])
+
+
+class sa_result(object):
+    '''
+    Result of a staged sensitivity analysis.
+
+    '''
+
+    def __init__(self, names, morris, survivors, sobol):
+        '''
+        Args:
+            names:      kinetic constants screened by Morris;
+            morris:     dict of output name to dict with 'mu_star' and 'sigma', (len(names),) arrays;
+            survivors:  kinetic constants passed on to the Sobol stage;
+            sobol:      dict of output name to dict with 'S1' and 'ST', (len(survivors),) arrays
+
+        Return:
+            None
+
+        '''
+        self.names = names
+        self.morris = morris
+        self.survivors = survivors
+        self.sobol = sobol
+
+        return None
+
+
+    def ranking(self, output, stage='sobol'):
+        '''
+        Return (name, index) pairs sorted by decreasing influence on output.
+
+        Args:
+            output:     one of OUTPUTS;
+            stage:      'sobol' (ranked by ST) or 'morris' (ranked by mu_star)
+
+        Return:
+            list of (str, float)
+
+        '''
+        if stage == 'sobol':
+            names, vals = self.survivors, self.sobol[output]['ST']
+        else:
+            names, vals = self.names, self.morris[output]['mu_star']
+        order = np.argsort(-np.nan_to_num(vals, nan=-np.inf))
+
+        return [(names[i], float(vals[i])) for i in order]
+
+
+def _init_worker(model, case):
+    '''
+    Keep the model and the steady-state case in this worker process.
+
+    '''
+    _worker.update(model=model, case=case)
+
+    return None
+
+
+def _run_batch(task):
+    '''
+    Steady-state outputs of one batch of parameter sets; nan where a solve did not converge.
+
+    '''
+    k, kinetics_20C = task
+    model, case = _worker['model'], _worker['case']
+
+    params = model.batch_params(kinetics_20C)
+    res = batch_steady_state(model, case['init_comps'], case['in_comps'], case['vol'], case['flow'], params,
+                             fix_DO=case['fix_DO'], DO_sat_T=case['DO_sat_T'])
+    out = model_outputs(res.comps, case['in_comps'], model, case['vol'], case['flow'])
+    out[~res.converged] = np.nan
+
+    return k, out
+
+
+class _evaluator(object):
+    '''
+    Batched, cached and optionally parallel evaluation of model_outputs.
+
+    '''
+
+    def __init__(self, model, case, cache_dir, batch_size, processes, mp_context):
+        '''
+        Args:
+            model:          an ASM2d_N2O instance;
+            case:           steady-state case, see sensitivity_analysis();
+            cache_dir:      directory of the evaluation cache, or None;
+            batch_size:     number of parameter sets per batch;
+            processes:      number of worker processes;
+            mp_context:     multiprocessing start method or None
+
+        Return:
+            None
+
+        '''
+        self._model = model
+        self._case = case
+        self._cache_dir = cache_dir
+        self._batch_size = batch_size
+        self._processes = processes
+        self._mp_context = mp_context
+
+        # the cache key covers everything that changes the model outputs
+        key = hashlib.sha256()
+        key.update(model._kinetics_20C_vals.tobytes())
+        key.update(model._log_theta.tobytes())
+        key.update(model._strip_ratio.tobytes() + model._strip_sat.tobytes())
+        key.update(repr((model._temperature, model._bulk_DO, model._pH, model._KLa, batch_size)).encode())
+        key.update(repr(sorted((k, np.asarray(v).tolist()) for k, v in case.items())).encode())
+        self._key = key.hexdigest()[:16]
+
+        return None
+
+
+    def __call__(self, stage, names, values):
+        '''
+        Outputs for parameter sets values (M, len(names)) of 20C constants, shape (M, len(OUTPUTS)).
+
+        '''
+        stage_dir = None
+        if self._cache_dir is not None:
+            key = hashlib.sha256((self._key + repr(names)).encode())
+            key.update(np.ascontiguousarray(values).tobytes())
+            stage_dir = os.path.join(self._cache_dir, '{}_{}'.format(stage, key.hexdigest()[:16]))
+            os.makedirs(stage_dir, exist_ok=True)
+
+        out = np.empty((len(values), len(OUTPUTS)))
+        tasks = []
+        for k, start in enumerate(range(0, len(values), self._batch_size)):
+            stop = min(start + self._batch_size, len(values))
+            path = None if stage_dir is None else os.path.join(stage_dir, 'batch_{}.npy'.format(k))
+            if path is not None and os.path.exists(path):
+                out[start:stop] = np.load(path)
+            else:
+                tasks.append((k, {name: values[start:stop, j] for j, name in enumerate(names)}))
+
+        for k, batch_out in self._run(tasks):
+            start = k * self._batch_size
+            out[start:start + len(batch_out)] = batch_out
+            if stage_dir is not None:
+                # write-then-rename, so an interrupted run never leaves a partial batch
+                path = os.path.join(stage_dir, 'batch_{}.npy'.format(k))
+                np.save(path + '.tmp.npy', batch_out)
+                os.replace(path + '.tmp.npy', path)
+
+        return out
+
+
+    def _run(self, tasks):
+        '''
+        Yield (batch index, outputs) of the tasks, in this process or over a pool.
+
+        '''
+        processes = max(1, min(self._processes, len(tasks)))
+        if processes == 1:
+            _init_worker(self._model, self._case)
+            for task in tasks:
+                yield _run_batch(task)
+            return
+
+        ctx = multiprocessing.get_context(self._mp_context)
+        with ctx.Pool(processes, initializer=_init_worker, initargs=(self._model, self._case)) as pool:
+            for res in pool.imap_unordered(_run_batch, tasks):
+                yield res
+
+
+def _morris_design(n_factors, trajectories, levels, rng):
+    '''
+    Morris trajectories in the unit hypercube.
+
+    Return:
+        points (trajectories * (n_factors + 1), n_factors), and for each trajectory
+        the factor changed at each step and the signed step size
+
+    '''
+    delta = levels / (2.0 * (levels - 1))
+    points = np.empty((trajectories, n_factors + 1, n_factors))
+    order = np.empty((trajectories, n_factors), dtype=int)
+    steps = np.empty((trajectories, n_factors))
+    for r in range(trajectories):
+        x = rng.integers(0, levels, n_factors) / (levels - 1.0)
+        points[r, 0] = x
+        order[r] = rng.permutation(n_factors)
+        for s, i in enumerate(order[r]):
+            steps[r, s] = delta if x[i] + delta <= 1.0 else -delta
+            x[i] += steps[r, s]
+            points[r, s + 1] = x
+
+    return points.reshape(-1, n_factors), order, steps
+
+
+def _morris_indices(y, order, steps):
+    '''
+    mu_star and sigma of the elementary effects, shape (n_factors,) each.
+
+    '''
+    trajectories, n_factors = order.shape
+    y = y.reshape(trajectories, n_factors + 1)
+    effects = np.empty((trajectories, n_factors))
+    effects[np.arange(trajectories)[:, None], order] = np.diff(y, axis=1) / steps
+
+    return np.nanmean(np.abs(effects), axis=0), np.nanstd(effects, axis=0)
+
+
+def _sobol_indices(f_A, f_B, f_AB):
+    '''
+    First-order (Saltelli 2010) and total (Jansen) indices, shape (n_factors,) each.
+
+    '''
+    S1 = np.empty(f_AB.shape[0])
+    ST = np.empty(f_AB.shape[0])
+    for i, f_ABi in enumerate(f_AB):
+        ok = np.isfinite(f_A) & np.isfinite(f_B) & np.isfinite(f_ABi)
+        var = np.var(np.concatenate([f_A[ok], f_B[ok]]))
+        S1[i] = np.mean(f_B[ok] * (f_ABi[ok] - f_A[ok])) / var
+        ST[i] = 0.5 * np.mean((f_A[ok] - f_ABi[ok]) ** 2) / var
+
+    return S1, ST
+
+
+def sensitivity_analysis(model, init_comps, in_comps, vol, flow, names=None, bounds=None, rel_range=0.5,
+                         trajectories=10, levels=4, threshold=0.1, max_survivors=None, sobol_n=512,
+                         seed=0, cache_dir=None, processes=1, batch_size=BATCH_SIZE, mp_context=None,
+                         fix_DO=False, DO_sat_T=9.0):
+    '''
+    Rank kinetic constants by their influence on N2O emission, effluent N and effluent P.
+
+    Stage 1 screens all constants with Morris trajectories (trajectories *
+    (n + 1) evaluations). A constant survives if its mu_star, relative to
+    the largest mu_star of an output, reaches threshold for any output.
+    Stage 2 estimates Sobol indices of the survivors from a Saltelli design
+    (sobol_n * (n_survivors + 2) evaluations). Constants vary uniformly
+    between their bounds; evaluations whose steady state does not converge
+    are left out of the indices.
+
+    Args:
+        model:          an ASM2d_N2O instance (its temperature, DO, pH, KLa and 20C constants
+                        are the baseline);
+        init_comps:     initial guess of the steady state, mg/L (24 values);
+        in_comps:       influent component concentrations, mg/L (24 values);
+        vol:            reactor volume, m3;
+        flow:           influent flow rate, m3/d;
+        names:          kinetic constants to screen (default: all with a nonzero 20C value);
+        bounds:         dict of name to (low, high) 20C values, overriding rel_range;
+        rel_range:      default bounds, baseline * (1 - rel_range) to baseline * (1 + rel_range);
+        trajectories:   number of Morris trajectories;
+        levels:         number of Morris grid levels (even);
+        threshold:      relative mu_star needed to pass the screening;
+        max_survivors:  optional cap on the number of survivors, by relative mu_star;
+        sobol_n:        number of base samples of the Sobol stage (a power of 2);
+        seed:           seed of the Morris and Sobol designs;
+        cache_dir:      directory of the evaluation cache, or None for no caching;
+        processes:      number of worker processes evaluating batches;
+        batch_size:     number of parameter sets per batch;
+        mp_context:     multiprocessing start method or None for the default;
+        fix_DO:         whether to fix the DO concentration;
+        DO_sat_T:       saturation DO at the chosen temperature, mg/L
+
+    Return:
+        sa_result
+
+    '''
+    k20 = model._kinetics_20C
+    if names is None:
+        names = [name for name in model._param_names if k20[name] != 0]
+    bounds = dict(bounds or {})
+    for name in names:
+        if name not in k20:
+            raise ValueError('unknown kinetic constant: {}'.format(name))
+        bounds.setdefault(name, (k20[name] * (1.0 - rel_range), k20[name] * (1.0 + rel_range)))
+    low = np.array([bounds[name][0] for name in names], dtype=float)
+    high = np.array([bounds[name][1] for name in names], dtype=float)
+
+    case = {'init_comps': np.array(init_comps, dtype=float), 'in_comps': np.array(in_comps, dtype=float),
+            'vol': vol, 'flow': flow, 'fix_DO': fix_DO, 'DO_sat_T': DO_sat_T}
+    evaluate = _evaluator(model, case, cache_dir, batch_size, processes, mp_context)
+
+    ## Stage 1: Morris screening of all constants
+    rng = np.random.default_rng(seed)
+    unit, order, steps = _morris_design(len(names), trajectories, levels, rng)
+    y = evaluate('morris', names, low + unit * (high - low))
+
+    morris = {}
+    score = np.zeros(len(names))
+    for j, output in enumerate(OUTPUTS):
+        mu_star, sigma = _morris_indices(y[:, j], order, steps)
+        morris[output] = {'mu_star': mu_star, 'sigma': sigma}
+        if np.nanmax(mu_star) > 0:
+            score = np.maximum(score, np.nan_to_num(mu_star / np.nanmax(mu_star)))
+
+    keep = np.flatnonzero(score >= threshold)
+    keep = keep[np.argsort(-score[keep])][:max_survivors]
+    survivors = [names[i] for i in keep]
+
+    ## Stage 2: Sobol indices of the survivors
+    sobol = {}
+    if survivors:
+        d = len(survivors)
+        lo, hi = low[keep], high[keep]
+        u = qmc.Sobol(d=2 * d, scramble=True, seed=seed).random(sobol_n)
+        A, B = lo + u[:, :d] * (hi - lo), lo + u[:, d:] * (hi - lo)
+        # AB[i] is A with column i taken from B
+        AB = np.repeat(A[None], d, axis=0)
+        AB[np.arange(d), :, np.arange(d)] = B.T
+        y = evaluate('sobol', survivors, np.vstack([A, B, AB.reshape(-1, d)]))
+        for j, output in enumerate(OUTPUTS):
+            f = y[:, j]
+            S1, ST = _sobol_indices(f[:sobol_n], f[sobol_n:2 * sobol_n], f[2 * sobol_n:].reshape(d, sobol_n))
+            sobol[output] = {'S1': S1, 'ST': ST}
+
+    return sa_result(names, morris, survivors, sobol)
@@ -0,0 +1,273 @@
+"""
+    Integration drivers for the ASM2d-N2O reactor model.
+
+    -   simulate(): integrate the single-CSTR mass balance (ASM2d_N2O._dCdt) with a stiff solver
+        and the analytic-accuracy Jacobian (ASM2d_N2O.jacobian), optionally streaming the output
+        to a results.result_writer instead of keeping it in memory, and optionally integrating the
+        cumulative off-gas emissions of the stripped gases (ASM2d_N2O.set_stripping) with the state.
+
+    Reference:
+        Massara, T.M., Solís, B., Guisasola, A., Katsou, E. and Baeza, J.A., 2018.
+        Development of an ASM2d-N2O model to describe nitrous oxide emissions in municipal WWTPs under dynamic conditions.
+        Chemical Engineering Journal, 335, pp.185-196.
+        (https://doi.org/10.1016/j.cej.2017.10.119)
+"""
+
+
+import numpy as np
+from scipy import sparse
+from scipy.integrate import solve_ivp, BDF, Radau, LSODA
+
+from .ASM2d_N2O import STRIPPED_GASES
+
+
+# default solver tolerances, relative and absolute (mg/L)
+RTOL = 1e-6
+ATOL = 1e-8
+
+# solvers that can be stepped one at a time when streaming to a sink
+_METHODS = {'BDF': BDF, 'Radau': Radau, 'LSODA': LSODA}
+
+
+class sim_result(object):
+    '''
+    Compact result of a reactor simulation.
+
+    '''
+
+    def __init__(self, t, comps, sol, nfev, njev, nlu, success, message, emissions=None):
+        '''
+        Args:
+            t:          output times, days;
+            comps:      component concentrations at t, mg/L, shape (len(t), 24);
+            sol:        dense output interpolant (or None);
+            nfev:       number of dC/dt evaluations;
+            njev:       number of Jacobian evaluations;
+            nlu:        number of LU decompositions;
+            success:    whether the solver reached the end of the horizon;
+            message:    solver status message;
+            emissions:  dict of stripped gas to its cumulative emission since the start at t, g
+                        (mg/L x m3, in the units of the component), or None
+
+        Return:
+            None
+
+        '''
+        self.t = t
+        self.comps = comps
+        self.sol = sol
+        self.nfev = nfev
+        self.njev = njev
+        self.nlu = nlu
+        self.success = success
+        self.message = message
+        self.emissions = emissions
+
+        return None
+
+
+    def final(self):
+        '''
+        Return a copy of the component concentrations at the last output time.
+
+        '''
+        return self.comps[-1].copy()
+
+
+def simulate(model, init_comps, in_comps, t_end, vol, flow, fix_DO=False, DO_sat_T=9.0,
+             t_eval=None, t_start=0.0, dense_output=False, method='BDF', rtol=RTOL, atol=ATOL,
+             sink=None, max_step=np.inf, emissions=False):
+    '''
+    Integrate a single CSTR described by model._dCdt from t_start to t_end.
+
+    A stiff method is used by default, with model.jacobian supplied to the
+    solver and written into one preallocated buffer for the whole run.
+
+    With a sink, the solver is stepped directly and the output at the
+    t_eval points passed by each step is interpolated from the step and
+    appended to the sink (with the process rates, if the sink stores
+    them), so the trajectory is never held in memory. The returned result
+    then only holds the last output row.
+
+    With emissions, the masses of the stripped gases sent to the gas phase,
+    vol * stripping rate, are appended to the state as integrals from
+    t_start, so the solver integrates them under the same error control
+    and the totals of long runs need no pass over the trajectory. The
+    dense output interpolant then also covers these extra values.
+
+    Args:
+        model:          an ASM2d_N2O instance;
+        init_comps:     initial component concentrations, mg/L (24 values);
+        in_comps:       influent component concentrations, mg/L (24 values), or a callable of
+                        time returning them (e.g. influent.influent_reader);
+        t_end:          end of the time horizon, days;
+        vol:            reactor volume, m3;
+        flow:           influent flow rate, m3/d;
+        fix_DO:         whether to fix the DO concentration;
+        DO_sat_T:       saturation DO at the chosen temperature, mg/L;
+        t_eval:         output times, days (default: t_start and t_end only);
+        t_start:        start of the time horizon, days;
+        dense_output:   whether to keep a continuous interpolant in the result;
+        method:         stiff solver passed to scipy solve_ivp ('BDF', 'Radau' or 'LSODA');
+        rtol:           relative tolerance;
+        atol:           absolute tolerance, mg/L;
+        sink:           optional results.result_writer receiving the output rows;
+        max_step:       maximum solver step, days (e.g. a fraction of the period of a periodic
+                        influent, which the error control cannot see if the steps alias it);
+        emissions:      whether to integrate the cumulative emissions of the stripped gases
+
+    Return:
+        sim_result
+
+    '''
+    y0 = np.array(init_comps, dtype=float)
+    inf = in_comps if callable(in_comps) else np.array(in_comps, dtype=float)
+    if t_eval is None:
+        t_eval = np.array([t_start, t_end], dtype=float)
+
+    jac_buf = np.empty((24, 24))
+
+    def _rhs(t, y):
+        return model._dCdt(t, y, vol, flow, inf, fix_DO, DO_sat_T)
+
+    def _jac(t, y):
+        # the stiff solvers drop their previous Jacobian whenever they request a new one
+        return model.jacobian(t, y, vol, flow, inf, fix_DO, DO_sat_T, out=jac_buf)
+
+    if emissions:
+        _rhs, _jac, y0 = _with_emissions(model, _rhs, _jac, y0, vol)
+
+    if sink is not None:
+        return _simulate_to_sink(model, _rhs, _jac, y0, t_start, t_end, np.asarray(t_eval, dtype=float),
+                                 method, rtol, atol, fix_DO, sink, max_step)
+
+    res = solve_ivp(_rhs, (t_start, t_end), y0, method=method, t_eval=t_eval,
+                    dense_output=dense_output, jac=_jac, rtol=rtol, atol=atol, max_step=max_step)
+
+    # solve_ivp leaves y a list when it fails before the first output time
+    y = np.reshape(res.y, (len(y0), -1)).T
+
+    return sim_result(res.t, y[:, :24], res.sol, res.nfev, res.njev, res.nlu, res.success, res.message,
+                      _emissions(y))
+
+
+def _with_emissions(model, rhs, jac, y0, vol, KLa=None, emitted=None):
+    '''
+    Extend the right-hand side, Jacobian and initial state with the emission integrals.
+
+    The stripping reactors are the first blocks of 24 components of the
+    state: one for a single reactor, one per tank of a stacked flowsheet
+    state (len(vol) of them). A sparse Jacobian stays sparse.
+
+    Args:
+        model:      the ASM2d_N2O instance of the stripping settings;
+        rhs:        dC/dt of the state, a function of (t, y);
+        jac:        its Jacobian, a function of (t, y) returning an array or a sparse matrix;
+        y0:         initial state;
+        vol:        volume of the reactor, m3, (n,) volumes of the first n reactors of a stacked
+                    state, or a callable of time returning the volume of a single reactor;
+        KLa:        oxygen KLa of the reactors, 1/d (default: the model KLa at the current DO);
+        emitted:    emission totals at the start, in the order of STRIPPED_GASES (default 0)
+
+    Return:
+        (rhs, jac, y0) of the extended state
+
+    '''
+    size = len(y0)
+    n_gas = len(STRIPPED_GASES)
+    n = 1 if callable(vol) else np.size(vol)
+    volume = vol if callable(vol) else (lambda t: vol)
+    strip = model._strip_idx
+    # Jacobian positions of the emission rates: gas g of reactor k depends on its component
+    rows = np.tile(np.arange(n_gas), n)
+    cols = (24 * np.arange(n)[:, None] + strip).ravel()
+    jac_buf = np.zeros((size + n_gas, size + n_gas))
+
+    def _KLa():
+        return model._aeration_KLa() if KLa is None else KLa
+
+    def _rhs(t, y):
+        out = np.empty(size + n_gas)
+        # rhs applies the forcing at t, which sets the aeration seen by the stripping rates
+        out[:size] = rhs(t, y[:size])
+        rates = model.stripping_rates(y[:24 * n].reshape(n, 24), np.broadcast_to(_KLa(), (n,)))
+        out[size:] = np.broadcast_to(volume(t), (n,)) @ rates
+        return out
+
+    def _jac(t, y):
+        J = jac(t, y[:size])
+        vals = ((np.broadcast_to(volume(t), (n,)) * _KLa())[:, None] * model._strip_ratio).ravel()
+        if sparse.issparse(J):
+            E = sparse.csr_matrix((vals, (rows, cols)), shape=(n_gas, size))
+            return sparse.bmat([[J, None], [E, sparse.csr_matrix((n_gas, n_gas))]], format='csc')
+        jac_buf[:size, :size] = J
+        jac_buf[size + rows, cols] = vals
+        return jac_buf
+
+    emitted = np.zeros(n_gas) if emitted is None else np.asarray(emitted, dtype=float)
+
+    return _rhs, _jac, np.concatenate([y0, emitted])
+
+
+def _emissions(y, size=24):
+    '''
+    Split the emission integrals, if any, from output rows of a state of the given size.
+
+    '''
+    if y.shape[1] == size:
+        return None
+
+    return dict(zip(STRIPPED_GASES, y[:, size:].T.copy()))
+
+
+def _simulate_to_sink(model, rhs, jac, y0, t_start, t_end, t_eval, method, rtol, atol, fix_DO, sink, max_step):
+    '''
+    Step a solver from t_start to t_end and append the output at t_eval to sink.
+
+    '''
+    if method not in _METHODS:
+        raise ValueError('streaming to a sink supports the methods {}'.format(', '.join(_METHODS)))
+
+    solver = _METHODS[method](rhs, t_start, y0, t_end, jac=jac, rtol=rtol, atol=atol, max_step=max_step)
+
+    # outputs before the solver moves, then those passed by each step
+    i = int(np.searchsorted(t_eval, t_start, side='right'))
+    if i > 0:
+        _append_rows(model, sink, t_eval[:i], np.tile(y0[:24], (i, 1)), fix_DO)
+    # the last output row, kept with its time; both are empty until an output is written
+    t_last, y_last = t_eval[:i][-1:], y0[None, :][:min(i, 1)]
+
+    message = None
+    while solver.status == 'running':
+        message = solver.step()
+        if solver.status == 'failed':
+            break
+        j = int(np.searchsorted(t_eval, solver.t, side='right'))
+        if j > i:
+            comps = solver.dense_output()(t_eval[i:j]).T
+            _append_rows(model, sink, t_eval[i:j], comps[:, :24], fix_DO)
+            t_last, y_last = t_eval[j - 1:j], comps[-1:]
+            i = j
+
+    success = solver.status == 'finished'
+    if message is None:
+        message = 'The solver successfully reached the end of the integration interval.' if success else ''
+
+    return sim_result(t_last, y_last[:, :24].copy(), None, solver.nfev, solver.njev, solver.nlu, success,
+                      message, _emissions(y_last))
+
+
+def _append_rows(model, sink, t, comps, fix_DO):
+    '''
+    Append output rows to a sink, with the process rates if the sink stores them.
+
+    '''
+    rates = None
+    if sink.has_rates():
+        # forcing changes the parameters with time, so the rates are taken row by row
+        rates = np.empty((len(t), 40))
+        for k in range(len(t)):
+            rates[k] = model._reaction_rate(model._forced_comps(t[k], comps[k].tolist(), fix_DO))
+    sink.append(t, comps, rates)
+
+    return None
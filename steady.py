@@ -0,0 +1,482 @@
+"""
+    Steady-state solvers for the ASM2d-N2O reactor model.
+
+    -   steady_state(): solve dC/dt == 0 for a single CSTR (ASM2d_N2O._dCdt) by Newton iterations,
+        falling back to pseudo-transient continuation when Newton stalls.
+    -   batch_steady_state(): the same CSTR for many kinetic parameter sets at once, by pseudo-
+        transient continuation vectorized over the parameter sets.
+    -   periodic_steady_state(): the cyclic steady state of a CSTR under periodic influent, DO or
+        temperature (e.g. diurnal), by Newton shooting on the one-period map with the monodromy
+        matrix from forward.forward_sensitivity() and Broyden updates in between.
+
+    Reference:
+        Massara, T.M., Solís, B., Guisasola, A., Katsou, E. and Baeza, J.A., 2018.
+        Development of an ASM2d-N2O model to describe nitrous oxide emissions in municipal WWTPs under dynamic conditions.
+        Chemical Engineering Journal, 335, pp.185-196.
+        (https://doi.org/10.1016/j.cej.2017.10.119)
+
+        Kelley, C.T. and Keyes, D.E., 1998. Convergence analysis of pseudo-transient continuation.
+        SIAM Journal on Numerical Analysis, 35(2), pp.508-523.
+
+        Aprille, T.J. and Trick, T.N., 1972. Steady-state analysis of nonlinear circuits with
+        periodic inputs. Proceedings of the IEEE, 60(1), pp.108-114.
+"""
+
+
+import numpy as np
+from scipy.linalg import lu_factor, lu_solve
+
+from .forward import forward_sensitivity
+from .simulation import simulate, RTOL, ATOL
+
+
+# smallest fraction of its current value a concentration may drop to in one update
+_MIN_FRACTION = 0.1
+
+
+class ss_result(object):
+    '''
+    Result of a steady-state solve.
+
+    '''
+
+    def __init__(self, comps, converged, n_iter, n_jac, residual, method):
+        '''
+        Args:
+            comps:      steady-state component concentrations, mg/L (24 values);
+            converged:  whether the residual tolerance was met;
+            n_iter:     number of nonlinear iterations (Newton + continuation);
+            n_jac:      number of Jacobian evaluations;
+            residual:   final scaled residual, 1/d;
+            method:     'newton' or 'ptc', the phase that produced comps
+
+        Return:
+            None
+
+        '''
+        self.comps = comps
+        self.converged = converged
+        self.n_iter = n_iter
+        self.n_jac = n_jac
+        self.residual = residual
+        self.method = method
+
+        return None
+
+
+class periodic_result(object):
+    '''
+    Result of a periodic steady-state solve.
+
+    '''
+
+    def __init__(self, t, comps, converged, n_iter, n_periods, n_monodromy, residual, monodromy):
+        '''
+        Args:
+            t:              output times over one period, days;
+            comps:          component concentrations at t, mg/L, shape (len(t), 24);
+            converged:      whether the residual tolerance was met;
+            n_iter:         number of shooting iterations;
+            n_periods:      number of one-period simulations, sensitivity runs not included;
+            n_monodromy:    number of monodromy matrix evaluations (sensitivity runs);
+            residual:       final scaled change of the state over one period;
+            monodromy:      last evaluated dC(t_start + period) / dC(t_start), shape (24, 24)
+
+        Return:
+            None
+
+        '''
+        self.t = t
+        self.comps = comps
+        self.converged = converged
+        self.n_iter = n_iter
+        self.n_periods = n_periods
+        self.n_monodromy = n_monodromy
+        self.residual = residual
+        self.monodromy = monodromy
+
+        return None
+
+
+def _bounded_update(x, dx):
+    '''
+    Return x + dx, with each component kept at or above a fraction of its current value.
+
+    '''
+    return np.maximum(x + dx, _MIN_FRACTION * x)
+
+
+def _scaled_norm(f, x):
+    '''
+    Max-norm of dC/dt relative to the concentrations (1 mg/L floor), 1/d.
+
+    '''
+    return np.max(np.abs(f) / (np.abs(x) + 1.0))
+
+
+def steady_state(model, init_comps, in_comps, vol, flow, fix_DO=False, DO_sat_T=9.0,
+                 tol=1e-9, max_newton=30, max_ptc=500, dt0=1e-2):
+    '''
+    Solve model._dCdt == 0 for a single CSTR.
+
+    Newton iterations reuse one LU factorization of the Jacobian while the
+    residual keeps contracting and refresh it otherwise. If Newton stalls,
+    pseudo-transient continuation solves (I / dt - J) dx = f with the
+    pseudo time step grown by switched evolution relaxation, which turns
+    into Newton again near the solution.
+
+    Concentrations stay non-negative: no component may fall below a fixed
+    fraction of its current value in one update. This also keeps the
+    iterates off the trivial wash-out solutions (a biomass of exactly zero
+    is always stationary).
+
+    Args:
+        model:          an ASM2d_N2O instance;
+        init_comps:     initial guess of the component concentrations, mg/L (24 values);
+        in_comps:       influent component concentrations, mg/L (24 values);
+        vol:            reactor volume, m3;
+        flow:           influent flow rate, m3/d;
+        fix_DO:         whether to fix the DO concentration;
+        DO_sat_T:       saturation DO at the chosen temperature, mg/L;
+        tol:            tolerance on the scaled residual, 1/d;
+        max_newton:     maximum number of Newton iterations;
+        max_ptc:        maximum number of continuation iterations;
+        dt0:            initial pseudo time step, days
+
+    Return:
+        ss_result
+
+    '''
+    x = np.maximum(np.array(init_comps, dtype=float), 0.0)
+    inf = np.array(in_comps, dtype=float)
+    jac_buf = np.empty((24, 24))
+
+    # DO is held constant when fixed or anoxic, so its row is replaced by dx[0] == 0
+    hold_DO = fix_DO or model._bulk_DO == 0
+
+    def _fun(x):
+        return model._dCdt(0.0, x, vol, flow, inf, fix_DO, DO_sat_T)
+
+    def _jac(x):
+        jac = model.jacobian(0.0, x, vol, flow, inf, fix_DO, DO_sat_T, out=jac_buf)
+        if hold_DO:
+            jac[0, 0] = -1.0
+        return jac
+
+    f = _fun(x)
+    res = _scaled_norm(f, x)
+    n_iter = 0
+    n_jac = 0
+
+    ## Newton iterations with a reused factorization and backtracking
+    lu = None
+    fresh = False
+    while res > tol and n_iter < max_newton:
+        if lu is None:
+            lu = lu_factor(_jac(x))
+            n_jac += 1
+            fresh = True
+        dx = lu_solve(lu, -f)
+
+        step = 1.0
+        while step > 1e-4:
+            x_new = _bounded_update(x, step * dx)
+            f_new = _fun(x_new)
+            res_new = _scaled_norm(f_new, x_new)
+            if res_new < res:
+                break
+            step *= 0.5
+        n_iter += 1
+
+        if res_new >= res:
+            if fresh:
+                # no descent even with a current Jacobian, hand over to continuation
+                break
+            lu = None
+            continue
+
+        # keep the factorization only while the residual contracts quickly
+        if res_new > 0.5 * res or step < 1.0:
+            lu = None
+        fresh = False
+        x, f, res = x_new, f_new, res_new
+
+    if res <= tol:
+        return ss_result(x, True, n_iter, n_jac, res, 'newton')
+
+    ## Pseudo-transient continuation with switched evolution relaxation
+    dt = dt0
+    eye = np.eye(24)
+    jac = _jac(x)
+    n_jac += 1
+    for i in range(max_ptc):
+        dx = np.linalg.solve(eye / dt - jac, f)
+        x_new = _bounded_update(x, dx)
+        f_new = _fun(x_new)
+        res_new = _scaled_norm(f_new, x_new)
+        n_iter += 1
+
+        if not np.isfinite(res_new):
+            dt *= 0.1
+            continue
+
+        grew = res_new > res
+        dt = min(dt * max(res / max(res_new, 1e-300), 0.1), 1e12)
+        x, f, res = x_new, f_new, res_new
+        if res <= tol:
+            break
+
+        # refresh the Jacobian every few steps, or when the residual grows
+        if grew or i % 5 == 4:
+            jac = _jac(x)
+            n_jac += 1
+
+    return ss_result(x, res <= tol, n_iter, n_jac, res, 'ptc')
+
+
+def _batch_dCdt(model, x, inf, vol, flow, params, stoich_mat, hold_DO, DO_sat_T):
+    '''
+    dC/dt of N CSTRs with their own kinetic parameters, shape (N, 24).
+
+    '''
+    _, net_rates = model.batch_reaction_rate(x, params=params, stoich_mat=stoich_mat)
+    f = (inf - x) / (vol / flow) + net_rates
+    if hold_DO:
+        f[:, 0] = 0.0
+    else:
+        f[:, 0] += model._KLa * (DO_sat_T - x[:, 0])
+    f[:, model._strip_idx] -= model.stripping_rates(x)
+
+    return f
+
+
+def _batch_jacobian(model, x, vol, flow, params, stoich_mat, hold_DO):
+    '''
+    Jacobians of _batch_dCdt by complex step, shape (N, 24, 24).
+
+    '''
+    n = x.shape[0]
+    h = 1e-30
+    # rows 24 * k + j perturb component j of parameter set k
+    states = np.repeat(x, 24, axis=0).astype(complex)
+    states[np.arange(n * 24), np.tile(np.arange(24), n)] += 1j * h
+    proc_rates, _ = model.batch_reaction_rate(states, params=np.repeat(params, 24, axis=0))
+
+    jac = np.matmul(proc_rates.imag.reshape(n, 24, 40), stoich_mat).transpose(0, 2, 1) / h
+    jac[:, np.arange(24), np.arange(24)] -= flow / vol
+    if hold_DO:
+        jac[:, 0, :] = 0.0
+        jac[:, 0, 0] = -1.0
+    else:
+        jac[:, 0, 0] -= model._KLa
+    jac[:, model._strip_idx, model._strip_idx] -= model._aeration_KLa() * model._strip_ratio
+
+    return jac
+
+
+def batch_steady_state(model, init_comps, in_comps, vol, flow, params, fix_DO=False, DO_sat_T=9.0,
+                       tol=1e-9, max_iter=500, dt0=1e-2):
+    '''
+    Solve dC/dt == 0 of a single CSTR for N kinetic parameter sets at once.
+
+    Every iteration evaluates the residuals and complex-step Jacobians of
+    all unconverged parameter sets in one batched kernel call and solves
+    their pseudo-transient continuation systems (I / dt - J) dx = f with
+    one stacked linear solve. Each set has its own pseudo time step, grown
+    by switched evolution relaxation, so it turns into Newton near its
+    solution. Updates are bounded as in steady_state().
+
+    Args:
+        model:          an ASM2d_N2O instance (temperature, DO, pH and KLa are shared);
+        init_comps:     initial guess, mg/L, shape (24,) or (N, 24);
+        in_comps:       influent component concentrations, mg/L (24 values);
+        vol:            reactor volume, m3;
+        flow:           influent flow rate, m3/d;
+        params:         kinetic parameters of each set, shape (N, n_params) (see model.batch_params);
+        fix_DO:         whether to fix the DO concentration;
+        DO_sat_T:       saturation DO at the chosen temperature, mg/L;
+        tol:            tolerance on the scaled residual, 1/d;
+        max_iter:       maximum number of continuation iterations;
+        dt0:            initial pseudo time step, days
+
+    Return:
+        ss_result, with comps of shape (N, 24) and converged, n_iter and residual of shape (N,)
+
+    '''
+    params = np.asarray(params, dtype=float)
+    n = params.shape[0]
+    stoich_mat = model.batch_stoich_mat(params)
+    inf = np.array(in_comps, dtype=float)
+    x = np.maximum(np.array(np.broadcast_to(init_comps, (n, 24)), dtype=float), 0.0)
+    hold_DO = fix_DO or model._bulk_DO == 0
+
+    # non-finite trial steps (e.g. X_PP / X_PAO of a washed-out X_PAO) are rejected below
+    with np.errstate(divide='ignore', over='ignore', invalid='ignore'):
+        return _batch_ptc(model, x, inf, vol, flow, params, stoich_mat, hold_DO, DO_sat_T, tol, max_iter, dt0)
+
+
+def _batch_ptc(model, x, inf, vol, flow, params, stoich_mat, hold_DO, DO_sat_T, tol, max_iter, dt0):
+    '''
+    Pseudo-transient continuation iterations of batch_steady_state.
+
+    '''
+    n = x.shape[0]
+    f = _batch_dCdt(model, x, inf, vol, flow, params, stoich_mat, hold_DO, DO_sat_T)
+    res = np.max(np.abs(f) / (np.abs(x) + 1.0), axis=1)
+    dt = np.full(n, float(dt0))
+    n_iter = np.zeros(n, dtype=int)
+    n_jac = 0
+    eye = np.eye(24)
+
+    for i in range(max_iter):
+        act = np.flatnonzero(res > tol)
+        if len(act) == 0:
+            break
+
+        xa, pa, sa = x[act], params[act], stoich_mat[act]
+        jac = _batch_jacobian(model, xa, vol, flow, pa, sa, hold_DO)
+        n_jac += 1
+        dx = np.linalg.solve(eye / dt[act, None, None] - jac, f[act][:, :, None])[:, :, 0]
+
+        x_new = _bounded_update(xa, dx)
+        f_new = _batch_dCdt(model, x_new, inf, vol, flow, pa, sa, hold_DO, DO_sat_T)
+        res_new = np.max(np.abs(f_new) / (np.abs(x_new) + 1.0), axis=1)
+        n_iter[act] += 1
+
+        # reject non-finite steps with a smaller pseudo time step
+        ok = np.isfinite(res_new)
+        dt[act[~ok]] *= 0.1
+
+        acc = act[ok]
+        dt[acc] = np.minimum(dt[acc] * np.maximum(res[acc] / np.maximum(res_new[ok], 1e-300), 0.1), 1e12)
+        x[acc], f[acc], res[acc] = x_new[ok], f_new[ok], res_new[ok]
+
+    return ss_result(x, res <= tol, n_iter, n_jac, res, 'ptc')
+
+
+def periodic_steady_state(model, init_comps, in_comps, vol, flow, period=1.0, fix_DO=False, DO_sat_T=9.0,
+                          t_start=0.0, n_out=97, tol=1e-6, max_iter=30, max_step=None, method='BDF',
+                          rtol=RTOL, atol=ATOL):
+    '''
+    Solve for the state that a CSTR under periodic conditions returns to after one period.
+
+    The one-period map P(x) is a simulation from t_start to t_start +
+    period, and P(x) - x == 0 is solved by Newton shooting. Its Jacobian
+    is M - I, with M the monodromy matrix dP/dx, which is integrated
+    together with the state as 24 sensitivity columns sharing one LU
+    factorization per step (forward.forward_sensitivity). Between
+    evaluations of M, the Jacobian is kept and corrected by Broyden
+    updates with every accepted step, so most iterations cost a single
+    period simulation; it is evaluated again only when the residual stops
+    contracting. Steps are backtracked and kept non-negative as in
+    steady_state. Slow modes such as biomass growth, which take tens of
+    periods to settle by plain integration, converge in a few
+    iterations.
+
+    Args:
+        model:          an ASM2d_N2O instance (with periodic forcing functions, if any);
+        init_comps:     initial guess of the state at t_start, mg/L (24 values);
+        in_comps:       influent component concentrations, mg/L (24 values), or a callable of time,
+                        periodic with the period;
+        vol:            reactor volume, m3;
+        flow:           influent flow rate, m3/d;
+        period:         period of the influent and forcing, days;
+        fix_DO:         whether to fix the DO concentration;
+        DO_sat_T:       saturation DO at the chosen temperature, mg/L;
+        t_start:        time at which the period starts, days;
+        n_out:          number of evenly spaced output times over the period, both ends included;
+        tol:            tolerance on the scaled change over one period (1 mg/L floor); it must be
+                        above the accuracy of the simulations;
+        max_iter:       maximum number of shooting iterations;
+        max_step:       maximum solver step, days (default: period / 24), so that no step skips
+                        over the periodic inputs;
+        method:         stiff solver of the period simulations passed to scipy solve_ivp;
+        rtol:           relative tolerance of the simulations;
+        atol:           absolute tolerance of the simulations, mg/L
+
+    Return:
+        periodic_result
+
+    '''
+    x = np.maximum(np.array(init_comps, dtype=float), 0.0)
+    t_end = t_start + period
+    t_out = np.linspace(t_start, t_end, n_out)
+    if max_step is None:
+        max_step = period / 24.0
+
+    # DO is held constant when fixed or anoxic, so its row is replaced by dx[0] == 0
+    hold_DO = fix_DO or model._bulk_DO == 0
+    eye = np.eye(24)
+    counts = {'periods': 0, 'monodromy': 0}
+
+    def _period(x):
+        counts['periods'] += 1
+        return simulate(model, x, in_comps, t_end, vol, flow, fix_DO, DO_sat_T, t_eval=t_out, t_start=t_start,
+                        method=method, rtol=rtol, atol=atol, max_step=max_step)
+
+    def _jac(x):
+        counts['monodromy'] += 1
+        sens = forward_sensitivity(model, [], x, in_comps, t_end, vol, flow, fix_DO, DO_sat_T,
+                                   t_start=t_start, rtol=rtol, atol=atol, init_sens=eye, max_step=max_step)
+        if not sens.success:
+            return None, None
+        mono = sens.sens[-1]
+        jac = mono - eye
+        if hold_DO:
+            jac[0, :] = 0.0
+            jac[0, 0] = -1.0
+        return mono, jac
+
+    run = _period(x)
+    if not run.success:
+        return periodic_result(run.t, run.comps, False, 0, counts['periods'], 0, np.inf, None)
+    f = run.comps[-1] - x
+    res = _scaled_norm(f, x)
+    n_iter = 0
+    mono = jac = None
+    fresh = False
+
+    while res > tol and n_iter < max_iter:
+        if jac is None:
+            mono, jac = _jac(x)
+            if jac is None:
+                break
+            fresh = True
+        try:
+            dx = np.linalg.solve(jac, -f)
+        except np.linalg.LinAlgError:
+            dx = np.linalg.lstsq(jac, -f, rcond=None)[0]
+
+        ## Backtracking on the one-period residual
+        step = 1.0
+        while step > 1e-3:
+            x_new = _bounded_update(x, step * dx)
+            run_new = _period(x_new)
+            if run_new.success:
+                f_new = run_new.comps[-1] - x_new
+                res_new = _scaled_norm(f_new, x_new)
+                if res_new < res:
+                    break
+            step *= 0.5
+        n_iter += 1
+
+        if not run_new.success or res_new >= res:
+            if fresh:
+                # no descent even with a current monodromy matrix
+                break
+            jac = None
+            continue
+
+        # Broyden correction of the Jacobian along the step actually taken
+        s = x_new - x
+        jac += np.outer((f_new - f) - jac @ s, s) / (s @ s)
+        if hold_DO:
+            jac[0, :] = 0.0
+            jac[0, 0] = -1.0
+        # evaluate the monodromy matrix again once the residual contracts slowly
+        if res_new > 0.5 * res:
+            jac = None
+        fresh = False
+        x, f, res, run = x_new, f_new, res_new, run_new
+
+    return periodic_result(run.t, run.comps, res <= tol, n_iter, counts['periods'], counts['monodromy'], res, mono)